@@ -0,0 +1,541 @@
+"""
+Benchmarks for the loader tools, run against synthetic plone exports.
+
+    python benchmark.py parse --items 300000
+
+writes a synthetic export (about 10KB per item, so 300000 items is ~3GB) built from the stories in
+data/sample.json, then reads it the old way (text mode, ijson's default backend, whole items)
+and the current way (validator.ExportReader: binary, C backend, large reads, projected fields),
+then sharded across --workers processes (validator.ShardedReader), each in a fresh process,
+and reports items/second and peak RSS for each.
+
+    python benchmark.py preprocess --items 100000
+
+times the original in-place preprocess_item against story.preprocess_item, per item.
+
+    python benchmark.py e2e --items 100000 --concurrency 16 --latency 0.05
+
+runs loader.py, editor.py, remove_privates.py and label_editor.py for real against a local
+mock_nuclia.py (with the given per request latency and --rate-limit fraction of 429s) and reports
+items/second, p95 request latency and peak RSS for each.  Use from 1000 up to 1000000 items.
+It also syncs a resource cache from the mock's catalog with resource_cache.py, and checks that the
+relabel and the sync did what they should - so the mock's replies are checked against the sdk's models.
+
+    python benchmark.py compressed --items 100000
+
+gzips and zstds the synthetic export, then reads each (validator.ExportReader, decompressing in a
+thread as it parses) against the uncompressed one, and against decompressing inline in the parsing
+thread - reporting size on disk, items/second, MB/s of json and peak RSS.  The synthetic export repeats
+a handful of stories, so it compresses much better than a real one.  zstd needs the zstandard package.
+
+    python benchmark.py startup
+
+imports each tool in a fresh interpreter with python -X importtime and reports how long the import
+took, and whether it pulled in the sdk, the http stack or the api keys - none of them should.
+"""
+import argparse
+import copy
+import gzip
+import json
+import os
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE = os.path.join(HERE, "data", "sample.json")
+
+# the tools, and the modules only a request to nuclia should need
+TOOLS = ('validator', 'indexer', 'delta', 'loader', 'editor', 'remove_privates', 'label_editor', 'resource_cache',
+         'retry', 'orchestrate')
+REQUEST_MODULES = ('nuclia', 'nucliadb_sdk', 'nucliadb_models', 'httpx', 'pydantic', 'keys_confg')
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="benchmark the loader tools against a synthetic plone export",
+                                     usage="usage: benchmark.py {parse,preprocess,e2e,compressed,startup} [--items N] [--export filename] [--keep] "
+                                           "[--concurrency N] [--latency S] [--rate-limit F]")
+    parser.add_argument("benchmark",
+                        choices=['parse', 'parse-run', 'preprocess', 'e2e', 'compressed', 'startup'],
+                        help="which benchmark to run")
+
+    parser.add_argument("--items",
+                        type=int,
+                        help="number of stories in the synthetic export",
+                        default=20000)
+
+    parser.add_argument("--export",
+                        help="use (or create, if it doesn't exist) this export file instead of a temporary one")
+
+    parser.add_argument("--keep",
+                        help="don't delete the synthetic export afterwards",
+                        action="store_true")
+
+    parser.add_argument("--knowledgebox",
+                        help="e2e: the knowledgebox name to load (any configured one - the mock accepts them all)",
+                        default="Korean")
+
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="e2e: the loader's and remove_privates' --concurrency",
+                        default=8)
+
+    parser.add_argument("--latency",
+                        type=float,
+                        help="e2e: seconds the mock takes over each request",
+                        default=0.02)
+
+    parser.add_argument("--rate-limit",
+                        type=float,
+                        help="e2e: fraction of requests the mock answers 429",
+                        default=0.0)
+
+    parser.add_argument("--workers",
+                        type=int,
+                        help="parse: processes for the sharded reader.  default: one per core",
+                        default=os.cpu_count())
+
+    parser.add_argument("--mode",
+                        help=argparse.SUPPRESS)
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def make_export(filename, count, unpublished_every=10):
+    """ write a synthetic plone export of 'count' stories, one item at a time.
+        every 'unpublished_every'th story is private.
+    """
+    with open(SAMPLE, 'r') as filep:
+        samples = [item for item in json.load(filep) if '@id' in item]
+
+    with open(filename, 'w') as filep:
+        filep.write("[\n")
+        for n in range(count):
+            item = copy.copy(samples[n % len(samples)])
+            item['UID'] = uuid.uuid4().hex
+            item['@id'] = f"{item['@id'].rsplit('.html', 1)[0]}-{n}.html"
+            item['review_state'] = "private" if unpublished_every and n % unpublished_every == 0 else "published"
+            filep.write(json.dumps(item))
+            filep.write(",\n")
+        filep.write(json.dumps({"unexported_paths": []}))
+        filep.write("\n]\n")
+
+
+def peak_rss_mb():
+    """ this process's peak resident set size, in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)  # bytes on macOS, KB everywhere else
+    return peak / 1024
+
+
+def run_parse(mode, filename, workers=1):
+    """ read every item of the export in this process, the old way, the new way, sharded,
+        or (for a compressed export) inline: decompressing in this thread rather than another.
+    """
+    # both ways import the same modules, so the RSS comparison is only the parsing.
+    import ijson
+    import validator
+    import story
+
+    tstart = time.monotonic()
+    count = 0
+    if mode == 'baseline':
+        with open(filename, 'r') as filep:
+            for item in ijson.items(filep, 'item'):
+                count += 1
+    elif mode == 'sharded':
+        for item in validator.ShardedReader(filename, fields=story.PREPROCESS_FIELDS, workers=workers):
+            count += 1
+    elif mode == 'inline':
+        import compressed
+        with open(filename, 'rb') as filep:
+            with compressed.decompressed(filep, compressed.compression(filename)) as stream:
+                for item in validator.ijson_backend.items(stream, 'item', buf_size=validator.BUFFER_SIZE):
+                    count += 1
+    else:
+        for item in validator.ExportReader(filename, fields=story.PREPROCESS_FIELDS):
+            count += 1
+    elapsed = time.monotonic() - tstart
+
+    return {'mode': mode,
+            'items': count,
+            'seconds': elapsed,
+            'items_per_second': count / elapsed,
+            'peak_rss_mb': peak_rss_mb(),
+            }
+
+
+def compare_parse(filename, workers):
+    results = []
+    for mode in ('baseline', 'fast', 'sharded'):
+        # each in its own process, so one's peak memory doesn't count against the other.
+        output = subprocess.run([sys.executable, __file__, 'parse-run', '--mode', mode, '--export', filename,
+                                 '--workers', str(workers)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+
+    size_mb = os.path.getsize(filename) / (1024 * 1024)
+    print(f"{filename}: {size_mb:.0f} MB, {results[0]['items']} items")
+    for result in results:
+        print(f"{result['mode']:>10}: {result['items_per_second']:10.0f} items/second "
+              f"({size_mb / result['seconds']:6.1f} MB/s) | peak RSS {result['peak_rss_mb']:7.1f} MB")
+    print(f"   speedup: {results[1]['items_per_second'] / results[0]['items_per_second']:.2f}x, "
+          f"sharded over {workers} workers {results[2]['items_per_second'] / results[0]['items_per_second']:.2f}x")
+
+
+def compress_export(filename, kind):
+    """ write a gzip or zstd copy of the export next to it, returning its filename, or None without zstandard """
+    if kind == 'gzip':
+        (compressed_filename, opener) = (f"{filename}.gz", lambda filep: gzip.GzipFile(fileobj=filep, mode='wb'))
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        (compressed_filename, opener) = (f"{filename}.zst", lambda filep: zstandard.ZstdCompressor().stream_writer(filep))
+
+    with open(filename, 'rb') as source, open(compressed_filename, 'wb') as filep:
+        with opener(filep) as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+    return compressed_filename
+
+
+def parse_run(mode, filename):
+    """ run_parse in a fresh process """
+    output = subprocess.run([sys.executable, __file__, 'parse-run', '--mode', mode, '--export', filename],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def compare_compressed(filename):
+    json_mb = os.path.getsize(filename) / (1024 * 1024)
+    runs = [('raw', filename, 'fast')]
+    compressed_filenames = []
+    for kind in ('gzip', 'zstd'):
+        compressed_filename = compress_export(filename, kind)
+        if compressed_filename is None:
+            print(f"{kind}: skipped - pip install zstandard")
+            continue
+        compressed_filenames.append(compressed_filename)
+        runs += [(kind, compressed_filename, 'fast'), (f"{kind} inline", compressed_filename, 'inline')]
+
+    try:
+        print(f"{filename}: {json_mb:.0f} MB of json")
+        baseline = None
+        for (name, run_filename, mode) in runs:
+            result = parse_run(mode, run_filename)
+            baseline = baseline or result['items_per_second']
+            size_mb = os.path.getsize(run_filename) / (1024 * 1024)
+            print(f"{name:>12}: {size_mb:8.1f} MB on disk ({json_mb / size_mb:5.1f}x) | "
+                  f"{result['items_per_second']:10.0f} items/second ({json_mb / result['seconds']:6.1f} MB/s of json, "
+                  f"{result['items_per_second'] / baseline:.2f}x raw) | peak RSS {result['peak_rss_mb']:7.1f} MB")
+    finally:
+        for compressed_filename in compressed_filenames:
+            os.remove(compressed_filename)
+
+
+def legacy_preprocess_item(item):
+    """ preprocess_item as it was before story.py, for comparison """
+    import urllib.parse
+    from story import LANGUAGES, LANGUAGE_LABELS
+
+    rfa_pattern = ".*\\.rfaweb.org"
+    item['@id'] = re.sub(rfa_pattern, "https://www.rfa.org", item['@id'])
+    benar_pattern = "https://.*\\.benarnews.org"
+    item['@id'] = re.sub(benar_pattern, "https://www.benarnews.org", item['@id'])
+
+    if not item['description'] or item['description'].isspace():
+        item['description'] = None
+
+    item['subjects'] = list([tag for tag in item['subjects'] if (tag and not tag.isspace())])
+
+    parsed_url = urllib.parse.urlparse(item['@id'])
+    language = parsed_url.path.split('/')[1]
+    language_code = LANGUAGES.get(language, "en")
+
+    item['language'] = {'title': language.capitalize(), 'token': language_code}
+
+    item['language_service'] = LANGUAGE_LABELS.get(language, 'unknown')
+    if language == 'english' and 'benar' in parsed_url.netloc:
+        item['language_service'] = "English BenarNews"
+
+    if item['text'] is None:
+        item['text'] = {"data": "",
+                        "content-type": "text/html"
+                        }
+
+    if item['featured_image'] is not None:
+        item['thumbnail'] = item['featured_image']['@id']
+    if item['image'] is not None:
+        item['thumbnail'] = item['@id']
+    elif item.get('p4_image') is not None:
+        item['thumbnail'] = item['p4_image']['@id']
+    else:
+        item['thumbnail'] = None
+
+    if item['thumbnail']:
+        item['thumbnail'] = item['thumbnail'] + "/@@images/image/image_thumb_tablet"
+        item['thumbnail'] = re.sub(rfa_pattern, "https://www.rfa.org", item['thumbnail'])
+        item['thumbnail'] = re.sub(benar_pattern, "https://www.benarnews.org", item['thumbnail'])
+
+    return item
+
+
+def compare_preprocess(count):
+    import story
+
+    with open(SAMPLE, 'r') as filep:
+        samples = [item for item in json.load(filep) if '@id' in item]
+
+    results = []
+    for (name, transform) in (('legacy', legacy_preprocess_item), ('story', story.preprocess_item)):
+        # fresh copies, made before the clock starts - the legacy transform changes them in place.
+        items = [copy.deepcopy(samples[n % len(samples)]) for n in range(count)]
+        tstart = time.perf_counter()
+        for item in items:
+            transform(item)
+        elapsed = time.perf_counter() - tstart
+        results.append((name, elapsed / count))
+
+    print(f"preprocess, {count} items")
+    for (name, per_item) in results:
+        print(f"{name:>10}: {per_item * 1e6:8.2f} microseconds/item")
+    print(f"   speedup: {results[0][1] / results[1][1]:.2f}x")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args):
+    """ mock_nuclia.py in its own process, so it doesn't compete with the tool for the GIL.  returns (process, base url) """
+    port = free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, "mock_nuclia.py"), "--port", str(port),
+                             "--latency", str(args.latency), "--rate-limit", str(args.rate_limit)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for attempt in range(100):
+        try:
+            urllib.request.urlopen(f"{base}/mock/stats", timeout=1).read()
+            return (mock, base)
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError("mock_nuclia.py did not start")
+
+
+def mock_request(base, path, body=None):
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(f"{base}{path}", data=data, method="GET" if data is None else "POST",
+                                     headers={"Content-Type": "application/json"})
+    for attempt in range(10):
+        try:
+            with urllib.request.urlopen(request) as response:
+                content = response.read()
+            return json.loads(content) if content else None
+        except urllib.error.HTTPError as e:
+            if e.code not in (429, 503) or attempt == 9:
+                raise  # the mock's injected failures are only for the tools
+            time.sleep(0.1)
+
+
+def run_child(command, env):
+    """ run a tool to completion.  returns (exit code, resource usage, seconds, the end of its stderr) """
+    tstart = time.monotonic()
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, env=env, cwd=HERE, stdout=subprocess.DEVNULL, stderr=stderr)
+        (_, status, usage) = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - tstart
+        stderr.seek(0)
+        errors = stderr.read().decode('utf-8', errors='replace')
+    return (os.waitstatus_to_exitcode(status), usage, elapsed, "\n".join(errors.splitlines()[-20:]))
+
+
+def check_tool(name, command, env):
+    """ run a tool that reports no metrics, raising if it fails """
+    (returncode, _, _, errors) = run_child(command, env)
+    if returncode:
+        raise RuntimeError(f"{name} exited with {returncode}:\n{errors}")
+
+
+def run_tool(name, command, env, metrics_filename):
+    """ run one tool to completion.  returns its items/second, p95 request latency and peak RSS """
+    (returncode, usage, elapsed, errors) = run_child(command, env)
+    if not os.path.exists(metrics_filename):
+        raise RuntimeError(f"{name} exited with {returncode} without writing {metrics_filename}:\n{errors}")
+
+    with open(metrics_filename, 'r') as filep:
+        metrics = json.load(filep)
+    p95 = [kind['quantiles']['0.95'] for kind in metrics['latency'].values() if kind['quantiles']['0.95'] is not None]
+    peak = usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    return {'tool': name,
+            'exit': returncode,
+            'items': metrics['completed'],
+            'seconds': elapsed,
+            'items_per_second': metrics['completed'] / elapsed,
+            'p95_ms': max(p95) * 1000 if p95 else None,
+            'outcomes': metrics['outcomes'],
+            'peak_rss_mb': peak,
+            }
+
+
+def compare_e2e(filename, args):
+    import configuration
+    from validator import ExportReader
+    from resource_cache import ResourceCache
+    from label_editor import OLD_LABELSET
+
+    (mock, base) = start_mock(args)
+    workdir = tempfile.mkdtemp(prefix="e2e-")
+    # the mock takes any key - so the tools don't need a keys_confg.py to run against it.
+    env = dict(os.environ, NUCLIA_ENDPOINT=f"{base}/api/v1", NUCLIA_API_KEY="benchmark")
+    kb = args.knowledgebox
+
+    def metrics_file(tool):
+        return os.path.join(workdir, f"{tool}.json")
+
+    results = []
+    try:
+        results.append(run_tool("loader", [sys.executable, "loader.py", kb, filename,
+                                           "--concurrency", str(args.concurrency), "--no-journal",
+                                           "--failures", os.path.join(workdir, "failures.jsonl"),
+                                           "--metrics-out", metrics_file("loader")],
+                                env, metrics_file("loader")))
+
+        results.append(run_tool("editor", [sys.executable, "editor.py", kb, filename, "--no-journal",
+                                           "--metrics-out", metrics_file("editor")],
+                                env, metrics_file("editor")))
+
+        # the loader skipped the private items - put them there for the remover to find.
+        (kbid, _) = configuration.get_kb_config(kb, need_key=False)
+        privates = [item['UID'] for item in ExportReader(filename, fields=('UID',))
+                    if '@id' in item and item.get('review_state') != "published"]
+        mock_request(base, f"/mock/seed?kb={kbid}", privates)
+
+        results.append(run_tool("remove_privates", [sys.executable, "remove_privates.py", kb, filename,
+                                                    "--concurrency", str(args.concurrency), "--no-journal",
+                                                    "--metrics-out", metrics_file("remove_privates")],
+                                env, metrics_file("remove_privates")))
+
+        # resources on the old labelset for label_editor.py to move - and then none should be left.
+        old = [{'slug': f"relabel-{n}", 'title': f"relabel {n}",
+                'usermetadata': {'classifications': [{'labelset': OLD_LABELSET, 'label': "Korean"}]}}
+               for n in range(max(args.items // 10, 1))]
+        mock_request(base, f"/mock/seed?kb={kbid}", old)
+        relabel = run_tool("label_editor", [sys.executable, "label_editor.py", kb,
+                                            "--concurrency", str(args.concurrency),
+                                            "--metrics-out", metrics_file("label_editor")],
+                           env, metrics_file("label_editor"))
+        results.append(relabel)
+        left = mock_request(base, f"/v1/kb/{kbid}/catalog", {'filters': [f"/l/{OLD_LABELSET}"]})
+        if relabel['exit'] or left['fulltext']['total']:
+            raise RuntimeError(f"label_editor.py exited with {relabel['exit']}, leaving "
+                               f"{left['fulltext']['total']} of {len(old)} resources on the old labelset")
+
+        # and a resource cache synced from the catalog should hold every resource in the mock.
+        cache_file = os.path.join(workdir, "resources.sqlite")
+        check_tool("resource_cache", [sys.executable, "resource_cache.py", kb, "--cache-file", cache_file], env)
+        total = mock_request(base, f"/v1/kb/{kbid}/catalog", {})['fulltext']['total']
+        with ResourceCache(kbid, cache_file) as cache:
+            if len(cache) != total:
+                raise RuntimeError(f"resource_cache.py synced {len(cache)} of the mock's {total} resources")
+        stats = mock_request(base, "/mock/stats")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    size_mb = os.path.getsize(filename) / (1024 * 1024)
+    print(f"{filename}: {size_mb:.0f} MB | mock latency {args.latency * 1000:.0f}ms, "
+          f"{args.rate_limit:.1%} rate limited | loader concurrency {args.concurrency}")
+    for result in results:
+        p95 = f"{result['p95_ms']:7.1f}ms" if result['p95_ms'] is not None else "      -  "
+        print(f"{result['tool']:>16}: {result['items']:8d} items {result['items_per_second']:10.1f} items/second "
+              f"| p95 {p95} | peak RSS {result['peak_rss_mb']:7.1f} MB | {result['outcomes']}"
+              + (f" | exit {result['exit']}" if result['exit'] else ""))
+    print(f"{'mock':>16}: {stats}")
+    print(f"metrics and failures in {workdir}")
+
+
+def synthetic_export(args):
+    """ the export to benchmark against, and whether to delete it afterwards """
+    if args.export:
+        if not os.path.exists(args.export):
+            make_export(args.export, args.items)
+        return (args.export, False)
+
+    (handle, filename) = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    make_export(filename, args.items)
+    return (filename, not args.keep)
+
+
+def import_time(module):
+    """ (microseconds to import 'module' in a fresh interpreter, the REQUEST_MODULES it imported) """
+    code = (f"import json, sys; import {module}; "
+            f"print(json.dumps([name for name in {REQUEST_MODULES!r} if name in sys.modules]))")
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                               cwd=HERE, capture_output=True, text=True)
+    if completed.returncode:
+        raise RuntimeError(f"importing {module} failed: {completed.stderr.strip().splitlines()[-1]}")
+
+    # lines of "import time: <self us> | <cumulative us> | <module>"
+    microseconds = None
+    for line in completed.stderr.splitlines():
+        columns = line.split('|')
+        if len(columns) == 3 and columns[2].strip() == module:
+            microseconds = int(columns[1])
+    return (microseconds, json.loads(completed.stdout))
+
+
+def compare_startup(repeat=5):
+    print(f"{'tool':>16}: import (best of {repeat}) | request modules imported")
+    for module in TOOLS:
+        try:
+            timings = [import_time(module) for n in range(repeat)]
+        except RuntimeError as e:
+            print(f"{module:>16}: {e}")
+            continue
+        imported = timings[0][1]
+        print(f"{module:>16}: {min(t[0] for t in timings) / 1000:8.1f} ms | {', '.join(imported) or 'none'}")
+
+
+if __name__ == "__main__":
+    args = process_args()
+    sys.path.insert(0, HERE)
+
+    if args.benchmark == 'startup':
+        compare_startup()
+        sys.exit()
+
+    if args.benchmark == 'parse-run':
+        print(json.dumps(run_parse(args.mode, args.export, args.workers)))
+        sys.exit()
+
+    if args.benchmark == 'preprocess':
+        compare_preprocess(args.items)
+        sys.exit()
+
+    (filename, remove) = synthetic_export(args)
+    try:
+        if args.benchmark == 'parse':
+            compare_parse(filename, args.workers)
+        elif args.benchmark == 'e2e':
+            compare_e2e(filename, args)
+        elif args.benchmark == 'compressed':
+            compare_compressed(filename)
+    finally:
+        if remove:
+            os.remove(filename)
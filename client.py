@@ -0,0 +1,106 @@
+"""
+One pooled, keep-alive connection to nuclia per knowledgebox, shared by every tool.
+
+The nuclia sdk builds a new client (and a new connection, with its own TLS handshake) for every
+call made with url= and api_key=.  Calls made with ndb=get_client(kb, api_key) instead all go
+through the same httpx connection pool, sized to the number of requests we keep in flight.
+"""
+import logging
+import threading
+import time
+
+import configuration
+import tracing
+
+logger = logging.getLogger("nuclia client")
+
+POOL_SIZE = 10  # connections kept open per knowledgebox - set from --concurrency via configure()
+HTTP2 = False
+TIMEOUT = 60.0 * 5  # same as the sdk's default
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure(pool_size=None, http2=None):
+    """ set the pool size and protocol for clients created after this call """
+    global POOL_SIZE, HTTP2
+    if pool_size is not None:
+        POOL_SIZE = max(pool_size, 1)
+    if http2 is not None:
+        HTTP2 = http2
+        if http2:
+            try:
+                import h2  # noqa: F401 - httpx needs it for http/2
+            except ImportError:
+                logger.warning("http/2 needs the 'h2' package (pip install httpx[http2]) - using http/1.1")
+                HTTP2 = False
+
+
+def kb_url(kb):
+    return f"{configuration.cloud_endpoint}/kb/{kb}"
+
+
+def _request_started(request):
+    request.extensions['trace_start'] = time.perf_counter()
+
+
+def _response_received(response):
+    start = response.request.extensions.get('trace_start')
+    if start is not None:
+        tracing.add_span("http", start, time.perf_counter() - start, "http",
+                         method=response.request.method,
+                         path=response.request.url.path,
+                         status=response.status_code)
+
+
+def pooled_session(session):
+    """ a replacement for one of the sdk's httpx clients, with our pool limits and keep-alive """
+    import httpx
+
+    limits = httpx.Limits(max_connections=POOL_SIZE,
+                          max_keepalive_connections=POOL_SIZE)
+    pooled = httpx.Client(headers=session.headers,
+                          base_url=session.base_url,
+                          timeout=TIMEOUT,
+                          limits=limits,
+                          http2=HTTP2)
+    if tracing.enabled():
+        # time from sending each request to its response headers: the network and the server.
+        pooled.event_hooks = {'request': [_request_started], 'response': [_response_received]}
+    session.close()
+    return pooled
+
+
+def get_client(kb, api_key):
+    """ the shared client for this knowledgebox.  pass it to sdk calls as ndb= in place of url= and api_key=. """
+    # the sdk and the http stack are imported with the first request, not at startup
+    from nuclia.lib.kb import NucliaDBClient, Environment
+
+    key = (kb, api_key)
+    with _lock:
+        if key not in _clients:
+            ndb = NucliaDBClient(environment=Environment.CLOUD,
+                                 url=kb_url(kb),
+                                 api_key=api_key,
+                                 region=configuration.REGION)
+            ndb.ndb.session = pooled_session(ndb.ndb.session)
+            if ndb.reader_session is not None:
+                ndb.reader_session = pooled_session(ndb.reader_session)
+            if ndb.writer_session is not None:
+                ndb.writer_session = pooled_session(ndb.writer_session)
+            logger.debug(f"connection pool of {POOL_SIZE} for {kb_url(kb)}")
+            _clients[key] = ndb
+
+        return _clients[key]
+
+
+def close():
+    """ close every pooled connection """
+    with _lock:
+        for ndb in _clients.values():
+            ndb.ndb.session.close()
+            for session in (ndb.reader_session, ndb.writer_session):
+                if session is not None:
+                    session.close()
+        _clients.clear()
@@ -0,0 +1,189 @@
+"""
+Reading gzip (.json.gz) and zstd (.json.zst) plone exports as if they were the json.
+
+open_export_file() opens an export for reading in binary, whatever it is compressed with (going by
+its first bytes, not its name).  A compressed one comes back as a DecompressingReader: a thread reads
+and decompresses the file a chunk at a time, a few chunks ahead of the parser, so decompressing and
+parsing overlap - zlib and zstd let go of the GIL while they work.
+
+create_export_file() is the other way round, for writing an export (see delta.py): compressed
+if its name ends in .gz or .zst.
+
+zstd needs the zstandard package (pip install zstandard); gzip is in the standard library.
+"""
+import gzip
+import io
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("export reader")
+
+CHUNK_SIZE = 1024 * 1024  # decompressed bytes per chunk handed to the parser
+CHUNKS_AHEAD = 4  # chunks decompressed ahead of the parser
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compression(filename):
+    """ 'gzip', 'zstd' or None, from the first bytes of the file """
+    with open(filename, 'rb') as filep:
+        magic = filep.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def decompressed(filep, kind):
+    """ a file object of the decompressed contents of the compressed file object filep """
+    if kind == 'gzip':
+        return gzip.GzipFile(fileobj=filep, mode='rb')
+    if kind == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logger.error("reading a zstd export needs the zstandard package: pip install zstandard")
+            raise
+        return zstandard.ZstdDecompressor().stream_reader(filep, read_across_frames=True, closefd=False)
+    raise ValueError(f"unknown compression {kind}")
+
+
+class DecompressingReader(io.RawIOBase):
+    """ the decompressed contents of a compressed file, read ahead by a thread.
+
+        tell() is how far through the decompressed contents the reader is, and compressed_position
+        how far through the compressed file the decompressed chunks handed out so far came from.
+        it only seeks forwards.
+    """
+
+    def __init__(self, filename, kind, chunk_size=CHUNK_SIZE, ahead=CHUNKS_AHEAD):
+        super().__init__()
+        self.filename = filename
+        self.kind = kind
+        self.compressed_position = 0
+        self._file = open(filename, 'rb')
+        self._chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=ahead)
+        self._chunk = b''  # the chunk being read from
+        self._offset = 0  # how much of it has been read
+        self._position = 0
+        self._eof = False
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._decompress, name=f"decompress {filename}", daemon=True)
+        self._thread.start()
+
+    def _put(self, entry):
+        """ hand an entry to the reader, unless it's closed first """
+        while not self._stopping.is_set():
+            try:
+                self._chunks.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decompress(self):
+        """ the thread: decompress the file chunk by chunk into the queue, ending with b'' or the exception """
+        try:
+            with decompressed(self._file, self.kind) as stream:
+                while True:
+                    chunk = stream.read(self._chunk_size)
+                    if not self._put((chunk, self._file.tell())) or not chunk:
+                        return
+        except Exception as e:
+            self._put((e, None))
+
+    def _next_chunk(self):
+        (chunk, compressed_position) = self._chunks.get()
+        if isinstance(chunk, Exception):
+            self._eof = True
+            raise chunk
+        self._chunk = chunk
+        self._offset = 0
+        self.compressed_position = compressed_position
+        if not chunk:
+            self._eof = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._offset >= len(self._chunk):
+            if self._eof:
+                return 0
+            self._next_chunk()
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        """ size bytes, or fewer only at the end of the file.  a whole chunk is handed out as it is,
+            so ijson's reads cost no copying.
+        """
+        if size is None or size < 0:
+            return self.readall()
+        parts = []
+        while size > 0:
+            if self._offset >= len(self._chunk):
+                if self._eof:
+                    break
+                self._next_chunk()
+                continue
+            if self._offset == 0 and size >= len(self._chunk):
+                data = self._chunk
+            else:
+                data = self._chunk[self._offset:self._offset + size]
+            self._offset += len(data)
+            self._position += len(data)
+            size -= len(data)
+            parts.append(data)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ skip forwards to offset in the decompressed contents """
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek from the start or the current position")
+        if offset < self._position:
+            raise io.UnsupportedOperation(f"can't seek backwards in a compressed export ({self.filename})")
+        while self._position < offset and self.read(offset - self._position):
+            pass
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._stopping.set()
+            self._thread.join()
+            self._file.close()
+        super().close()
+
+
+def open_export_file(filename, buffering=-1):
+    """ the export open for reading in binary - decompressed as it is read, if it's compressed """
+    kind = compression(filename)
+    if kind is None:
+        return open(filename, 'rb', buffering=buffering)
+    return DecompressingReader(filename, kind)
+
+
+def create_export_file(filename):
+    """ a new file open for writing in binary - gzip or zstd compressed if the name ends in .gz or .zst """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wb')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            logger.error("writing a zstd export needs the zstandard package: pip install zstandard")
+            raise
+        return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+    return open(filename, 'wb')
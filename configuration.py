@@ -2,12 +2,16 @@
 
 # you must create your own 'keys_config.py" and add these strings
 # but do not add 'keys_config.py' to a public repo - it's privileged information
-import keys_confg as keys_config
-from keys_confg import API_KEY, Account_UID
+import importlib
+import logging
+import os
+
+logger = logging.getLogger("configuration")
 
 
 # these configuration options are public knowledge, and can be added to source control
-cloud_endpoint = "https://europe-1.nuclia.cloud/api/v1"
+# NUCLIA_ENDPOINT points the tools somewhere else - e.g. at mock_nuclia.py for benchmarks.
+cloud_endpoint = os.environ.get("NUCLIA_ENDPOINT", "https://europe-1.nuclia.cloud/api/v1")
 REGION = "europe-1"
 
 RadioFreeAsia_KB = "1194b6c4-fc68-4dcf-b969-49b96380bfe9"
@@ -25,26 +29,66 @@ Vietnamese_KB = "7bcc1511-3fce-4747-91f5-dfee8d82913b"
 Indonesian_KB = "013ee2f8-3247-418c-9af8-2c2ec1bacfd1"
 Malay_KB = "b0407bad-2f20-482b-99c0-cb225189a827"
 
-kb_config = {"RadioFreeAsia": (RadioFreeAsia_KB, keys_config.McFadden_Owner_key),
-             "Burmese": (Burmese_KB, keys_config.Burmese_Key),
-             "Uyghur": (Uyghur_KB, keys_config.Uyghur_Key),
-             "Mandarin": (Mandarin_KB, keys_config.Mandarin_Key),
-             "Bengali": (Bengali_KB, keys_config.Bengali_Key),
-             "Cantonese": (Cantonese_KB, keys_config.Cantonese_Key),
-             "Indonesian": (Indonesian_KB, keys_config.Indonesian_Key),
-             "Khmer": (Khmer_KB, keys_config.Khmer_Key),
-             "Lao": (Lao_KB, keys_config.Lao_Key),
-             "Vietnamese": (Vietnamese_KB, keys_config.Vietnamese_Key),
-             "Malay": (Malay_KB, keys_config.Malay_Key),
-             "Korean": (Korean_KB, keys_config.Korean_Key),
-             "Tibetan": (Tibetan_KB, keys_config.Tibetan_Key),
-             "Thai": (Thai_KB, keys_config.Thai_Key),
+# each knowledgebox's id, and the name of its api key in keys_confg.  the keys are only looked up
+# (and keys_confg imported) when a tool first needs one - so validating, indexing and --fake-it runs
+# work without it.
+kb_config = {"RadioFreeAsia": (RadioFreeAsia_KB, "McFadden_Owner_key"),
+             "Burmese": (Burmese_KB, "Burmese_Key"),
+             "Uyghur": (Uyghur_KB, "Uyghur_Key"),
+             "Mandarin": (Mandarin_KB, "Mandarin_Key"),
+             "Bengali": (Bengali_KB, "Bengali_Key"),
+             "Cantonese": (Cantonese_KB, "Cantonese_Key"),
+             "Indonesian": (Indonesian_KB, "Indonesian_Key"),
+             "Khmer": (Khmer_KB, "Khmer_Key"),
+             "Lao": (Lao_KB, "Lao_Key"),
+             "Vietnamese": (Vietnamese_KB, "Vietnamese_Key"),
+             "Malay": (Malay_KB, "Malay_Key"),
+             "Korean": (Korean_KB, "Korean_Key"),
+             "Tibetan": (Tibetan_KB, "Tibetan_Key"),
+             "Thai": (Thai_KB, "Thai_Key"),
              }
 
-def get_kb_config(knowledgebox):
+
+class EnvironmentKeys:
+    """ stands in for keys_confg when NUCLIA_ENDPOINT and NUCLIA_API_KEY are set: every key is NUCLIA_API_KEY """
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return os.environ["NUCLIA_API_KEY"]
+
+
+def keys():
+    # a run pointed somewhere else (e.g. benchmark.py at mock_nuclia.py) can take its key from the environment
+    if "NUCLIA_ENDPOINT" in os.environ and "NUCLIA_API_KEY" in os.environ:
+        return EnvironmentKeys()
+    try:
+        return importlib.import_module("keys_confg")
+    except ImportError:
+        logger.error("no keys_confg.py with the api keys - see the top of configuration.py "
+                     "(or set NUCLIA_API_KEY along with NUCLIA_ENDPOINT)")
+        raise
+
+
+def __getattr__(name):
+    # configuration.API_KEY, .Account_UID and .keys_config, from keys_confg on first use
+    if name == "keys_config":
+        return keys()
+    if name in ("API_KEY", "Account_UID"):
+        return getattr(keys(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_kb_config(knowledgebox, need_key=True):
+    """ (knowledgebox id, api key) for a knowledgebox name.
+        the api key is None unless need_key - a run that sends nothing doesn't need keys_confg.
+    """
     try:
-        return kb_config[knowledgebox]
+        (kb, key_name) = kb_config[knowledgebox]
     except KeyError:
         logger.error(f"unknown Knowledgebox {knowledgebox}")
         raise ValueError
+    if not need_key:
+        return (kb, None)
+    return (kb, getattr(keys(), key_name))
 
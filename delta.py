@@ -0,0 +1,220 @@
+"""
+Works out what changed between two exports of the same site, so a nightly sync only sends that.
+
+    python delta.py yesterday.json.gz today.json.gz delta.json.gz
+
+Both exports are streamed, never held in memory: the older one into a temporary sqlite table of
+UID -> (published, modified, content hash), and the newer one is joined against it UID by UID.
+The delta is itself an export - a json array of items, gzip or zstd compressed if its name says
+so - holding only the stories that changed, each cut down to the fields the tools use, with a
+"delta" field saying what happened to it:
+
+    added        published now, and wasn't before
+    changed      published before and now, with a different modified date or content hash
+    unpublished  published before, and not now
+    removed      published before, and gone from the newer export (its review_state is "removed")
+
+So the tools take the delta in place of an export: loader.py creates the added stories and updates
+the changed ones, editor.py edits them, and remove_privates.py deletes the unpublished and removed ones.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from validator import open_export
+from story import preprocess_item, content_hash, PREPROCESS_FIELDS
+from compressed import create_export_file
+
+logger = logging.getLogger("export delta")
+
+ADDED = "added"
+CHANGED = "changed"
+UNPUBLISHED = "unpublished"
+REMOVED = "removed"
+
+DELTA_FIELD = "delta"  # what happened to the item, in a delta file
+REMOVED_STATE = "removed"  # the review_state of a removed item, so the loader skips it and the remover deletes it
+
+BATCH_SIZE = 1000  # rows written to the table per transaction
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="""write the stories added, changed, unpublished and removed between
+                                                   two exports of the same site to a delta file, which loader.py,
+                                                   editor.py and remove_privates.py read like an export""",
+                                     usage="usage: delta.py <old export> <new export> <delta file> [--parse-workers=N]")
+    parser.add_argument("old",
+                        help="filename of the earlier json export")
+
+    parser.add_argument("new",
+                        help="filename of the later json export")
+
+    parser.add_argument("delta",
+                        help="filename to write the delta to - compressed if it ends in .gz or .zst")
+
+    parser.add_argument("--parse-workers",
+                        type=int,
+                        help="processes parsing each export, a shard of the file each",
+                        default=1
+                        )
+
+    parser.add_argument("-v", "--verbose",
+                        help="turn on debug",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def published(item):
+    return item.get('review_state') == "published"
+
+
+def stories(filename, parse_workers=1):
+    """ yield every story (item with a UID) in the export, cut down to the fields the tools use """
+    for item in open_export(filename, fields=PREPROCESS_FIELDS, workers=parse_workers):
+        if '@id' in item and 'UID' in item:
+            yield item
+
+
+def fingerprint(item):
+    """ (modified, content hash) of a published item - None for the hash of an unpublished one """
+    if not published(item):
+        return (item.get('modified'), None)
+    return (item.get('modified'), content_hash(preprocess_item(item)))
+
+
+class Baseline:
+    """ the older export's stories by UID, in a temporary sqlite table """
+
+    def __init__(self, directory=None):
+        (handle, self.filename) = tempfile.mkstemp(suffix=".sqlite", prefix="delta-", dir=directory)
+        os.close(handle)
+        self._db = sqlite3.connect(self.filename, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("""CREATE TABLE stories (
+                                uid TEXT PRIMARY KEY,
+                                published INTEGER NOT NULL,
+                                modified TEXT,
+                                hash TEXT,
+                                seen INTEGER NOT NULL DEFAULT 0
+                            ) WITHOUT ROWID""")
+
+    def _write(self, statement, rows):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(statement, rows)
+
+    def load(self, items):
+        """ add the stories, a batch at a time.  returns how many there were. """
+        count = 0
+        rows = []
+        for item in items:
+            rows.append((item['UID'], published(item), *fingerprint(item)))
+            if len(rows) >= BATCH_SIZE:
+                self._write("INSERT OR REPLACE INTO stories (uid, published, modified, hash) VALUES (?, ?, ?, ?)", rows)
+                count += len(rows)
+                rows = []
+        self._write("INSERT OR REPLACE INTO stories (uid, published, modified, hash) VALUES (?, ?, ?, ?)", rows)
+        return count + len(rows)
+
+    def get(self, uid):
+        """ (published, modified, hash) for the story, or None if it wasn't in the older export """
+        return self._db.execute("SELECT published, modified, hash FROM stories WHERE uid = ?", (uid,)).fetchone()
+
+    def mark_seen(self, uids):
+        self._write("UPDATE stories SET seen = 1 WHERE uid = ?", [(uid,) for uid in uids])
+
+    def unseen_published(self, uid):
+        """ True if the story was published in the older export and hasn't been seen in the newer one """
+        row = self._db.execute("SELECT published, seen FROM stories WHERE uid = ?", (uid,)).fetchone()
+        return row is not None and row[0] and not row[1]
+
+    def removed_count(self):
+        return self._db.execute("SELECT COUNT(*) FROM stories WHERE published AND NOT seen").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+        os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def classify(item, before):
+    """ what happened to a story of the newer export, given its (published, modified, hash) in the older one.
+        None if there is nothing to sync.
+    """
+    if before is None or not before[0]:
+        return ADDED if published(item) else None
+    if not published(item):
+        return UNPUBLISHED
+    (modified, digest) = fingerprint(item)
+    if modified != before[1] or digest != before[2]:
+        return CHANGED
+    return None
+
+
+def make_delta(old, new, delta, parse_workers=1):
+    """ write the delta between exports old and new to the file delta.  returns the count of each kind. """
+    counts = {ADDED: 0, CHANGED: 0, UNPUBLISHED: 0, REMOVED: 0}
+    tstart = time.monotonic()
+
+    with Baseline(os.path.dirname(os.path.abspath(delta))) as baseline, create_export_file(delta) as filep:
+        logger.info(f"reading {old}")
+        logger.info(f"{baseline.load(stories(old, parse_workers))} stories in {old}")
+
+        def write(item, kind):
+            item[DELTA_FIELD] = kind
+            filep.write(b",\n" if sum(counts.values()) else b"[\n")
+            filep.write(json.dumps(item, ensure_ascii=False).encode('utf-8'))
+            counts[kind] += 1
+
+        logger.info(f"comparing {new}")
+        seen = []
+        for item in stories(new, parse_workers):
+            kind = classify(item, baseline.get(item['UID']))
+            if kind is not None:
+                write(item, kind)
+            seen.append(item['UID'])
+            if len(seen) >= BATCH_SIZE:
+                baseline.mark_seen(seen)
+                seen = []
+        baseline.mark_seen(seen)
+
+        # the stories that were published and are gone - the older export has what's needed to delete them.
+        if baseline.removed_count():
+            logger.info(f"collecting removed stories from {old}")
+            for item in stories(old, parse_workers):
+                if baseline.unseen_published(item['UID']):
+                    item['review_state'] = REMOVED_STATE
+                    write(item, REMOVED)
+
+        filep.write(b"\n]\n" if sum(counts.values()) else b"[]\n")
+
+    logger.info(f"delta written to {delta} in {time.monotonic() - tstart:.1f}s")
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+    args = process_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("debug on")
+
+    counts = make_delta(args.old, args.new, args.delta, args.parse_workers)
+    print(f"{args.delta}:  " + " | ".join(f"{count} {kind}" for (kind, count) in counts.items()))
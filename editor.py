@@ -1,19 +1,21 @@
 import argparse
 import logging
 import urllib
-import time
-import ijson
-from datetime import datetime, timedelta
 
-from nuclia import sdk
 import configuration
+import client
+from throttle import Throttle
 
-from validator import validate
+from validator import open_export
 
-from collections import deque
-from statistics import mean
 from pprint import pformat
-from loader import preprocess_item
+from story import preprocess_item, content_hash, PREPROCESS_FIELDS
+from journal import Journal
+from resource_cache import ResourceCache
+from indexer import find_items
+from metrics import Metrics
+import tracing
+import queued_logging
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
@@ -24,6 +26,8 @@ logger = logging.getLogger("nuclia origin editor")
 FAKE_IT = False #global override for debugging and not actually uploading.
 KB = None #set during argparse
 API_KEY = None #set during argparse
+THROTTLE = Throttle() #retry policy for requests
+METRICS = Metrics("nuclia origin editor") #progress and request latencies, replaced during argparse
 
 def process_args():
     parser = argparse.ArgumentParser(description="""Update the creation date metadata by editing existing records
@@ -49,11 +53,15 @@ def process_args():
                         )
 
     parser.add_argument("--id",
-                        help="find a item by @id from input file and edit that resource's date",
+                        help="find a item by @id from input file and edit that resource's date.  may be given more than once",
+                        action="append",
+                        default=[],
                         )
 
     parser.add_argument("--slug", "--uid",
-                        help="find a item by UID from input file and edit that resource's date"
+                        help="find a item by UID from input file and edit that resource's date.  may be given more than once",
+                        action="append",
+                        default=[],
                         )
 
     parser.add_argument("--max",
@@ -62,6 +70,57 @@ def process_args():
                         default=None
                         )
 
+    parser.add_argument("--no-journal",
+                        help="edit everything, even items the loader's journal says are unchanged",
+                        action="store_true")
+
+    parser.add_argument("--cache",
+                        help="edit resources by the resource id in the local resource cache (see resource_cache.py), "
+                             "rather than by slug",
+                        action="store_true")
+
+    parser.add_argument("--metrics-out",
+                        help="keep progress and request latency metrics in this file: "
+                             "a prometheus textfile if it ends in .prom, otherwise json",
+                        default=None
+                        )
+
+    parser.add_argument("--parse-workers",
+                        type=int,
+                        help="processes parsing the export, a shard of the file each",
+                        default=1
+                        )
+
+    parser.add_argument("--report-interval",
+                        type=float,
+                        help="seconds between progress lines (and metrics file updates)",
+                        default=10
+                        )
+
+    parser.add_argument("--trace-out",
+                        help="record where each item's time goes (pipeline stages, requests, http) "
+                             "to this file in chrome trace format - open it in chrome://tracing or ui.perfetto.dev",
+                        default=None
+                        )
+
+    parser.add_argument("--profile-every",
+                        type=int,
+                        help="cProfile one in every N edits",
+                        default=None
+                        )
+
+    parser.add_argument("--profile-out",
+                        help="where to write the profile.  default: profile.pstats",
+                        default=None
+                        )
+
+    parser.add_argument("--log-every",
+                        type=int,
+                        help="log through a background thread, and only one in every N of each per item line "
+                             "(warnings and errors always), with a count of those left out every --report-interval",
+                        default=None
+                        )
+
     parser.add_argument("--fake-it",
                         help="do everything except posting to url.",
                         action="store_true")
@@ -75,17 +134,14 @@ def process_args():
     return parsed_args
 
 
-def load_file(filename, resume_at=0, max_uploads=None):
+def load_file(filename, resume_at=0, max_uploads=None, journal=None, cache=None, parse_workers=1):
 
-    logger.debug(f"counting objects in {filename}")
-    (objects, unpublished, errors) = validate(filename)
-    total_published = objects - unpublished
-    logger.debug(f"{objects} objects | {total_published} published")
+    reader = open_export(filename, fields=PREPROCESS_FIELDS, workers=parse_workers)
+    if reader.exact is not None:
+        logger.debug(f"{reader.total_objects} objects | {reader.total_published} published")
+    else:
+        logger.debug(f"no counts for {filename} yet - progress is estimated until the whole file is read")
     count = 0
-    average_duration = 0.0001  # a guess
-
-    last_runtimes = deque()
-    window_average = 10
 
     if resume_at < 0:
         resume_at = 0
@@ -93,144 +149,103 @@ def load_file(filename, resume_at=0, max_uploads=None):
         logger.error("combining max and resume_at is not supported")
         raise ValueError
 
-    target_uploads = total_published
     if max_uploads is not None:
         logger.info(f"Maximum number of uploads set to {max_uploads}")
-        target_uploads = max_uploads
-
-    with open(filename, 'r') as filep:
-
-        # stream it from json into objects one item at a time
-        objects = ijson.items(filep, 'item')
-        logger.debug("Starting Edits")
-        tstart = time.monotonic()
-        for item in objects:
-
-            logger.debug(f"processing object at {count}")
-            if "unexported_paths" in item and "@id" not in item:
-                # it's the error report at the end of the export - ignore it.
-                continue
-
-            # Skip unpublished content.
-            if item.get('review_state') != "published":
-                logger.info(f"skipping: review state '{item.get('review_state')}' for {item['@id']} ")
-                continue
-
-            # Skip objects until 'resume at' is met:
-            if count < resume_at:
-                logger.info(f"{item['title']} |  skipping up to {count}/{resume_at}")
-                count += 1
-                continue
-
-            if max_uploads is not None and count >= max_uploads:
-                logger.info("maximum uploads reached.  Exiting.")
-                break
-
-            item = preprocess_item(item)
-            slug = item['UID']
-            new_data = {
-                'origin': {
-                    "url": item['@id'],
-                    "tags": item['subjects'],
-                    "created": item['effective'],
-                    "modified": item['modified'],
-                },
-                "extra": {
-                    "metadata": {"thumbnail": item['thumbnail']}
-                }
-            }
-            try:
-                edit_one(slug=slug, data=new_data)
-            except Exception as e:
-                logger.error(e, exc_info=True)
 
+    def target():
+        if max_uploads is not None:
+            return max_uploads
+        # provisional until the reader has seen the whole file.
+        return max(reader.total_published - resume_at, 1)
+
+    METRICS.target = target
+
+    logger.debug("Starting Edits")
+    for item in reader:
+
+        logger.debug("processing object at %s", count)
+        if "unexported_paths" in item and "@id" not in item:
+            # it's the error report at the end of the export - ignore it.
+            continue
+
+        # Skip unpublished content.
+        if item.get('review_state') != "published":
+            logger.info("skipping: review state '%s' for %s ", item.get('review_state'), item['@id'])
+            continue
+
+        # Skip objects until 'resume at' is met:
+        if count < resume_at:
+            logger.info("%s |  skipping up to %s/%s", item['title'], count, resume_at)
             count += 1
-            logger.info(f"{count} of {target_uploads} | {count/target_uploads:.1%} complete")
+            continue
 
-            #print running average rate:
-            if len(last_runtimes) > window_average:
-                last_runtimes.popleft()
-                rate = mean(last_runtimes)
-            else:
-                rate = 9999.9
+        if max_uploads is not None and count >= max_uploads:
+            logger.info("maximum uploads reached.  Exiting.")
+            break
 
+        record = preprocess_item(item)
+        slug = record.uid
 
-            # figure out the estimated time to completion.
-            remaining_seconds = (target_uploads - count) * average_duration
-            delta = timedelta(seconds=int(remaining_seconds))
-            (h, m, s) = f"{delta}".split(':')
-            logger.info(f"rate: {rate:.4f} items/second ETA: {h}h {m}m {s}s |" +
-                        f"{(datetime.now()+timedelta(seconds=remaining_seconds)).strftime('%Y-%m-%d %X')}")
+        # the journal knows what the loader last sent - nothing to fix if it hasn't changed.
+        if journal is not None and journal.unchanged(slug, content_hash(record)):
+            logger.debug("skipping: %s unchanged since it was loaded", slug)
+            continue
+        if cache is not None:
+            record.rid = cache.rid(slug)
 
-            tend = time.monotonic()
-            duration = tend-tstart
-            last_runtimes.append(1/duration)
+        try:
+            edit_one(record)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            METRICS.complete(e.__class__.__name__)
+        else:
+            METRICS.complete("edited")
 
-            average_duration = average_duration + ((duration-average_duration)/(count-resume_at))
+        count += 1
 
-            # leave this as the last line of the loop - always
-            tstart = tend  # next loop iteration start time is this loop iteration end time.
+    METRICS.close()
 
 
-def edit_id(item_id=None, item_uid=None, filename=None):
-    """ given a specific ID or UID from the plone export file,
-        find that ID in the json export and only edit that single date.
+def edit_ids(item_ids=(), item_uids=(), filename=None, cache=None):
+    """ given specific IDs or UIDs from the plone export file,
+        find them in the json export and only edit those dates.
+        the export's index (see indexer.py) takes us straight to each item.
     """
     if filename is None:
         raise FileNotFoundError("provide a filename.")
 
-    logger.debug(f"searching for item[@id]={item_id} or item[UID]={item_uid}")
-    with open(filename, 'r') as filep:
-
-        # stream it from json into objects one item at a time
-        objects = ijson.items(filep, 'item')
-        found = False
-        for item in objects:
-            if item.get('@id') == item_id or item.get('UID') == item_uid:
-                found = True
-                logger.debug(f"found slug {item['UID']}:  {item['title']}")
-                item = preprocess_item(item)
-                slug = item['UID']
-                new_data = {
-                    'origin': {
-                        "url": item['@id'],
-                        "tags": item['subjects'],
-                        "created": item['effective'],
-                        "modified": item['modified'],
-                    },
-                    "extra": {
-                        "metadata": {"thumbnail": item['thumbnail']}
-                    }
-                }
-
-                try:
-                    edit_one(slug, new_data)
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-
-                break
-
-        if not found:
-            logger.warning(f"id {item_id} / uid {item_uid} not found in {filename}")
-
-
-def edit_one(slug, data):
-    """edit the resource by 'slug', replacing with new data 'data'
-       data must be a key-value pair of arguments & data that can be provided to 'update_resource'
+    logger.debug(f"searching for item[@id] in {item_ids} or item[UID] in {item_uids}")
+    for item in find_items(filename, ids=item_ids, uids=item_uids):
+        logger.debug(f"found slug {item['UID']}:  {item['title']}")
+        record = preprocess_item(item)
+        if cache is not None:
+            record.rid = cache.rid(record.uid)
+
+        try:
+            edit_one(record)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+
+def edit_one(record):
+    """edit the resource for a StoryRecord, replacing its origin and thumbnail
+       with the record's origin-only patch (StoryRecord.origin_payload)
        https://docs.nuclia.dev/docs/docs/nucliadb/python_nucliadb_sdk#update_resource """
 
-    uri = f"{configuration.cloud_endpoint}/kb/{KB}"
-    logger.info(f"editing resource {slug}")
-    res = sdk.NucliaResource()
-    logger.debug(f"""
-                     slug = {slug}
+    logger.debug("editing resource %s", record.uid)
+    with tracing.span("serialise"):
+        data = record.origin_payload()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"""
                      data = {pformat(data)}
                   """)
     if not FAKE_IT:
-        res.update(url=uri,
-                   api_key=API_KEY,
-                   slug=slug,
-                   **data)
+        from nuclia import sdk  # not until the first request - a faked run never needs it
+
+        with METRICS.timer("update"), tracing.profiled():
+            THROTTLE.call(sdk.NucliaResource().update,
+                          ndb=client.get_client(KB, API_KEY),
+                          **data)
     else:
         logger.warning("Faked request - upload did not occur")
 
@@ -241,14 +256,35 @@ if __name__ == "__main__":
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("debug on")
+    if args.log_every:
+        queued_logging.start(args.log_every, args.report_interval)
 
     if args.fake_it:
         FAKE_IT = True  #global
 
     logger.debug(f"using {args.knowledgebox} knowledgebox")
-    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox)
-
-    if args.id or args.slug is not None:
-        edit_id(item_id=args.id, item_uid=args.slug, filename=args.filename)
+    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox, need_key=not FAKE_IT)
+    tracing.enable(args.trace_out, args.profile_every, args.profile_out)
+    METRICS = Metrics("nuclia origin editor",
+                      interval=args.report_interval,
+                      export=args.metrics_out,
+                      labels={'knowledgebox': args.knowledgebox})
+
+    cache = None
+    if args.cache:
+        cache = ResourceCache(KB)
+
+    if args.id or args.slug:
+        edit_ids(item_ids=args.id, item_uids=args.slug, filename=args.filename, cache=cache)
+    elif args.no_journal:
+        load_file(args.filename, args.resume_at, args.max, cache=cache, parse_workers=args.parse_workers)
     else:
-        load_file(args.filename, args.resume_at, args.max)
+        with Journal(args.knowledgebox) as journal:
+            load_file(args.filename, args.resume_at, args.max, journal, cache, args.parse_workers)
+
+    if cache is not None:
+        cache.close()
+
+    client.close()
+    tracing.close()
+    queued_logging.stop()
@@ -0,0 +1,322 @@
+"""
+Builds a byte-offset index of a plone export, so single items can be read without parsing the whole file.
+
+The index maps each item's "@id" and "UID" to the (offset, length) of its json object in the export,
+and is stored next to the export as <filename>.index.json.  Finding an item is then a dictionary lookup,
+a seek, and parsing that one object.  It also lists the UIDs of the unpublished items, for remove_privates.py.
+
+plan_shards() splits an export into byte ranges that start at items, for parsing in parallel
+(see validator.ShardedReader).
+
+A compressed export (see compressed.py) is indexed by offsets into its decompressed json.  Finding
+items in it means decompressing up to the last of them, but not parsing anything else.
+"""
+import argparse
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+
+from compressed import compression, open_export_file
+
+logger = logging.getLogger("export indexer")
+
+# a whole json string (escapes included) or a bracket - everything else can be skipped over.
+_token_pattern = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+# as _token_pattern, but a string may run off the end of the buffer - when scanning a chunk at a time.
+_partial_token_pattern = re.compile(rb'"(?:[^"\\]|\\.)*"?|[\[\]{}]', re.DOTALL)
+# an object following a comma - the start of the next element of some array, perhaps the top level one.
+_element_pattern = re.compile(rb',\s*(\{)')
+# what can follow an element of an array: the next one, or the end of the array.
+_separator_pattern = re.compile(r'\s*([,\]])\s*')
+
+SIBLINGS_WINDOW = 256 * 1024  # bytes read past a candidate item, to check it isn't in an array nested in an item
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Index a plone export by @id and UID, "
+                                                 "so loader.py --id and editor.py --id/--slug can seek to an item.",
+                                     usage="usage: indexer.py <filename>")
+    parser.add_argument("filename",
+                        help="filename of json export")
+
+    parser.add_argument("-v", "--verbose",
+                        help="turn on debug",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def index_filename(filename):
+    return f"{filename}.index.json"
+
+
+def scan_items(buf, start=0, end=None, depth=0):
+    """ yield the (offset, length) of each element of the top level json array in buf.
+
+        buf is bytes or an mmap.  start and depth allow scanning from part way through the file,
+        from a position known to be between elements (depth 1) - see shard planning.
+    """
+    item_start = None
+    for match in _token_pattern.finditer(buf, start, len(buf) if end is None else end):
+        token = match.group()
+        if token[0] == 0x22:  # '"' - strings can't change the nesting.
+            continue
+        if token in (b'{', b'['):
+            if depth == 1:
+                item_start = match.start()
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1 and item_start is not None:
+                yield (item_start, match.end() - item_start)
+                item_start = None
+
+
+def scan_stream(filep, chunk_size=1024 * 1024):
+    """ as scan_items, for a file that can only be read from start to end (a compressed export):
+        yield the (offset, json bytes) of each element of the top level json array.
+    """
+    depth = 0
+    item_start = None  # offset in the file of the element being scanned
+    base = 0  # offset in the file of buf[0]
+    buf = b''
+    scanned = 0  # how much of buf has been scanned
+    while True:
+        chunk = filep.read(chunk_size)
+        buf += chunk
+        (start, scanned) = (scanned, len(buf))
+        for match in _partial_token_pattern.finditer(buf, start):
+            token = match.group()
+            if token[0] == 0x22:  # '"'
+                if chunk and match.end() >= len(buf) - 1:
+                    scanned = match.start()  # the string may go on in the next chunk - scan it again then.
+                    break
+                continue
+            if token in (b'{', b'['):
+                if depth == 1:
+                    item_start = base + match.start()
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1 and item_start is not None:
+                    yield (item_start, buf[item_start - base:match.end()])
+                    item_start = None
+        if not chunk:
+            return
+
+        # keep what is left to scan, and the element being scanned.
+        keep = scanned if item_start is None else min(item_start - base, scanned)
+        buf = buf[keep:]
+        base += keep
+        scanned -= keep
+
+
+def exported_items(filename):
+    """ yield the (offset, json bytes) of each item in the export """
+    if compression(filename) is not None:
+        with open_export_file(filename) as filep:
+            yield from scan_stream(filep)
+        return
+
+    with open(filename, 'rb') as filep:
+        if os.fstat(filep.fileno()).st_size:
+            with mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for (offset, length) in scan_items(buf):
+                    yield (offset, buf[offset:offset + length])
+
+
+def build_index(filename):
+    """ one pass over the export, recording where every item is.  saves and returns the index. """
+    ids = {}
+    uids = {}
+    unpublished = []
+    for (offset, data) in exported_items(filename):
+        item = json.loads(data)
+        length = len(data)
+        if '@id' in item:
+            ids[item['@id']] = (offset, length)
+        if 'UID' in item:
+            uids[item['UID']] = (offset, length)
+            if '@id' in item and item.get('review_state') != "published":
+                unpublished.append(item['UID'])
+
+    stat = os.stat(filename)
+    index = {'size': stat.st_size,
+             'mtime': stat.st_mtime_ns,
+             'ids': ids,
+             'uids': uids,
+             'unpublished': unpublished,
+             }
+    try:
+        with open(index_filename(filename), 'w') as filep:
+            json.dump(index, filep)
+    except OSError as e:
+        logger.warning(f"could not save the index for {filename}: {e}")
+
+    return index
+
+
+def read_index(filename):
+    """ the saved index for this export, or None if there isn't one or the export has changed since """
+    try:
+        with open(index_filename(filename), 'r') as filep:
+            index = json.load(filep)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(filename)
+    if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime_ns:
+        return None
+    if 'unpublished' not in index:
+        return None  # written before unpublished items were listed
+
+    return index
+
+
+def get_index(filename):
+    index = read_index(filename)
+    if index is None:
+        logger.info(f"indexing {filename}")
+        index = build_index(filename)
+    return index
+
+
+def ran_off_the_end(text, error):
+    """ True if decoding text failed because the text stops part way through a json value,
+        rather than because it isn't json
+    """
+    if error.msg.startswith("Unterminated string"):
+        return True  # error.pos is where the string started, not where the text ran out
+    # nothing but whitespace left, or the start of a number, literal or escape cut short.
+    return not text[error.pos:].strip() or len(text) - error.pos < 8
+
+
+def object_at(buf, offset, window=64 * 1024):
+    """ the json value starting at offset, or None if there isn't a whole one there.
+        reads as much of buf as it takes, a window at a time.
+    """
+    decoder = json.JSONDecoder()
+    while True:
+        text = buf[offset:offset + window].decode('utf-8', 'replace')
+        try:
+            return decoder.raw_decode(text)[0]
+        except json.JSONDecodeError as e:
+            if offset + window >= len(buf) or not ran_off_the_end(text, e):
+                return None  # not json - it started inside a string, say
+            window *= 2  # it ran off the end of the window
+
+
+def in_top_level_array(buf, offset, window=SIBLINGS_WINDOW):
+    """ False if the array element at offset is in an array nested in an item, not the export's own:
+        reading on through the elements after it, their array closes before the end of the file.
+        True if it is still open 'window' bytes on - an item's own arrays are much shorter than that.
+    """
+    decoder = json.JSONDecoder()
+    text = buf[offset:offset + window].decode('utf-8', 'replace')
+    position = 0
+    while True:
+        try:
+            (_, position) = decoder.raw_decode(text, position)
+        except json.JSONDecodeError as e:
+            return ran_off_the_end(text, e)
+        separator = _separator_pattern.match(text, position)
+        if separator is None:
+            return False  # not an array element at all
+        if separator.group(1) == ']':
+            return not text[separator.end():].strip()
+        position = separator.end()
+
+
+def next_item(buf, start):
+    """ the offset of the first object from 'start' on that looks like an item of the export:
+        it follows a comma, is a whole json object with an @id and a UID, and is an element of the
+        top level array (see in_top_level_array).  None if there are none.
+    """
+    for match in _element_pattern.finditer(buf, start):
+        item = object_at(buf, match.start(1))
+        if isinstance(item, dict) and '@id' in item and 'UID' in item and in_top_level_array(buf, match.start(1)):
+            return match.start(1)
+    return None
+
+
+def plan_shards(filename, shards):
+    """ split the export into at most 'shards' (start, end) byte ranges of about the same size,
+        each but the first starting at an item.
+
+        with a saved index the items' offsets are known.  otherwise each boundary is the first thing
+        that looks like an item after an evenly spaced offset (see next_item).  if that is wrong after
+        all - an object nested in an item - the shard ending at it doesn't parse on its own, so the
+        reader parses it together with the next one instead.
+    """
+    size = os.path.getsize(filename)
+    if shards <= 1 or not size:
+        return [(0, size)]
+
+    targets = [size * n // shards for n in range(1, shards)]
+    boundaries = [0]
+    index = read_index(filename)
+    if index is not None:
+        starts = sorted(offset for (offset, length) in index['uids'].values())
+        for target in targets:
+            n = bisect.bisect_left(starts, max(target, boundaries[-1] + 1))
+            if n < len(starts):
+                boundaries.append(starts[n])
+    else:
+        with open(filename, 'rb') as filep:
+            with mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for target in targets:
+                    boundary = next_item(buf, max(target, boundaries[-1] + 1))
+                    if boundary is not None:
+                        boundaries.append(boundary)
+
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def read_item(filep, offset, length):
+    filep.seek(offset)
+    return json.loads(filep.read(length))
+
+
+def find_items(filename, ids=(), uids=()):
+    """ yield the items in the export with any of the given @ids or UIDs, in file order.
+        anything not in the export is logged and skipped.
+    """
+    index = get_index(filename)
+
+    locations = set()
+    for item_id in ids:
+        if item_id in index['ids']:
+            locations.add(tuple(index['ids'][item_id]))
+        else:
+            logger.warning(f"id {item_id} not found in {filename}")
+    for uid in uids:
+        if uid in index['uids']:
+            locations.add(tuple(index['uids'][uid]))
+        else:
+            logger.warning(f"uid {uid} not found in {filename}")
+
+    # in file order, so a compressed export only has to be read forwards.
+    with open_export_file(filename) as filep:
+        for (offset, length) in sorted(locations):
+            yield read_item(filep, offset, length)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+    args = process_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("debug on")
+
+    index = build_index(args.filename)
+    print(f"{args.filename}:  {len(index['uids'])} items indexed in {index_filename(args.filename)}")
@@ -0,0 +1,113 @@
+"""
+An append-only record, per knowledgebox, of what happened to each item we sent to nuclia.
+
+Every upload outcome (created, updated, conflict, or failed with the exception's class name)
+is appended to a small sqlite file under journal/, along with a hash of the content that was sent.
+When the same knowledgebox is loaded again, items whose latest outcome shows they are already
+in nuclia with the same content are skipped by UID, changed ones are updated, and failures
+are retried - no matter what order the uploads finished in.
+
+It also remembers the nuclia resource id (rid) each UID was created as, so later tools
+(remove_privates.py) can address resources by rid without looking their slugs up first.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+
+CREATED = "created"
+UPDATED = "updated"
+CONFLICT = "conflict"
+FAILED = "failed"
+DELETED = "deleted"
+
+# outcomes that mean the resource exists in the knowledgebox
+COMMITTED = (CREATED, UPDATED, CONFLICT)
+
+
+def journal_filename(knowledgebox):
+    return os.path.join(JOURNAL_DIR, f"{knowledgebox}.sqlite")
+
+
+class Journal:
+
+    def __init__(self, knowledgebox, filename=None):
+        self.filename = filename or journal_filename(knowledgebox)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS outcomes (
+                                uid TEXT NOT NULL,
+                                id TEXT,
+                                outcome TEXT NOT NULL,
+                                exception TEXT,
+                                recorded REAL NOT NULL,
+                                hash TEXT
+                            )""")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(outcomes)")]
+        if 'hash' not in columns:
+            # journal written before content hashes were recorded.
+            self._db.execute("ALTER TABLE outcomes ADD COLUMN hash TEXT")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS rids (
+                                uid TEXT PRIMARY KEY,
+                                rid TEXT NOT NULL
+                            )""")
+
+        # the latest outcome and content hash for every UID, so lookups don't touch the database.
+        self.latest = {}
+        self.hashes = {}
+        for (uid, outcome, digest) in self._db.execute("SELECT uid, outcome, hash FROM outcomes ORDER BY rowid"):
+            self.latest[uid] = outcome
+            if outcome != FAILED:
+                self.hashes[uid] = digest
+        self.rids = dict(self._db.execute("SELECT uid, rid FROM rids"))
+
+    def committed(self, uid):
+        """ True if the resource for this UID is known to exist in the knowledgebox """
+        return self.latest.get(uid) in COMMITTED
+
+    def unchanged(self, uid, digest):
+        """ True if the resource for this UID exists and was last sent with this content hash """
+        return self.committed(uid) and self.hashes.get(uid) == digest
+
+    def committed_uids(self):
+        """ every UID whose resource is known to exist in the knowledgebox """
+        return [uid for (uid, outcome) in self.latest.items() if outcome in COMMITTED]
+
+    def rid(self, uid):
+        """ the nuclia resource id for this UID, if we know it """
+        return self.rids.get(uid)
+
+    def record(self, uid, item_id, outcome, exception=None, digest=None, rid=None):
+        """ append an outcome for this UID.
+            digest is the content hash of what is now in the knowledgebox, if known,
+            and rid the resource id it was created as.
+        """
+        with self._lock:
+            self._db.execute("INSERT INTO outcomes (uid, id, outcome, exception, recorded, hash) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (uid, item_id, outcome, exception, time.time(), digest))
+            self.latest[uid] = outcome
+            if outcome != FAILED:
+                self.hashes[uid] = digest
+            if outcome == DELETED:
+                self._db.execute("DELETE FROM rids WHERE uid = ?", (uid,))
+                self.rids.pop(uid, None)
+            elif rid is not None:
+                self._db.execute("INSERT OR REPLACE INTO rids (uid, rid) VALUES (?, ?)", (uid, rid))
+                self.rids[uid] = rid
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,20 +1,48 @@
+"""
+Moves resources from the old 'language-service' labelset to 'Language Service'.
+
+Relabelling everything pages through the catalog of resources still carrying the old labelset,
+relabelling them concurrently (--concurrency) as the pages arrive.  Relabelled resources drop out of
+the catalog as nuclia indexes the change, which shifts the later pages - so once the last page is
+reached and relabelled it starts again from the first, until a pass turns up nothing it hasn't already
+seen.  Resources that couldn't be relabelled are tried again by the next pass, for up to --passes
+passes, and at the end the catalog is checked once more: it's only done if it is empty.
+
+Each relabel is one request: the usermetadata comes with the catalog page, and only the
+usermetadata is patched.
+"""
 import argparse
 import logging
-import requests
-
-from nuclia import sdk
-from nucliadb_models.search import SearchRequest
-from configuration import API_KEY
-from configuration import KB
-from configuration import cloud_endpoint
+import sys
+import threading
 
-URI = f"{cloud_endpoint}/kb/{KB}"
+import configuration
+import client
+from throttle import Throttle
+from pipeline import Pipeline, POLL_INTERVAL
+import tracing
+import queued_logging
+from metrics import Metrics
+from resource_cache import ResourceCache
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
                     datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger("nuclia label editor")
 
+#Globals
+FAKE_IT = False #global override for debugging and not actually editing.
+KB = None #set during argparse
+API_KEY = None #set during argparse
+CACHE = None #the local resource cache, if --cache, set during argparse
+THROTTLE = Throttle() #rate limit and retry policy for requests, replaced during argparse
+METRICS = Metrics("nuclia label editor") #progress and request latencies, replaced during argparse
+
+OLD_LABELSET = "language-service"
+NEW_LABELSET = "Language Service"
+PAGE_SIZE = 100
+MAX_PASSES = 5  # passes over the catalog, retrying the resources that failed, before giving up
+
 #all vietnamese up to (not including)
 # https://viedevview.rfaweb.org/vietnamese/HumanRights/Vietnam_government_tight_control_over_media_p2_TMi-20070131.html
 # need to have the labelset re-written.
@@ -24,7 +52,13 @@ def process_args():
     parser = argparse.ArgumentParser(description="""update all labels from labelset 'language-service' to 'Language Service'
      or set an individual resource by slug or resource id to the new label
      additionally delete the old 'label-service' label if it exists on the resource""",
-                                     usage=f"usage: {__name__}.py --slug slug --rid resource_id")
+                                     usage=f"usage: {__name__}.py <knowledgebox> --slug slug --rid resource_id "
+                                           "--concurrency=N --page-size=N --rate=N --cache")
+
+    parser.add_argument("knowledgebox",
+                        help="language name for knowledgebox."
+                             f"supported: {configuration.kb_config.keys()}",
+                        )
 
     parser.add_argument("--slug",
                         help="slug of resource to change label on",
@@ -34,64 +68,247 @@ def process_args():
                         help="resource id of resource to change label on",
                         )
 
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="number of resources to relabel at once",
+                        default=1
+                        )
+
+    parser.add_argument("--page-size",
+                        type=int,
+                        help="resources per catalog page",
+                        default=PAGE_SIZE
+                        )
+
+    parser.add_argument("--passes",
+                        type=int,
+                        help="most passes over the catalog - each retries the resources that failed before",
+                        default=MAX_PASSES
+                        )
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second to send to nuclia",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--cache",
+                        help="look the --slug up in the local resource cache (see resource_cache.py) "
+                             "and address it by resource id",
+                        action="store_true")
+
+    parser.add_argument("--metrics-out",
+                        help="keep progress and request latency metrics in this file: "
+                             "a prometheus textfile if it ends in .prom, otherwise json",
+                        default=None
+                        )
+
+    parser.add_argument("--report-interval",
+                        type=float,
+                        help="seconds between progress lines (and metrics file updates)",
+                        default=10
+                        )
+
+    parser.add_argument("--trace-out",
+                        help="record how long each request takes to this file in chrome trace format",
+                        default=None
+                        )
+
+    parser.add_argument("--log-every",
+                        type=int,
+                        help="log through a background thread, and only one in every N of each per item line "
+                             "(warnings and errors always), with a count of those left out every --report-interval",
+                        default=None
+                        )
+
     parser.add_argument("-v", "--verbose",
                         help="turn on debug",
                         action="store_true")
 
+    parser.add_argument("--fake-it",
+                        help="do everything except editing something.",
+                        action="store_true")
+
     parsed_args = parser.parse_args()
 
     return parsed_args
 
 
-def find_labels_with_sdk():
+def catalog_page(page_number, page_size=PAGE_SIZE):
+    """ one page of the resources still labelled with the old labelset """
+    from nuclia import sdk
+    from nucliadb_models.search import CatalogRequest, ResourceProperties
+
     kb = sdk.NucliaKB()
-    filter = "/l/language-service"
-    searchReq = SearchRequest(filters=[filter])
-    results = kb.search.search(url=URI, api_key=API_KEY, query=searchReq)
+    request = CatalogRequest(filters=[f"/l/{OLD_LABELSET}"],
+                             page_number=page_number,
+                             page_size=page_size,
+                             show=[ResourceProperties.BASIC])
+    with METRICS.timer("catalog"):
+        return THROTTLE.call(kb.search.catalog, ndb=client.get_client(KB, API_KEY), query=request)
+
+
+def resources_to_relabel(page_size=PAGE_SIZE, failed=None, settle=None, max_passes=MAX_PASSES):
+    """ yield every resource with the old labelset, paging through the catalog until a whole pass
+        finds nothing new, or after max_passes passes.
+        the caller adds the rid of each resource it fails to relabel to 'failed', and settle(n) waits
+        for the results of the last n resources yielded: each pass waits for its results, and the
+        next one yields the resources that failed again.
+    """
+    seen = set()
+    failed = set() if failed is None else failed
+    passes = 0
+    while True:
+        passes += 1
+        found = 0
+        retried = 0
+        page_number = 0
+        while True:
+            results = catalog_page(page_number, page_size)
+            for (rid, resource) in results.resources.items():
+                if rid in failed:
+                    failed.discard(rid)
+                    retried += 1
+                    yield resource
+                elif rid not in seen:
+                    seen.add(rid)
+                    found += 1
+                    yield resource
+            if results.fulltext is None or not results.fulltext.next_page:
+                break
+            page_number += 1
+
+        if settle is not None:
+            settle(found + retried)
+        logger.info(f"pass {passes}: {found} resources to relabel, {retried} to retry, on {page_number + 1} pages")
+        if not found and not retried:
+            return
+        if passes >= max_passes:
+            logger.warning(f"giving up after {passes} passes over the catalog")
+            return
+
+
+def relabelled(usermetadata):
+    """ the usermetadata moved to the new labelset, or None if there is nothing to change """
+    if usermetadata is None:
+        return None
+    changed = False
+    classifications = []
+    for classification in usermetadata.classifications:
+        if classification.labelset == OLD_LABELSET:
+            changed = True
+            already = any(c.labelset == NEW_LABELSET and c.label == classification.label
+                          for c in usermetadata.classifications)
+            if already:
+                continue  # the new label is there too - just drop the old one
+            classification.labelset = NEW_LABELSET
+        classifications.append(classification)
+    if not changed:
+        return None
+    usermetadata.classifications = classifications
+    return usermetadata
 
-    return [x for x in results.resources.values()]
 
+def edit_all_labels(concurrency=1, page_size=PAGE_SIZE, max_passes=MAX_PASSES):
+    """ relabel every resource on the old labelset.  True if none are left on it afterwards. """
+    METRICS.target = None
+    failed = set()  # rids of resources that couldn't be relabelled, for the next pass to retry
+    finished = threading.Semaphore(0)  # released as each result comes in
 
-def edit_all_labels():
-    resources_to_edit = find_labels_with_sdk()
-    logger.info(f"found {len(resources_to_edit)} items to edit")
-    for res in resources_to_edit:
-        logger.info(f"editing resource {res.id}")
-        edit_label(rid=res.id)
+    def settle(count):
+        for n in range(count):
+            # a result that never comes - finish() raised, or a stage did - would wait forever.
+            while not finished.acquire(timeout=POLL_INTERVAL):
+                if pipeline.failed:
+                    raise RuntimeError("gave up waiting for results: the pipeline failed")
 
+    def relabel(resource):
+        try:
+            edit_label(rid=resource.id, resource=resource)
+        except Exception as e:
+            return (resource, e)
+        return (resource, None)
 
-def edit_label(rid: str = None, slug: str = None):
+    def finish(result):
+        (resource, error) = result
+        if error is not None:
+            logger.error(f"could not relabel {resource.id}: {error}", exc_info=error)
+            failed.add(resource.id)
+            METRICS.complete(error.__class__.__name__)
+        else:
+            METRICS.complete("relabelled")
+        finished.release()
+
+    concurrency = max(concurrency, 1)
+    pipeline = Pipeline(resources_to_relabel(page_size, failed, settle, max_passes),
+                        depth=max(2 * concurrency, page_size), name="catalog")
+    pipeline.add_stage("relabel", relabel, workers=concurrency, limit=lambda: THROTTLE.limit)
+    pipeline.run(finish, name="results")
+    METRICS.close()
+
+    if FAKE_IT:
+        return True
+    # relabelled resources drop out of the catalog - so it's done when there are none left in it.
+    left = catalog_page(0, page_size)
+    if left.resources:
+        more = " (and more)" if left.fulltext is not None and left.fulltext.next_page else ""
+        logger.error(f"{len(left.resources)} resources{more} still have the '{OLD_LABELSET}' labelset: "
+                     f"{', '.join(list(left.resources)[:10])}")
+        return False
+    logger.info(f"no resources left with the '{OLD_LABELSET}' labelset")
+    return True
+
+
+def edit_label(rid: str = None, slug: str = None, resource=None):
 
     """
     :param rid: the resource id of the resource
     :param slug: the slug of the resource
-    :param label: the "Language Service" label.
+    :param resource: the resource, with its usermetadata, if we already have it (from the catalog)
     :return:
     """
 
+    if rid is None and slug is not None and CACHE is not None:
+        rid = CACHE.rid(slug)
+
+    from nuclia import sdk
+
     #get the old usermedata:
-    if rid is not None:
-        res = sdk.NucliaResource().get(url=URI,
-                                       api_key=API_KEY,
-                                       rid=rid,)
-    elif slug is not None:
-        res = sdk.NucliaResource().get(url=URI,
-                                       api_key=API_KEY,
-                                       slug=slug,)
-    else:
-        raise ValueError("Must provide either rid or slug")
+    if resource is None or resource.usermetadata is None:
+        if rid is not None:
+            with METRICS.timer("get"):
+                resource = THROTTLE.call(sdk.NucliaResource().get,
+                                         ndb=client.get_client(KB, API_KEY),
+                                         rid=rid,)
+        elif slug is not None:
+            with METRICS.timer("get"):
+                resource = THROTTLE.call(sdk.NucliaResource().get,
+                                         ndb=client.get_client(KB, API_KEY),
+                                         slug=slug,)
+        else:
+            raise ValueError("Must provide either rid or slug")
 
-    rid = res.id
-    metadata = res.usermetadata
-    for classification in metadata.classifications:
-        if classification.labelset == "language-service":
-            classification.labelset = "Language Service"
+    rid = resource.id
+    usermetadata = relabelled(resource.usermetadata)
+    if usermetadata is None:
+        logger.debug("%s has no '%s' labels", rid, OLD_LABELSET)
+        return
 
-    logger.info(f"fixing f{rid}")
-    sdk.NucliaResource().update(url=URI,
-                                api_key=API_KEY,
-                                rid=rid,
-                                usermetadata=res.usermetadata)
+    logger.debug("fixing %s", rid)
+    if not FAKE_IT:
+        with METRICS.timer("update"):
+            THROTTLE.call(sdk.NucliaResource().update,
+                          ndb=client.get_client(KB, API_KEY),
+                          rid=rid,
+                          usermetadata=usermetadata)
+    else:
+        logger.warning("Faked request - edit did not occur")
 
 
 if __name__ == "__main__":
@@ -100,10 +317,37 @@ if __name__ == "__main__":
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("debug on")
+    if args.log_every:
+        queued_logging.start(args.log_every, args.report_interval)
+
+    if args.fake_it:
+        FAKE_IT = True  #global
 
+    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox)
+    tracing.enable(args.trace_out)
+    METRICS = Metrics("nuclia label editor",
+                      interval=args.report_interval,
+                      export=args.metrics_out,
+                      labels={'knowledgebox': args.knowledgebox})
+    client.configure(pool_size=args.concurrency)
+    THROTTLE = Throttle(max_concurrency=args.concurrency,
+                        rate=args.rate,
+                        max_attempts=args.retries)
+    if args.cache:
+        CACHE = ResourceCache(KB)
+
+    done = True
     if args.slug:
         edit_label(slug=args.slug)
     elif args.rid:
         edit_label(rid=args.rid)
     else:
-        edit_all_labels()
+        done = edit_all_labels(args.concurrency, args.page_size, args.passes)
+
+    if CACHE is not None:
+        CACHE.close()
+    client.close()
+    tracing.close()
+    queued_logging.stop()
+    if not done:
+        sys.exit(1)
@@ -1,20 +1,26 @@
 import sys, traceback
 import argparse
-import re
 import logging
-import urllib
+import os
 import time
-import ijson
-from datetime import datetime, timedelta
+import json
+import threading
 
-from nuclia import sdk
-from nucliadb_sdk.v2.exceptions import ConflictError
 import configuration
+import client
+from throttle import Throttle, http_status
 
-from validator import validate
+from validator import open_export
+from story import preprocess_item, content_hash, PREPROCESS_FIELDS
+from delta import DELTA_FIELD, CHANGED
+from indexer import find_items
+from journal import Journal, CREATED, UPDATED, CONFLICT, FAILED
+from resource_cache import ResourceCache
+from pipeline import Pipeline
+from metrics import Metrics
+import tracing
+import queued_logging
 
-from collections import deque
-from statistics import mean
 
 
 
@@ -23,43 +29,13 @@ logging.basicConfig(level=logging.INFO,
                     datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger("nuclia loader")
 
-LANGUAGES = {'english': 'en',
-             'korean': 'kr',
-             'vietnamese': 'vi',
-             'burmese': 'my',
-             'tibetan': 'bo',
-             'khmer': 'km',
-             'uyghur': 'ug',
-             'mandarin': 'zh-cn',
-             'cantonese': 'zh-yue',
-             'lao': 'lo',
-             'indonesian': 'id',
-             'bengali': 'bn',
-             'malay': 'ms-zsm',
-             'thai': 'th'
-             }
-
-LANGUAGE_LABELS = {'burmese': "Burmese",
-                   'cantonese': "Cantonese",
-                   'english': "English RFA",
-                   'khmer': "Khmer",
-                   'korean': "Korean",
-                   'lao': "Lao",
-                   'mandarin': "Mandarin",
-                   'tibetan': "Tibetan",
-                   'uyghur': "Uyghur",
-                   'vietnamese': "Vietnamese",
-                   'bengali': "Bengali",
-                   'english-benar': "English BenarNews",
-                   'indonesian': "Indonesian",
-                   'malay': "Malay",
-                   'thai': "Thai"
-                   }
-
 #Globals
 FAKE_IT = False #global override for debugging and not actually uploading.
 KB = None #set during argparse
 API_KEY = None #set during argparse
+THROTTLE = Throttle() #rate limit and retry policy for requests, replaced during argparse
+QUEUE_DEPTH = 16 #smallest queue between pipeline stages
+METRICS = Metrics("nuclia loader") #throughput and request latencies, replaced during argparse
 
 def process_args():
     parser = argparse.ArgumentParser(description="""Load nuclia with a knowledgebox name and json file from plone export.
@@ -69,6 +45,12 @@ def process_args():
                                      usage="""usage: loader.py <knowledgebox> <filename> 
                                                      --id=<id> --resume_at=<index>
                                                      --max=number
+                                                     --concurrency=N --queue-depth=N --preprocess-workers=N --parse-workers=N
+                                                     --no-journal --cache --upsert --http2
+                                                     --rate=N --retries=N --target-latency=S
+                                                     --failures=<manifest.jsonl>
+                                                     --metrics-out=<file.prom|file.json> --report-interval=S
+                                                     --trace-out=<trace.json> --profile-every=N --profile-out=<file.pstats>
                                                      -v"""
                                      )
 
@@ -89,7 +71,8 @@ def process_args():
                         )
 
     parser.add_argument("--id",
-                        help="upload only a single ID from file",
+                        help="upload only this ID from file.  may be given more than once",
+                        action="append",
                         )
     parser.add_argument("--max",
                         type=int,
@@ -97,6 +80,109 @@ def process_args():
                         default=None
                         )
 
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="number of uploads to keep in flight at once",
+                        default=1
+                        )
+
+    parser.add_argument("--queue-depth",
+                        type=int,
+                        help="items allowed to wait between each stage of the pipeline. default: twice the concurrency",
+                        default=None
+                        )
+
+    parser.add_argument("--parse-workers",
+                        type=int,
+                        help="processes parsing the export, a shard of the file each",
+                        default=1
+                        )
+
+    parser.add_argument("--preprocess-workers",
+                        type=int,
+                        help="threads preparing items for upload",
+                        default=1
+                        )
+
+    parser.add_argument("--no-journal",
+                        help="upload everything, even items the journal says are already loaded and unchanged, "
+                             "and don't record outcomes",
+                        action="store_true")
+
+    parser.add_argument("--cache",
+                        help="skip items the local resource cache (see resource_cache.py) says are loaded and unchanged, "
+                             "update the rest by resource id, and record what is loaded in it",
+                        action="store_true")
+
+    parser.add_argument("--upsert",
+                        help="when a resource already exists, update it with the full content instead of skipping it",
+                        action="store_true")
+
+    parser.add_argument("--http2",
+                        help="talk to nuclia over http/2 (needs the 'h2' package)",
+                        action="store_true")
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second to send to nuclia",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--target-latency",
+                        type=float,
+                        help="seconds; slower replies make the loader reduce concurrency like a 429 does",
+                        default=None
+                        )
+
+    parser.add_argument("--failures",
+                        help="where to write the manifest of items that failed to upload, one json object per line. "
+                             "default: errors/<knowledgebox>_failures.jsonl.  replay it with retry.py.  "
+                             "only replaced if something fails",
+                        default=None
+                        )
+
+    parser.add_argument("--metrics-out",
+                        help="keep progress and request latency metrics in this file: "
+                             "a prometheus textfile if it ends in .prom, otherwise json",
+                        default=None
+                        )
+
+    parser.add_argument("--report-interval",
+                        type=float,
+                        help="seconds between progress lines (and metrics file updates)",
+                        default=10
+                        )
+
+    parser.add_argument("--trace-out",
+                        help="record where each item's time goes (pipeline stages, requests, http) "
+                             "to this file in chrome trace format - open it in chrome://tracing or ui.perfetto.dev",
+                        default=None
+                        )
+
+    parser.add_argument("--profile-every",
+                        type=int,
+                        help="cProfile one in every N item steps",
+                        default=None
+                        )
+
+    parser.add_argument("--profile-out",
+                        help="where to write the profile.  default: profile.pstats",
+                        default=None
+                        )
+
+    parser.add_argument("--log-every",
+                        type=int,
+                        help="log through a background thread, and only one in every N of each per item line "
+                             "(warnings and errors always), with a count of those left out every --report-interval",
+                        default=None
+                        )
+
     parser.add_argument("-v", "--verbose",
                         help="turn on debug",
                         action="store_true")
@@ -110,17 +196,27 @@ def process_args():
     return parsed_args
 
 
-def load_file(filename, resume_at=0, max_uploads=None):
-
-    logger.debug(f"counting objects in {filename}")
-    (objects, unpublished, errors) = validate(filename)
-    total_published = objects - unpublished
-    logger.debug(f"{objects} objects | {total_published} published")
-    count = 0
-    average_duration = 0.0001  # a guess
+def load_file(filename, resume_at=0, max_uploads=None, concurrency=1, journal=None, upsert=False, failures=None,
+              progress=None, queue_depth=None, preprocess_workers=1, cache=None, parse_workers=1):
+    """ upload the published items in the export.
+        the export goes through a pipeline: parse -> filter -> preprocess -> upload -> journal,
+        with queue_depth items (default: twice the concurrency) allowed to wait between stages.
+        with more than one parse_workers the export is parsed by that many processes (see validator.ShardedReader).
+        progress, if given, is called with (completed, target) as each upload finishes.
+        returns the upload_errors buckets.
+    """
 
-    last_runtimes = deque()
-    window_average = 10
+    # a delta file (see delta.py) says which of its stories are already in the knowledgebox.
+    reader = open_export(filename, fields=PREPROCESS_FIELDS + (DELTA_FIELD,), workers=parse_workers)
+    if reader.exact is not None:
+        logger.debug(f"{reader.total_objects} objects | {reader.total_published} published")
+    else:
+        logger.debug(f"no counts for {filename} yet - progress is estimated until the whole file is read")
+    skipped = 0  # published items skipped to reach resume_at
+    count = 0  # items handed to the uploaders (max_uploads is counted against this)
+    completed = 0  # items whose upload has finished, successfully or not
+    journaled = 0  # items skipped because the journal (or cache) says they are already loaded and unchanged
+    counting = threading.Lock()
     upload_errors = {}
 
     if resume_at < 0:
@@ -128,214 +224,310 @@ def load_file(filename, resume_at=0, max_uploads=None):
     if max_uploads is not None and resume_at:
         logger.error("combining max and resume_at is not supported")
         raise ValueError
+    if concurrency < 1:
+        concurrency = 1
+    if queue_depth is None:
+        queue_depth = max(2 * concurrency, QUEUE_DEPTH)
 
-    target_uploads = total_published
     if max_uploads is not None:
         logger.info(f"Maximum number of uploads set to {max_uploads}")
-        target_uploads = max_uploads
 
-    with open(filename, 'r') as filep:
+    def target():
+        """ the number of uploads expected - provisional until the reader has seen the whole file. """
+        if max_uploads is not None:
+            return max_uploads
+        return max(reader.total_published - resume_at - journaled, completed, 1)
+
+    def accept(item):
+        """ filter stage: only published items, after resume_at. """
+        nonlocal skipped
+        if "unexported_paths" in item and "@id" not in item:
+            # it's the error report at the end of the export - ignore it.
+            return None
+
+        # Skip unpublished content.
+        if item.get('review_state') != "published":
+            logger.info("skipping: review state '%s' for %s ", item.get('review_state'), item['@id'])
+            return None
+
+        # Skip objects until 'resume at' is met:
+        if skipped < resume_at:
+            logger.info("%s |  skipping up to %s/%s", item['title'], skipped, resume_at)
+            skipped += 1
+            return None
+
+        return item
+
+    def prepare(item):
+        """ preprocess stage: the record to upload, and whether it is already in the knowledgebox. """
+        nonlocal count, journaled
+        record = preprocess_item(item)
+        record.content_hash = content_hash(record)
+
+        # new items are created, changed ones updated, and unchanged ones left alone.
+        exists = False
+        if journal is not None:
+            if journal.unchanged(record.uid, record.content_hash):
+                logger.debug("skipping: %s already loaded and unchanged according to the journal", record.uid)
+                with counting:
+                    journaled += 1
+                return None
+            exists = journal.committed(record.uid)
+            record.rid = journal.rid(record.uid)
+        if cache is not None:
+            if cache.unchanged(record.uid, record.content_hash):
+                logger.debug("skipping: %s already loaded and unchanged according to the resource cache", record.uid)
+                with counting:
+                    journaled += 1
+                return None
+            exists = exists or cache.exists(record.uid)
+            record.rid = cache.rid(record.uid) or record.rid
+        exists = exists or item.get(DELTA_FIELD) == CHANGED
+
+        with counting:
+            if max_uploads is not None and count >= max_uploads:
+                if not pipeline.stopped:
+                    logger.info("maximum uploads reached.  Exiting.")
+                    pipeline.stop()
+                return None
+            count += 1
 
-        # stream it from json into objects one item at a time
-        objects = ijson.items(filep, 'item')
-        logger.debug("starting upload")
-        tstart = time.monotonic()
-        for item in objects:
+        return (record, exists)
 
-            logger.debug(f"processing object at {count}")
-            if "unexported_paths" in item and "@id" not in item:
-                # it's the error report at the end of the export - ignore it.
-                continue
+    METRICS.target = target
+    last_queues = time.monotonic()
 
-            # Skip unpublished content.
-            if item.get('review_state') != "published":
-                logger.info(f"skipping: review state '{item.get('review_state')}' for {item['@id']} ")
-                continue
+    def finish(result):
+        """ journal stage: collect the result of an upload and report progress. """
+        nonlocal completed, last_queues
+        (record, outcome) = result
+        record_result(record, outcome, upload_errors, journal, failures, cache)
 
-            # Skip objects until 'resume at' is met:
-            if count < resume_at:
-                logger.info(f"{item['title']} |  skipping up to {count}/{resume_at}")
-                count += 1
-                continue
+        completed += 1
+        if progress is not None:
+            progress(completed, target())
+        METRICS.complete(outcome_name(outcome))
 
-            if max_uploads is not None and count >= max_uploads:
-                logger.info("maximum uploads reached.  Exiting.")
-                break
-
-            item = preprocess_item(item)
-
-            try:
-                load_one(item)
-            except ConflictError as e:
-                logger.error(f"{item['UID']} already exists.  Maybe we should PATCH?")
-                if 'ConflictError' not in upload_errors:
-                    upload_errors['ConflictError'] = []
-                upload_errors['ConflictError'].append(f"{item['UID']}, {item['@id']}")
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                exception_name = e.__class__.__name__
-                if exception_name not in upload_errors:
-                    upload_errors[exception_name] = []
-                ex_type, ex, tb = sys.exc_info()
-                upload_errors[exception_name].append(f"{item['UID']}, {item['@id']} : {traceback.print_tb(tb)}")
+        if time.monotonic() - last_queues >= METRICS.interval:
+            logger.info(f"queues: {pipeline.depths()}")
+            last_queues = time.monotonic()
 
-            count += 1
-            logger.info(f"{count} of {target_uploads} | {count/target_uploads:.1%} complete")
+    # the throttle lowers the number of busy uploaders while the server is struggling.
+    pipeline = Pipeline(reader, depth=queue_depth)
+    pipeline.add_stage("filter", accept)
+    pipeline.add_stage("preprocess", prepare, workers=preprocess_workers)
+    pipeline.add_stage("upload", upload_stage(upsert), workers=concurrency, limit=lambda: THROTTLE.limit)
 
-            #print running average rate:
-            if len(last_runtimes) > window_average:
-                last_runtimes.popleft()
-                rate = mean(last_runtimes)
-            else:
-                rate = 9999.9
+    logger.debug(f"starting upload with {concurrency} concurrent requests, {queue_depth} items per queue")
+    pipeline.run(finish, name="journal")
+    METRICS.close()
+    logger.info(f"pipeline:\n{pipeline.summary()}")
 
+    if journaled:
+        logger.info(f"{journaled} items were skipped as already loaded and unchanged")
+    if THROTTLE.retries:
+        logger.info(f"{THROTTLE.retries} requests were retried")
 
-            # figure out the estimated time to completion.
-            remaining_seconds = (target_uploads - count) * average_duration
-            delta = timedelta(seconds=int(remaining_seconds))
-            (h, m, s) = f"{delta}".split(':')
-            logger.info(f"rate: {rate:.4f} items/second ETA: {h}h {m}m {s}s |" +
-                        f"{(datetime.now()+timedelta(seconds=remaining_seconds)).strftime('%Y-%m-%d %X')}")
+    # output the upload errors to stderr:
+    print(f"{upload_errors}", file=sys.stderr)
 
-            tend = time.monotonic()
-            duration = tend-tstart
-            last_runtimes.append(1/duration)
+    return upload_errors
 
-            average_duration = average_duration + ((duration-average_duration)/(count-resume_at))
 
-            # leave this as the last line of the loop - always
-            tstart = tend  # next loop iteration start time is this loop iteration end time.
+def outcome_name(outcome):
+    """ the journal outcome of an upload, or the name of the exception it raised """
+    if isinstance(outcome, Exception):
+        return outcome.__class__.__name__
+    return outcome
 
 
+def upload_stage(upsert=False):
+    """ the upload stage: send a (record, exists) pair, passing on (record, outcome or exception) """
+    def upload(work):
+        (record, exists) = work
+        try:
+            return (record, send_one(record, exists, upsert))
+        except Exception as e:
+            return (record, e)
+    return upload
 
-    # output the upload errors to stderr:
-    print(f"{upload_errors}", file=sys.stderr)
 
-def load_id(item_id, filename):
-    """ given a specific ID from the plone export file,
-        find that ID in the json export and only upload that specific one.
+def record_result(record, outcome, upload_errors, journal=None, failures=None, cache=None):
+    """ file the outcome of a finished upload of 'record' (its journal outcome, or the exception
+        it raised) into the upload_errors buckets, and into the journal, failure manifest and
+        resource cache if there are any.
+    """
+    if isinstance(outcome, Exception) and http_status(outcome) == 409:
+        logger.error(f"{record.uid} already exists.  Maybe we should PATCH?")
+        if 'ConflictError' not in upload_errors:
+            upload_errors['ConflictError'] = []
+        upload_errors['ConflictError'].append(f"{record.uid}, {record.url}")
+        if journal is not None:
+            journal.record(record.uid, record.url, CONFLICT)
+        if failures is not None:
+            write_failure(failures, record, outcome)
+    elif isinstance(outcome, Exception):
+        e = outcome
+        logger.error(e, exc_info=e)
+        exception_name = e.__class__.__name__
+        if exception_name not in upload_errors:
+            upload_errors[exception_name] = []
+        upload_errors[exception_name].append(f"{record.uid}, {record.url} : {''.join(traceback.format_tb(e.__traceback__))}")
+        if journal is not None:
+            journal.record(record.uid, record.url, FAILED, exception_name)
+        if failures is not None:
+            write_failure(failures, record, e)
+    else:
+        if journal is not None:
+            journal.record(record.uid, record.url, outcome, digest=record.content_hash, rid=record.rid)
+        if cache is not None:
+            cache.put(record.uid, record.rid, digest=record.content_hash)
+
+
+def write_failure(failures, record, e):
+    """ one line of the failure manifest - retry.py reads these back """
+    failure = {'UID': record.uid,
+               '@id': record.url,
+               'exception': e.__class__.__name__,
+               'status': http_status(e),
+               'attempts': getattr(e, 'attempts', 1),
+               }
+    failures.write(json.dumps(failure) + "\n")
+    failures.flush()
+
+
+def load_ids(item_ids=(), filename=None, journal=None, upsert=False, item_uids=(), concurrency=1, failures=None,
+             cache=None):
+    """ given specific IDs or UIDs from the plone export file,
+        find them in the json export and only upload those.
+        the export's index (see indexer.py) takes us straight to each item.
+    """
+    logger.debug(f"searching for item[@id] in {item_ids} or item[UID] in {item_uids}")
+    upload_errors = {}
+
+    def prepare(item):
+        record = preprocess_item(item)
+        record.content_hash = content_hash(record)
+        exists = False
+        if journal is not None:
+            exists = journal.committed(record.uid)
+            record.rid = journal.rid(record.uid)
+        if cache is not None:
+            exists = exists or cache.exists(record.uid)
+            record.rid = cache.rid(record.uid) or record.rid
+        return (record, exists)
+
+    def finish(result):
+        (record, outcome) = result
+        record_result(record, outcome, upload_errors, journal, failures, cache)
+        METRICS.complete(outcome_name(outcome))
+
+    concurrency = max(concurrency, 1)
+    pipeline = Pipeline(find_items(filename, ids=item_ids, uids=item_uids), depth=max(2 * concurrency, QUEUE_DEPTH))
+    pipeline.add_stage("preprocess", prepare)
+    pipeline.add_stage("upload", upload_stage(upsert), workers=concurrency, limit=lambda: THROTTLE.limit)
+    pipeline.run(finish, name="journal")
+    METRICS.close()
+
+    if upload_errors:
+        print(f"{upload_errors}", file=sys.stderr)
+
+
+def failures_path(knowledgebox):
+    return os.path.join("errors", f"{knowledgebox.lower()}_failures.jsonl")
+
+
+class FailureManifest:
+    """ a failure manifest that isn't created until the first failure is written - so a run in which
+        nothing fails (an --id, a --max 1, a faked run) leaves the last run's manifest for retry.py.
     """
-    logger.debug(f"searching for item[@id]={item_id}")
-    with open(filename, 'r') as filep:
 
-        # stream it from json into objects one item at a time
-        objects = ijson.items(filep, 'item')
-        found = False
-        for item in objects:
-            if item.get('@id') == item_id:
-                found = True
-                item = preprocess_item(item)
+    def __init__(self, filename):
+        self.filename = filename
+        self._filep = None
+
+    def write(self, line):
+        if self._filep is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self._filep = open(self.filename, 'w')
+        self._filep.write(line)
 
-                try:
-                    load_one(item)
-                except ConflictError as e:
-                    logger.error(f"{item['UID']} already exists.  Maybe we should PATCH?")
-                except Exception as e:
-                    raise
+    def flush(self):
+        if self._filep is not None:
+            self._filep.flush()
 
-                break
+    def close(self):
+        if self._filep is not None:
+            self._filep.close()
+
+
+def send_one(record, exists=False, upsert=False):
+    """ create the resource for a record, or update it if it is already in the knowledgebox.
+        with upsert, a create that conflicts with an existing resource is retried as an update.
+        returns the journal outcome.
+    """
+    if exists:
+        update_one(record)
+        return UPDATED
 
-        if not found:
-            logger.warning(f"id {item_id} not found in {filename}")
+    try:
+        load_one(record)
+    except Exception as e:
+        if not upsert or http_status(e) != 409:
+            raise
+        logger.info("%s already exists - updating it instead", record.uid)
+        update_one(record)
+        return UPDATED
 
+    return CREATED
 
-def load_one(item):
+
+def load_one(record):
     # The slug is your own unique id (so the Plone uid is probably a good one in your case),
     # it will allow you to access the created resource without having to store locally
     # the corresponding Nuclia-specific unique id.
     #
 
-    uri = f"{configuration.cloud_endpoint}/kb/{KB}"
-    logger.info(f"adding resource for {item['@id']}, language {item['language']['token']}")
-    res = sdk.NucliaResource()
-    logger.debug(f"""
-                     title = {item['title']}
-                     slug = {item['UID']}
-                     thumbnail = {item['thumbnail']}
-                     effective = {item['effective']}  (nuclia 'created')
-                     created = {item['created']}
-                  """)
+    logger.debug("adding resource for %s, language %s", record.url, record.language)
+    logger.debug("""
+                     title = %s
+                     slug = %s
+                     thumbnail = %s
+                     effective = %s  (nuclia 'created')
+                     created = %s
+                  """, record.title, record.uid, record.thumbnail, record.effective, record.created)
+    with tracing.span("serialise"):
+        payload = record.create_payload()
     if not FAKE_IT:
-        res.create(
-            url=uri,
-            api_key=API_KEY,
-            title=item['title'],
-            slug=item['UID'],
-            metadata={
-                "language": item['language']['token'],
-            },
-            usermetadata={
-                "classifications": [
-                    {"labelset": "Language Service", "label": item['language_service']},
-                ],
-            },
-            origin={
-                "url": item['@id'],
-                "tags": item['subjects'],
-                "created": item['effective'],
-                "modified": item['modified'],
-                # "metadata": {"thumbnail": item['thumbnail']}
-            },
-            extra={"metadata": {"thumbnail": item['thumbnail']}},
-            summary=item['description'],
-            texts={
-                "body": {
-                    "body": item['text']['data'],
-                    "format": "HTML",
-                }
-            },
-        )
+        from nuclia import sdk  # not until the first request - a faked run never needs it
+
+        with METRICS.timer("create"):
+            record.rid = THROTTLE.call(
+                sdk.NucliaResource().create,
+                ndb=client.get_client(KB, API_KEY),
+                **payload
+            )
     else:
         logger.warning("Faked request - upload did not occur")
 
 
-def preprocess_item(item):
-    # fix the ID, so it points to a published resource, not a test or dev uri
-    rfa_pattern = ".*\.rfaweb.org"
-    item['@id'] = re.sub(rfa_pattern, "https://www.rfa.org", item['@id'])
-    benar_pattern = "https://.*\.benarnews.org"
-    item['@id'] = re.sub(benar_pattern, "https://www.benarnews.org", item['@id'])
-
-    # set description to None if it's blank:
-    if not item['description'] or item['description'].isspace():
-        item['description'] = None
-
-    # clean the whitespace crap out of subjects:
-    item['subjects'] = list([tag for tag in item['subjects'] if (tag and not tag.isspace())])
-
-    # language must be inferred from URL
-    parsed_url = urllib.parse.urlparse(item['@id'])
-    language = parsed_url.path.split('/')[1]
-    language_code = LANGUAGES.get(language, "en")
-
-    item['language'] = {'title': language.capitalize(), 'token': language_code}
-
-    item['language_service'] = LANGUAGE_LABELS.get(language, 'unknown')
-    if language == 'english' and 'benar' in parsed_url.netloc:
-        item['language_service'] = "English BenarNews"
-
-    # Some stories have no text!
-    if item['text'] is None:
-        item['text'] = {"data": "",
-                        "content-type": "text/html"
-                        }
-
-    #set the thumbnail URL:
-    if item['featured_image'] is not None:
-        item['thumbnail'] = item['featured_image']['@id']
-    if item['image'] is not None:
-        item['thumbnail'] = item['@id']
-    elif item.get('p4_image') is not None:
-        item['thumbnail'] = item['p4_image']['@id']
-    else:
-        item['thumbnail'] = None
-
-    if item['thumbnail']:
-        item['thumbnail'] = item['thumbnail'] + "/@@images/image/image_thumb_tablet"
-        item['thumbnail'] = re.sub(rfa_pattern, "https://www.rfa.org", item['thumbnail'])
-        item['thumbnail'] = re.sub(benar_pattern, "https://www.benarnews.org", item['thumbnail'])
+def update_one(record):
+    """ replace the content of the existing resource for a record (by rid, or slug) with the full payload """
 
-    return item
+    logger.debug("updating resource for %s, language %s", record.url, record.language)
+    with tracing.span("serialise"):
+        payload = record.update_payload()
+    if not FAKE_IT:
+        from nuclia import sdk
+
+        with METRICS.timer("update"):
+            THROTTLE.call(
+                sdk.NucliaResource().update,
+                ndb=client.get_client(KB, API_KEY),
+                **payload
+            )
+    else:
+        logger.warning("Faked request - update did not occur")
 
 
 if __name__ == "__main__":
@@ -344,16 +536,52 @@ if __name__ == "__main__":
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("debug on")
-
-    logger.debug(f"using {args.knowledgebox} knowledgebox")
-    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox)
+    if args.log_every:
+        queued_logging.start(args.log_every, args.report_interval)
 
     if args.fake_it:
         FAKE_IT = True  #global
 
-    if args.id is not None:
-        load_id(args.id, args.filename)
-    else:
-        load_file(args.filename, args.resume_at, args.max)
+    logger.debug(f"using {args.knowledgebox} knowledgebox")
+    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox, need_key=not FAKE_IT)
+
+    tracing.enable(args.trace_out, args.profile_every, args.profile_out)
 
+    # one connection per in-flight upload
+    client.configure(pool_size=args.concurrency, http2=args.http2)
+    THROTTLE = Throttle(max_concurrency=args.concurrency,
+                        rate=args.rate,
+                        max_attempts=args.retries,
+                        target_latency=args.target_latency)
 
+    METRICS = Metrics("nuclia loader",
+                      interval=args.report_interval,
+                      export=args.metrics_out,
+                      labels={'knowledgebox': args.knowledgebox})
+
+    # a faked run uploads nothing, so it mustn't be journaled as if it had.
+    journal = None
+    if not args.no_journal and not FAKE_IT:
+        journal = Journal(args.knowledgebox)
+    cache = None
+    if args.cache and not FAKE_IT:
+        cache = ResourceCache(KB)
+
+    failures = FailureManifest(args.failures or failures_path(args.knowledgebox))
+
+    if args.id is not None:
+        load_ids(args.id, args.filename, journal, args.upsert, concurrency=args.concurrency, failures=failures,
+                 cache=cache)
+    else:
+        load_file(args.filename, args.resume_at, args.max, args.concurrency, journal, args.upsert, failures,
+                  queue_depth=args.queue_depth, preprocess_workers=args.preprocess_workers, cache=cache,
+                  parse_workers=args.parse_workers)
+
+    failures.close()
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.close()
+    client.close()
+    tracing.close()
+    queued_logging.stop()
@@ -0,0 +1,216 @@
+"""
+Progress and latency metrics for long running loads.
+
+    metrics = Metrics("loader", target=lambda: expected, export="metrics/korean.prom")
+    with metrics.timer("create"):
+        ...
+    metrics.complete("created")
+
+Throughput is an exponentially weighted moving average, updated once per report interval, and
+the ETA comes from it.  Request latencies are kept per request type (the most recent
+LATENCY_SAMPLES of each) for p50/p95/p99.  Nothing is logged per item: report() logs one summary
+line once 'interval' seconds have passed, and, if 'export' is given, rewrites a Prometheus
+textfile (a .prom filename, for node_exporter's textfile collector) or a json file.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("metrics")
+
+LATENCY_SAMPLES = 10000  # per request type
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(ordered, q):
+    """ the q'th quantile (0..1) of an already sorted list, by nearest rank """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    (minutes, s) = divmod(int(seconds), 60)
+    (h, m) = divmod(minutes, 60)
+    return f"{h}h {m:02d}m {s:02d}s"
+
+
+class Metrics:
+
+    def __init__(self, name, target=None, interval=10.0, alpha=0.3, export=None, labels=None):
+        """
+        :param name: the logger for the summary lines, and (as snake case) the prefix for the exported metrics
+        :param target: number of items expected, or a callable returning it (for estimates that firm up)
+        :param interval: seconds between summary lines (and exports)
+        :param alpha: weight of the latest interval's throughput in the moving average
+        :param export: filename to write the metrics to every interval - .prom for prometheus, otherwise json
+        :param labels: extra prometheus labels for every metric, e.g. {'knowledgebox': 'korean'}
+        """
+        self.name = name
+        self.logger = logging.getLogger(name)
+        self.target = target
+        self.interval = interval
+        self.alpha = alpha
+        self.export_filename = export
+        self.labels = labels or {}
+
+        self.completed = 0
+        self.outcomes = Counter()
+        self.throughput = None  # items/second, moving average
+        self.latencies = {}  # request type -> deque of recent durations
+        self.latency_counts = Counter()
+        self.latency_sums = Counter()
+
+        self._lock = threading.Lock()
+        self._tstart = time.monotonic()
+        self._last_report = self._tstart
+        self._last_completed = 0
+
+    def expected(self):
+        target = self.target() if callable(self.target) else self.target
+        return max(target or 0, self.completed)
+
+    def observe(self, kind, seconds):
+        """ record how long one request of this type took """
+        with self._lock:
+            if kind not in self.latencies:
+                self.latencies[kind] = deque(maxlen=LATENCY_SAMPLES)
+            self.latencies[kind].append(seconds)
+            self.latency_counts[kind] += 1
+            self.latency_sums[kind] += seconds
+
+    @contextmanager
+    def timer(self, kind):
+        tstart = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, time.perf_counter() - tstart)
+
+    def complete(self, outcome="completed"):
+        """ count one finished item, and report if it's time to """
+        with self._lock:
+            self.completed += 1
+            self.outcomes[outcome] += 1
+        self.report()
+
+    def report(self, force=False):
+        """ log a summary line (and export) if the interval has passed since the last one """
+        now = time.monotonic()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._update_throughput(now)
+        self.logger.info(self.summary(), extra={'sampled': False})  # never left out by queued_logging
+        if self.export_filename:
+            self.export()
+
+    def _update_throughput(self, now):
+        with self._lock:
+            elapsed = now - self._last_report
+            if elapsed <= 0:
+                return
+            rate = (self.completed - self._last_completed) / elapsed
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = self.alpha * rate + (1 - self.alpha) * self.throughput
+            self._last_report = now
+            self._last_completed = self.completed
+
+    def eta_seconds(self):
+        if not self.throughput:
+            return None
+        return (self.expected() - self.completed) / self.throughput
+
+    def quantiles(self, kind):
+        with self._lock:
+            ordered = sorted(self.latencies.get(kind, ()))
+        return {q: percentile(ordered, q) for q in QUANTILES}
+
+    def summary(self):
+        target = self.expected()
+        line = (f"{self.completed} of {target} | {self.completed / max(target, 1):.1%} complete"
+                f" | {self.throughput or 0:.2f} items/second")
+        eta = self.eta_seconds()
+        if eta is not None:
+            line += f" | ETA {format_duration(eta)} ({(datetime.now() + timedelta(seconds=eta)).strftime('%Y-%m-%d %X')})"
+        for kind in sorted(self.latencies):
+            quantiles = self.quantiles(kind)
+            line += f" | {kind} p50/p95/p99 " + "/".join(f"{quantiles[q] * 1000:.0f}" for q in QUANTILES) + "ms"
+        if self.outcomes and (len(self.outcomes) > 1 or "completed" not in self.outcomes):
+            line += " | " + ", ".join(f"{outcome} {n}" for (outcome, n) in sorted(self.outcomes.items()))
+        return line
+
+    def snapshot(self):
+        """ everything as a json-able dict """
+        return {'name': self.name,
+                'labels': self.labels,
+                'time': time.time(),
+                'elapsed_seconds': time.monotonic() - self._tstart,
+                'completed': self.completed,
+                'target': self.expected(),
+                'throughput': self.throughput,
+                'eta_seconds': self.eta_seconds(),
+                'outcomes': dict(self.outcomes),
+                'latency': {kind: {'count': self.latency_counts[kind],
+                                   'sum': self.latency_sums[kind],
+                                   'quantiles': {str(q): v for (q, v) in self.quantiles(kind).items()}}
+                            for kind in sorted(self.latencies)},
+                }
+
+    def prometheus(self):
+        """ the metrics in the prometheus text exposition format """
+        prefix = self.name.replace(' ', '_').replace('-', '_')
+
+        def labels(**extra):
+            pairs = {**self.labels, **extra}
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for (key, value) in pairs.items()) + "}"
+
+        lines = [f"# TYPE {prefix}_items_completed_total counter"]
+        for (outcome, n) in sorted(self.outcomes.items()):
+            lines.append(f"{prefix}_items_completed_total{labels(outcome=outcome)} {n}")
+        lines.append(f"# TYPE {prefix}_items_target gauge")
+        lines.append(f"{prefix}_items_target{labels()} {self.expected()}")
+        lines.append(f"# TYPE {prefix}_throughput_items_per_second gauge")
+        lines.append(f"{prefix}_throughput_items_per_second{labels()} {self.throughput or 0}")
+        eta = self.eta_seconds()
+        if eta is not None:
+            lines.append(f"# TYPE {prefix}_eta_seconds gauge")
+            lines.append(f"{prefix}_eta_seconds{labels()} {eta}")
+        if self.latencies:
+            lines.append(f"# TYPE {prefix}_request_seconds summary")
+        for kind in sorted(self.latencies):
+            for (q, value) in self.quantiles(kind).items():
+                lines.append(f"{prefix}_request_seconds{labels(type=kind, quantile=q)} {value}")
+            lines.append(f"{prefix}_request_seconds_sum{labels(type=kind)} {self.latency_sums[kind]}")
+            lines.append(f"{prefix}_request_seconds_count{labels(type=kind)} {self.latency_counts[kind]}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """ rewrite the export file - atomically, so a collector never reads half of it """
+        if self.export_filename.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        directory = os.path.dirname(os.path.abspath(self.export_filename))
+        os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.export_filename}.tmp"
+        try:
+            with open(temporary, 'w') as filep:
+                filep.write(content)
+            os.replace(temporary, self.export_filename)
+        except OSError as e:
+            logger.warning(f"could not export metrics to {self.export_filename}: {e}")
+
+    def close(self):
+        """ the final summary line and export """
+        self.report(force=True)
@@ -0,0 +1,341 @@
+"""
+A local stand-in for the parts of the nuclia api the tools use, for benchmarks and trying things
+out without real knowledgeboxes or api keys.
+
+    python mock_nuclia.py --port 8765 --latency 0.05 --rate-limit 0.01
+
+then point the tools at it with
+
+    NUCLIA_ENDPOINT=http://127.0.0.1:8765/api/v1 NUCLIA_API_KEY=any python loader.py Korean data/sample.json
+
+Resources live in memory, per knowledgebox id (any id is accepted):
+
+    POST   /v1/kb/{kb}/resources                  create - 409 if the slug is taken
+    GET    /v1/kb/{kb}/resource/{rid}, /slug/{slug}
+    HEAD   the same - does it exist
+    PATCH  the same                               update the given fields
+    DELETE the same
+    GET    /v1/kb/{kb}/resources                  list, paged
+    POST   /v1/kb/{kb}/search, /catalog           label filters ("/l/<labelset>[/<label>]"), paged
+    GET    the same, with the filters and paging in the query string
+
+and, for the benchmark harness, POST /mock/seed (a json list of slugs to create as bare resources, or
+of the fields of resources to create),
+GET /mock/stats (requests by method and status) and POST /mock/reset.
+
+Every request waits --latency seconds (+/- --jitter), and --rate-limit / --error-rate of them are
+answered 429 (with a try_after) / 503 instead.
+"""
+import argparse
+import datetime
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                    datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("mock nuclia")
+
+PAGE_SIZE = 20  # the api's default
+
+# the fields of a resource that come back as they were sent - the rest are shaped like the sdk's
+# Resource model in resource_view().
+RESOURCE_FIELDS = ('id', 'slug', 'title', 'summary', 'icon', 'thumbnail', 'usermetadata', 'origin', 'extra', 'hidden')
+
+_resource_path = re.compile(r"^/v1/kb/(?P<kb>[^/]+)/(?P<by>resource|slug)/(?P<key>[^/]+)$")
+_collection_path = re.compile(r"^/v1/kb/(?P<kb>[^/]+)/(?P<what>resources|search|catalog|find)$")
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="a local stand-in for the nuclia api, for benchmarks",
+                                     usage="usage: mock_nuclia.py [--port=N] [--latency=S] [--jitter=S] "
+                                           "[--rate-limit=F] [--error-rate=F]")
+    parser.add_argument("--host",
+                        default="127.0.0.1")
+
+    parser.add_argument("--port",
+                        type=int,
+                        default=8765)
+
+    parser.add_argument("--latency",
+                        type=float,
+                        help="seconds each request takes",
+                        default=0.0)
+
+    parser.add_argument("--jitter",
+                        type=float,
+                        help="random +/- seconds on top of the latency",
+                        default=0.0)
+
+    parser.add_argument("--rate-limit",
+                        type=float,
+                        help="fraction of requests answered 429 Too Many Requests",
+                        default=0.0)
+
+    parser.add_argument("--try-after",
+                        type=float,
+                        help="seconds to tell rate limited clients to wait",
+                        default=1.0)
+
+    parser.add_argument("--error-rate",
+                        type=float,
+                        help="fraction of requests answered 503 Service Unavailable",
+                        default=0.0)
+
+    parser.add_argument("-v", "--verbose",
+                        help="log every request",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+class Store:
+    """ the resources of every knowledgebox, in memory """
+
+    def __init__(self):
+        self.resources = {}  # kb -> rid -> resource
+        self.slugs = {}  # kb -> slug -> rid
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.resources.clear()
+            self.slugs.clear()
+
+    def find(self, kb, by, key):
+        """ the resource by rid or slug, or None """
+        resources = self.resources.get(kb, {})
+        if by == 'slug':
+            key = self.slugs.get(kb, {}).get(key)
+        return resources.get(key)
+
+    def create(self, kb, fields):
+        slug = fields.get('slug') or uuid.uuid4().hex
+        with self.lock:
+            slugs = self.slugs.setdefault(kb, {})
+            if slug in slugs:
+                return None
+            rid = uuid.uuid4().hex
+            now = now_iso()
+            resource = {**fields, 'id': rid, 'slug': slug, 'created': now, 'modified': now}
+            self.resources.setdefault(kb, {})[rid] = resource
+            slugs[slug] = rid
+        return resource
+
+    def update(self, kb, by, key, fields):
+        with self.lock:
+            resource = self.find(kb, by, key)
+            if resource is not None:
+                resource.update({name: value for (name, value) in fields.items() if name not in ('id', 'slug')})
+                resource['modified'] = now_iso()
+        return resource
+
+    def delete(self, kb, by, key):
+        with self.lock:
+            resource = self.find(kb, by, key)
+            if resource is not None:
+                del self.resources[kb][resource['id']]
+                del self.slugs[kb][resource['slug']]
+        return resource
+
+    def query(self, kb, filters=()):
+        """ the resources with every one of the label filters """
+        wanted = [parse_filter(f) for f in filters]
+        with self.lock:
+            resources = list(self.resources.get(kb, {}).values())
+        return [resource for resource in resources if all(has_label(resource, *label) for label in wanted)]
+
+
+def parse_filter(expression):
+    """ '/l/<labelset>/<label>' or '/classification.labels/<labelset>' -> (labelset, label or None) """
+    parts = expression.strip('/').split('/')
+    labelset = urllib.parse.unquote(parts[1]) if len(parts) > 1 else None
+    label = urllib.parse.unquote(parts[2]) if len(parts) > 2 else None
+    return (labelset, label)
+
+
+def has_label(resource, labelset, label=None):
+    classifications = (resource.get('usermetadata') or {}).get('classifications') or []
+    return any(c.get('labelset') == labelset and (label is None or c.get('label') == label)
+               for c in classifications)
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def resource_view(resource):
+    """ a stored resource the way the api returns it (the sdk's Resource model), not the way it was sent """
+    view = {name: resource[name] for name in RESOURCE_FIELDS if name in resource}
+    view['metadata'] = {**(resource.get('metadata') or {}), 'status': "PROCESSED"}
+    view['created'] = resource['created']
+    view['modified'] = resource['modified']
+    return view
+
+
+def page(resources, page_number=0, page_size=PAGE_SIZE):
+    """ the search api's response shape, for one page of resources """
+    page_number = int(page_number or 0)
+    page_size = int(page_size or PAGE_SIZE)
+    start = page_number * page_size
+    chosen = resources[start:start + page_size]
+    return {'resources': {resource['id']: resource_view(resource) for resource in chosen},
+            'fulltext': {'results': [{'rid': resource['id'], 'score': 1.0, 'field_type': "a", 'field': "title"}
+                                     for resource in chosen],
+                         'facets': {},
+                         'query': "",
+                         'total': len(resources),
+                         'page_number': page_number,
+                         'page_size': page_size,
+                         'next_page': start + page_size < len(resources),
+                         'min_score': 0.0},
+            }
+
+
+class MockNucliaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+
+    # set by serve()
+    store = None
+    options = None
+    stats = None
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            logger.info(format % args)
+
+    def reply(self, status, body=None):
+        content = b"" if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+        with self.stats_lock:
+            self.stats[f"{self.command} {status}"] += 1
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def handle_one(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if path.startswith("/api/"):
+            path = path[len("/api"):]
+        query = urllib.parse.parse_qs(url.query)
+
+        # drain the body even if we're going to refuse the request, to keep the connection usable.
+        fields = self.body() if self.command in ('POST', 'PATCH', 'PUT') else {}
+
+        if path == "/mock/stats":
+            with self.stats_lock:
+                stats = dict(self.stats)
+            return self.reply(200, stats)
+        if path == "/mock/reset":
+            self.store.reset()
+            with self.stats_lock:
+                self.stats.clear()
+            return self.reply(204)
+        if path == "/mock/seed":
+            kb = query.get('kb', ['mock'])[0]
+            created = sum(1 for entry in fields
+                          if self.store.create(kb, entry if isinstance(entry, dict) else {'slug': entry}) is not None)
+            return self.reply(200, {'created': created})
+
+        options = self.options
+        if options.latency or options.jitter:
+            time.sleep(max(0.0, options.latency + random.uniform(-options.jitter, options.jitter)))
+        if options.rate_limit and random.random() < options.rate_limit:
+            return self.reply(429, {'detail': {'message': "rate limited", 'try_after': options.try_after}})
+        if options.error_rate and random.random() < options.error_rate:
+            return self.reply(503, {'detail': "service unavailable"})
+
+        match = _resource_path.match(path)
+        if match:
+            (kb, by, key) = match.group('kb', 'by', 'key')
+            if self.command in ('GET', 'HEAD'):
+                resource = self.store.find(kb, by, key)
+            elif self.command == 'PATCH':
+                resource = self.store.update(kb, by, key, fields)
+            elif self.command == 'DELETE':
+                resource = self.store.delete(kb, by, key)
+            else:
+                return self.reply(405, {'detail': "method not allowed"})
+
+            if resource is None:
+                return self.reply(404, {'detail': "Resource does not exist"})
+            if self.command == 'DELETE':
+                return self.reply(204)
+            if self.command == 'PATCH':
+                return self.reply(200, {'seqid': 1})
+            return self.reply(200, resource_view(resource))
+
+        match = _collection_path.match(path)
+        if match:
+            (kb, what) = match.group('kb', 'what')
+            if what == 'resources' and self.command == 'POST':
+                resource = self.store.create(kb, fields)
+                if resource is None:
+                    return self.reply(409, {'detail': f"A resource with this slug already exists: {fields.get('slug')}"})
+                return self.reply(201, {'uuid': resource['id'], 'seqid': 1})
+
+            if self.command == 'GET':
+                filters = query.get('filters', [])
+                page_number = query.get('page_number', [0])[0]
+                page_size = query.get('page_size', [PAGE_SIZE])[0]
+            else:
+                filters = fields.get('filters') or []
+                page_number = fields.get('page_number', 0)
+                page_size = fields.get('page_size', PAGE_SIZE)
+            filters = [f for f in filters if isinstance(f, str)]
+            results = page(self.store.query(kb, filters), page_number, page_size)
+            if what == 'resources':
+                results = {'resources': list(results['resources'].values()),
+                           'pagination': {'page': results['fulltext']['page_number'],
+                                          'size': results['fulltext']['page_size'],
+                                          'last': not results['fulltext']['next_page']}}
+            return self.reply(200, results)
+
+        return self.reply(404, {'detail': "Not Found"})
+
+    do_GET = do_HEAD = do_POST = do_PATCH = do_PUT = do_DELETE = handle_one
+
+
+def serve(host="127.0.0.1", port=8765, options=None):
+    """ start the mock in a background thread.  returns the server - call shutdown() on it when done. """
+    if options is None:
+        options = argparse.Namespace(latency=0.0, jitter=0.0, rate_limit=0.0, try_after=1.0,
+                                     error_rate=0.0, verbose=False)
+    handler = type("Handler", (MockNucliaHandler,), {'store': Store(), 'options': options, 'stats': Counter()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock nuclia", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    args = process_args()
+
+    server = serve(args.host, args.port, args)
+    logger.info(f"mock nuclia on http://{args.host}:{server.server_port}/api/v1 - "
+                f"set NUCLIA_ENDPOINT to that to use it")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
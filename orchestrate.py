@@ -0,0 +1,247 @@
+"""
+Loads several knowledgeboxes at once, one worker process per knowledgebox.
+
+The manifest lists one "<knowledgebox> <filename>" pair per line (blank lines and # comments are ignored):
+
+    Korean      data/korean_stories.json
+    Thai        data/thai_stories.json
+
+Every worker draws from the same budget: --concurrency caps the uploads in flight across all of
+them, and --rate caps the requests per second across all of them.  Progress for every box is
+logged together, and a summary per box is printed at the end.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import configuration
+import client
+import loader
+from throttle import Throttle, SharedTokenBucket
+from journal import Journal
+from metrics import Metrics
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                    datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("nuclia orchestrator")
+
+PROGRESS_INTERVAL = 10  # seconds between consolidated progress lines
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="""Load several knowledgeboxes in parallel from a manifest of
+                                                 '<knowledgebox> <filename>' lines, sharing one concurrency and rate budget""",
+                                     usage="""usage: orchestrate.py <manifest>
+                                                     --concurrency=N --rate=N --processes=N
+                                                     --upsert --no-journal
+                                                     -v"""
+                                     )
+
+    parser.add_argument("manifest",
+                        help="file listing a knowledgebox and export filename per line. "
+                             f"supported knowledgeboxes: {configuration.kb_config.keys()}",
+                        )
+
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="uploads in flight across all knowledgeboxes",
+                        default=8
+                        )
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second across all knowledgeboxes",
+                        default=None
+                        )
+
+    parser.add_argument("--processes",
+                        type=int,
+                        help="knowledgeboxes to load at the same time.  default: all of them",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--upsert",
+                        help="when a resource already exists, update it with the full content instead of skipping it",
+                        action="store_true")
+
+    parser.add_argument("--no-journal",
+                        help="upload everything, even items the journal says are already loaded and unchanged, "
+                             "and don't record outcomes",
+                        action="store_true")
+
+    parser.add_argument("-v", "--verbose",
+                        help="turn on debug, and the per item logging of each worker",
+                        action="store_true")
+
+    parser.add_argument("--fake-it",
+                        help="do everything except upload something.",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def read_manifest(filename):
+    """ the (knowledgebox, export filename) pairs in the manifest.  a knowledgebox may only be listed once -
+        two workers on one box would share its journal and failures manifest.
+    """
+    boxes = []
+    with open(filename, 'r') as filep:
+        for line in filep:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            (knowledgebox, export) = line.split(None, 1)
+            configuration.get_kb_config(knowledgebox, need_key=False)  # fail now on a typo, not half way through.
+            if any(knowledgebox == listed for (listed, _) in boxes):
+                logger.error(f"{knowledgebox} is listed more than once in {filename}")
+                raise ValueError(f"duplicate knowledgebox {knowledgebox}")
+            boxes.append((knowledgebox, export.strip()))
+
+    return boxes
+
+
+def load_box(knowledgebox, filename, options, bucket, gate, messages):
+    """ worker process: load one knowledgebox, reporting progress and the result on 'messages' """
+    if not options.verbose:
+        # the consolidated progress replaces the per item lines.
+        logging.getLogger().setLevel(logging.WARNING)
+
+    (loader.KB, loader.API_KEY) = configuration.get_kb_config(knowledgebox, need_key=not options.fake_it)
+    loader.FAKE_IT = options.fake_it
+    client.configure(pool_size=options.concurrency)
+    loader.THROTTLE = Throttle(max_concurrency=options.concurrency,
+                               max_attempts=options.retries,
+                               bucket=bucket,
+                               gate=gate)
+    loader.METRICS = Metrics("nuclia loader", labels={'knowledgebox': knowledgebox})
+
+    journal = None
+    if not options.no_journal and not options.fake_it:
+        journal = Journal(knowledgebox)
+
+    counts = {'completed': 0, 'target': 0}
+    last_report = 0.0
+
+    def progress(completed, target):
+        nonlocal last_report
+        counts['completed'] = completed
+        counts['target'] = target
+        now = time.monotonic()
+        if now - last_report >= 1:
+            messages.put(('progress', knowledgebox, completed, target))
+            last_report = now
+
+    tstart = time.monotonic()
+    try:
+        failures_filename = loader.failures_path(knowledgebox)
+        os.makedirs(os.path.dirname(os.path.abspath(failures_filename)), exist_ok=True)
+        with open(failures_filename, 'w') as failures:
+            upload_errors = loader.load_file(filename,
+                                             concurrency=options.concurrency,
+                                             journal=journal,
+                                             upsert=options.upsert,
+                                             failures=failures,
+                                             progress=progress)
+    except Exception as e:
+        logger.error(f"{knowledgebox} failed: {e}", exc_info=True)
+        messages.put(('failed', knowledgebox, f"{e.__class__.__name__}: {e}"))
+    else:
+        errors = {name: len(failed) for (name, failed) in upload_errors.items()}
+        messages.put(('done', knowledgebox, counts['completed'], errors, time.monotonic() - tstart))
+    finally:
+        if journal is not None:
+            journal.close()
+        client.close()
+
+
+def orchestrate(boxes, options):
+    bucket = SharedTokenBucket(options.rate)
+    gate = multiprocessing.BoundedSemaphore(max(options.concurrency, 1))
+    messages = multiprocessing.Queue()
+
+    waiting = list(boxes)
+    running = {}  # knowledgebox -> process
+    progress = {knowledgebox: (0, 0) for (knowledgebox, filename) in boxes}
+    summaries = {}
+    max_running = options.processes or len(boxes)
+
+    tstart = time.monotonic()
+    last_report = tstart
+    while waiting or running:
+        while waiting and len(running) < max_running:
+            (knowledgebox, filename) = waiting.pop(0)
+            logger.info(f"starting {knowledgebox} from {filename}")
+            process = multiprocessing.Process(target=load_box,
+                                              name=knowledgebox,
+                                              args=(knowledgebox, filename, options, bucket, gate, messages))
+            process.start()
+            running[knowledgebox] = process
+
+        try:
+            message = messages.get(timeout=1)
+        except queue.Empty:
+            message = None
+
+        if message is not None:
+            (kind, knowledgebox) = message[:2]
+            if kind == 'progress':
+                progress[knowledgebox] = message[2:]
+            else:
+                summaries[knowledgebox] = message
+                running.pop(knowledgebox).join()
+                logger.info(f"finished {knowledgebox}")
+
+        # a worker that died without reporting (killed, out of memory...)
+        for (knowledgebox, process) in list(running.items()):
+            if not process.is_alive() and messages.empty():
+                process.join()
+                if knowledgebox not in summaries:
+                    summaries[knowledgebox] = ('failed', knowledgebox, f"worker exited with code {process.exitcode}")
+                running.pop(knowledgebox)
+
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            completed = sum(done for (done, target) in progress.values())
+            target = sum(target for (done, target) in progress.values())
+            boxes_line = " | ".join(f"{knowledgebox} {done}/{target}"
+                                    for (knowledgebox, (done, target)) in progress.items()
+                                    if knowledgebox in running)
+            logger.info(f"{completed} of {target} | {completed / max(target, 1):.1%} complete "
+                        f"| {completed / (now - tstart):.2f} items/second | {boxes_line}")
+
+    return summaries
+
+
+def print_summary(summaries):
+    for (knowledgebox, summary) in summaries.items():
+        if summary[0] == 'done':
+            (kind, knowledgebox, completed, errors, elapsed) = summary
+            print(f"{knowledgebox}: {completed} uploaded in {elapsed:.0f}s "
+                  f"({completed / max(elapsed, 1e-6):.2f} items/second) | errors: {errors or 'none'}")
+        else:
+            print(f"{knowledgebox}: FAILED - {summary[2]}")
+
+
+if __name__ == "__main__":
+    args = process_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("debug on")
+
+    boxes = read_manifest(args.manifest)
+    summaries = orchestrate(boxes, args)
+    print_summary(summaries)
@@ -0,0 +1,254 @@
+"""
+A staged pipeline: a source feeding a chain of stages, each with its own worker threads,
+connected by bounded queues.
+
+A stage that falls behind fills the queue in front of it, and everything upstream then waits for
+room - so however big the input, at most 'depth' items wait in each queue, and the queue depths
+show which stage is holding the rest up.
+
+    pipeline = Pipeline(reader, depth=64)
+    pipeline.add_stage("preprocess", preprocess_item)
+    pipeline.add_stage("upload", upload, workers=8)
+    pipeline.run(record_result, name="journal")
+
+A stage function returns what to hand to the next stage, or None to drop the item.  The sink
+runs on the calling thread, so it sees results one at a time.
+"""
+import logging
+import queue
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger("pipeline")
+
+POLL_INTERVAL = 0.1  # seconds between checks for a failed pipeline while waiting on a queue
+
+_DONE = object()  # end of input, passed from stage to stage
+
+
+class _Aborted(Exception):
+    """ another part of the pipeline failed - give up quietly, run() raises the real error """
+
+
+class MeteredQueue(queue.Queue):
+    """ a bounded queue that keeps track of how full it gets """
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def _put(self, item):
+        # called with the queue's lock held
+        super()._put(item)
+        depth = len(self.queue)
+        self.puts += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def mean_depth(self):
+        return self.total_depth / self.puts if self.puts else 0.0
+
+
+class Stage:
+    """ one step of the pipeline and the numbers about how it is keeping up """
+
+    def __init__(self, name, func, workers=1, limit=None):
+        """
+        :param func: called with each item, returns the item for the next stage or None to drop it
+        :param workers: threads running func
+        :param limit: optional callable giving how many of the workers may be busy at once
+                      (e.g. the throttle's adaptive concurrency)
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.limit = limit
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self._busy = 0
+        self._running = 0
+        self._lock = threading.Condition()
+
+
+class Pipeline:
+
+    def __init__(self, source, depth=16, name="parse"):
+        """
+        :param source: an iterable of the items to process, read on its own thread
+        :param depth: the size of each queue between stages
+        :param name: what to call the source in the stats
+        """
+        self.source = source
+        self.depth = max(depth, 1)
+        self.source_stage = Stage(name, None)
+        self.stages = []
+        self.sink_stage = Stage("sink", None)  # the numbers for run()'s sink, on the calling thread
+        self.queues = []
+        self._stopping = threading.Event()
+        self._failed = threading.Event()
+        self._error = None
+        self._tstart = None
+
+    def add_stage(self, name, func, workers=1, limit=None):
+        self.stages.append(Stage(name, func, workers, limit))
+        return self
+
+    def stop(self):
+        """ read no more of the source.  items already in the pipeline are still finished. """
+        self._stopping.set()
+
+    @property
+    def stopped(self):
+        return self._stopping.is_set()
+
+    @property
+    def failed(self):
+        """ some stage or the sink has raised - run() is winding down to raise it """
+        return self._failed.is_set()
+
+    def run(self, sink, name="sink"):
+        """ run every stage, calling sink with each item that comes out of the last one.
+            returns once everything has been through, raising the first error any stage raised.
+        """
+        self.sink_stage.name = name
+        names = [stage.name for stage in self.stages] + [name]
+        self.queues = [MeteredQueue(queue_name, self.depth) for queue_name in names]
+        self._tstart = time.monotonic()
+
+        threads = [threading.Thread(target=self._feed, name=self.source_stage.name, daemon=True)]
+        for (n, stage) in enumerate(self.stages):
+            stage._running = stage.workers
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage, self.queues[n], self.queues[n + 1]),
+                                                name=f"{stage.name}-{worker}",
+                                                daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(self.queues[-1])
+                if item is _DONE:
+                    break
+                tstart = time.perf_counter()
+                try:
+                    with tracing.span(name, "stage"):
+                        sink(item)
+                finally:
+                    self.sink_stage.busy_seconds += time.perf_counter() - tstart
+                    self.sink_stage.processed += 1
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _fail(self, e):
+        if not self._failed.is_set():
+            self._error = e
+            self._failed.set()
+
+    # both give up once any stage has failed - not only while they wait, or the other threads would
+    # carry on through the rest of the input.
+    def _put(self, q, item):
+        while not self._failed.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise _Aborted
+
+    def _get(self, q):
+        while not self._failed.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        raise _Aborted
+
+    def _feed(self):
+        stage = self.source_stage
+        try:
+            items = iter(self.source)
+            while not self._stopping.is_set():
+                tstart = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    duration = time.perf_counter() - tstart
+                    stage.busy_seconds += duration
+                    tracing.add_span(stage.name, tstart, duration, "stage")
+                stage.processed += 1
+                self._put(self.queues[0], item)
+            self._put(self.queues[0], _DONE)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _work(self, stage, inbox, outbox):
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    self._put(inbox, _DONE)  # for this stage's other workers
+                    break
+
+                with stage._lock:
+                    while stage.limit is not None and stage._busy >= max(stage.limit(), 1):
+                        stage._lock.wait(POLL_INTERVAL)
+                    stage._busy += 1
+                tstart = time.perf_counter()
+                try:
+                    with tracing.span(stage.name, "stage"), tracing.profiled():
+                        result = stage.func(item)
+                finally:
+                    with stage._lock:
+                        stage._busy -= 1
+                        stage.busy_seconds += time.perf_counter() - tstart
+                        stage.processed += 1
+                        stage._lock.notify()
+
+                if result is not None:
+                    self._put(outbox, result)
+
+            with stage._lock:
+                stage._running -= 1
+                last = stage._running == 0
+            if last:
+                self._put(outbox, _DONE)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def depths(self):
+        """ how full each queue is right now - the one in front of the slowest stage fills up """
+        return " | ".join(f"{q.name} {q.qsize()}/{q.maxsize}" for q in self.queues)
+
+    def summary(self):
+        """ per stage, and the sink: items processed, how busy its workers were, and how deep the queue
+            in front of it got
+        """
+        elapsed = max(time.monotonic() - (self._tstart or time.monotonic()), 1e-6)
+        lines = [f"{'stage':>12} {'workers':>8} {'items':>10} {'busy':>6} {'queue mean/max':>16}"]
+        for (stage, q) in zip([self.source_stage] + self.stages + [self.sink_stage], [None] + self.queues):
+            busy = stage.busy_seconds / (elapsed * stage.workers)
+            depth = f"{q.mean_depth:.1f}/{q.max_depth}" if q is not None else "-"
+            lines.append(f"{stage.name:>12} {stage.workers:>8} {stage.processed:>10} {busy:>6.0%} {depth:>16}")
+        return "\n".join(lines)
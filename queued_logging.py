@@ -0,0 +1,126 @@
+"""
+Logging that stays out of the way of the upload loop.
+
+    queued_logging.start(sample_every=100, rollup_interval=10)
+    ...
+    queued_logging.stop()
+
+start() puts the root logger's handlers (basicConfig's stream handler) behind a queue: a log call
+on the hot path only puts the record on the queue, and a listener thread formats and writes it.
+The message isn't formatted until then either - so per item log calls pass their arguments,
+logger.info("skipping %s", uid), rather than an f-string.
+
+With sample_every, each line of code logging INFO or DEBUG only gets one in every sample_every lines
+through, and at least one every rollup_interval seconds (so periodic progress lines are all kept).
+Warnings and errors always get through, as do lines logged with extra={'sampled': False}, and every
+rollup_interval seconds a line says how many were left out, and from where.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger("logging")
+
+_listener = None
+_handler = None
+_sampler = None
+_handlers = []  # the root logger's handlers, moved behind the queue
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ a QueueHandler that leaves formatting the message to the listener's handlers.
+        the queue is in-process, so the record (and its arguments) can go on it as it is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """ let through one in every 'every' INFO and DEBUG records from each line of code,
+        and at least one every 'interval' seconds
+    """
+
+    def __init__(self, every, interval=10.0):
+        super().__init__()
+        self.every = max(int(every), 1)
+        self.interval = interval
+        self.seen = Counter()  # (pathname, lineno) -> records
+        self.left_out = Counter()  # (pathname, lineno) -> records left out since the last rollup
+        self.kept = {}  # (pathname, lineno) -> when a record was last let through
+        self.messages = {}  # (pathname, lineno) -> the latest message left out, for the rollup
+        self._lock = threading.Lock()
+        self._last_rollup = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, 'sampled', True):
+            return True
+
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            keep = self.seen[site] % self.every == 0 or now - self.kept.get(site, 0) >= self.interval
+            self.seen[site] += 1
+            if keep:
+                self.kept[site] = now
+            else:
+                self.left_out[site] += 1
+                self.messages[site] = record.msg
+            due = now - self._last_rollup >= self.interval
+
+        if due:
+            self.rollup()
+        return keep
+
+    def rollup(self):
+        """ log how many lines were left out since the last rollup, from where """
+        with self._lock:
+            (left_out, self.left_out) = (self.left_out, Counter())
+            self._last_rollup = time.monotonic()
+        if not left_out:
+            return
+        sites = "; ".join(f"{n} from {os.path.basename(path)}:{lineno} ({str(self.messages[(path, lineno)])[:60]!r})"
+                          for ((path, lineno), n) in left_out.most_common())
+        logger.info(f"left out {sum(left_out.values())} log lines: {sites}", extra={'sampled': False})
+
+
+def start(sample_every=None, rollup_interval=10.0):
+    """ move the root logger's handlers behind a queue and a listener thread, sampling if sample_every is given """
+    global _listener, _handler, _sampler, _handlers
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    _handlers = root.handlers[:]
+    records = queue.SimpleQueue()
+    _handler = LazyQueueHandler(records)
+    if sample_every and sample_every > 1:
+        _sampler = SampleFilter(sample_every, rollup_interval)
+        _handler.addFilter(_sampler)
+
+    for handler in _handlers:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    _listener = logging.handlers.QueueListener(records, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """ write out everything still queued (and the last rollup), and put the handlers back """
+    global _listener, _handler, _sampler
+    if _listener is None:
+        return
+
+    if _sampler is not None:
+        _sampler.rollup()
+    _listener.stop()
+
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    for handler in _handlers:
+        root.addHandler(handler)
+    (_listener, _handler, _sampler) = (None, None, None)
@@ -3,19 +3,26 @@ the objects in a non-published state.
 
 This goes through and finds those items, and deletes them.
 
+Deletes run concurrently (--concurrency), by resource id when the loader's journal knows it
+and by slug otherwise.  With --from-journal the export isn't parsed at all: the export's index
+(see indexer.py) lists the unpublished UIDs, and only those the journal says were loaded are
+read back and deleted.
 """
 import argparse
 import logging
-import time
-import ijson
-from datetime import datetime, timedelta
 
-from nuclia import sdk
-from nucliadb_sdk.v2 import exceptions
-from configuration import API_KEY
-from configuration import KB
-from configuration import cloud_endpoint
-from validator import validate
+import configuration
+import client
+from throttle import Throttle, http_status
+from validator import open_export
+from story import StoryRecord, DELETE_FIELDS
+from journal import Journal, DELETED
+from resource_cache import ResourceCache
+from indexer import get_index, find_items
+from pipeline import Pipeline
+import tracing
+import queued_logging
+from metrics import Metrics
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
@@ -23,74 +30,199 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger("private item deleter")
 
+#Globals
+FAKE_IT = False #global override for debugging and not actually deleting.
+KB = None #set during argparse
+API_KEY = None #set during argparse
+THROTTLE = Throttle() #rate limit and retry policy for requests, replaced during argparse
+METRICS = Metrics("private item deleter") #progress and request latencies, replaced during argparse
+
 
 def process_args():
     parser = argparse.ArgumentParser(description="""Provide a plone export file.
     walk through all objects, and delete resources that are found to be non-published.
     """,
-                                     usage="usage: remove_privates.py <filename>")
+                                     usage="""usage: remove_privates.py <knowledgebox> <filename>
+                                              --concurrency=N --rate=N --retries=N --parse-workers=N
+                                              --from-journal --no-journal --cache""")
+    parser.add_argument("knowledgebox",
+                        help="language name for knowledgebox."
+                             f"supported: {configuration.kb_config.keys()}",
+                        )
+
     parser.add_argument("filename",
                         help="filename of json export",
                         )
 
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="number of deletes to keep in flight at once",
+                        default=1
+                        )
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second to send to nuclia",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--parse-workers",
+                        type=int,
+                        help="processes parsing the export, a shard of the file each",
+                        default=1
+                        )
+
+    parser.add_argument("--from-journal",
+                        help="only delete the unpublished items the journal says were loaded, "
+                             "finding them through the export's index instead of parsing the whole export",
+                        action="store_true")
+
+    parser.add_argument("--no-journal",
+                        help="don't use the journal's resource ids, and don't record the deletions",
+                        action="store_true")
+
+    parser.add_argument("--cache",
+                        help="delete by the resource ids in the local resource cache (see resource_cache.py) "
+                             "when the journal doesn't have them, and forget the deleted resources",
+                        action="store_true")
+
+    parser.add_argument("--metrics-out",
+                        help="keep progress and request latency metrics in this file: "
+                             "a prometheus textfile if it ends in .prom, otherwise json",
+                        default=None
+                        )
+
+    parser.add_argument("--report-interval",
+                        type=float,
+                        help="seconds between progress lines (and metrics file updates)",
+                        default=10
+                        )
+
+    parser.add_argument("--trace-out",
+                        help="record how long each request takes to this file in chrome trace format",
+                        default=None
+                        )
+
+    parser.add_argument("--log-every",
+                        type=int,
+                        help="log through a background thread, and only one in every N of each per item line "
+                             "(warnings and errors always), with a count of those left out every --report-interval",
+                        default=None
+                        )
+
     parser.add_argument("-v", "--verbose",
                         help="turn on debug",
                         action="store_true")
 
+    parser.add_argument("--fake-it",
+                        help="do everything except delete something.",
+                        action="store_true")
+
     parsed_args = parser.parse_args()
 
     return parsed_args
 
 
-def remove_privates(filename):
-
-    logger.info(f"counting objects in {filename}")
-    (total_objects, unpublished, errors) = validate(filename)
-    logger.info(f"{unpublished} unpublished objects out of {total_objects} objects")
-
-    with open(filename, 'r') as filep:
-        # stream it from json into objects one item at a time
-        objects = ijson.items(filep, 'item')
-        uri = f"{cloud_endpoint}/kb/{KB}"
-        res = sdk.NucliaResource()
-
-        deleted = 0
-        processed = 0
-        not_found = 0
-
-        tstart = time.monotonic()
-        average_duration = 0.0001  # a guess
-        for item in objects:
-            # If the item is not public...
-            if "@id" in item and item.get('review_state') != "published":
-                logger.info(f"removing '{item.get('review_state')}' item {item['@id']} {item['UID']} ")
-
-                try:
-                    res.delete(url=uri,
-                               api_key=API_KEY,
-                               slug=item['UID'])
-                    pass
-                except exceptions.NotFoundError:
-                    logger.warning(f"slug {item['UID']} not found.")
-                    not_found += 1
-                else:
-                    deleted += 1
-
-            processed += 1
-
-            # occasional logging:
-            if processed % 50 == 0:
-                remaining_time = (total_objects-processed) * average_duration
-                logger.info(f"{processed/total_objects:.1%} ETA: {remaining_time:.0f} seconds |" +
-                            f"{(datetime.now()+timedelta(seconds=remaining_time)).strftime('%Y-%m-%d %X')}")
-
-            # figure out the estimated time to completion.
-            tend = time.monotonic()
-            duration = tend-tstart
-            average_duration = average_duration + ((duration-average_duration)/processed)
-            tstart = tend  # next loop iteration start time is this loop iteration end time.
-
-        logger.info(f"complete.  Deleted {deleted} objects out of {unpublished} with {not_found} not found")
+def journaled_privates(filename, journal):
+    """ the unpublished items in the export that the journal says are in the knowledgebox """
+    unpublished = set(get_index(filename)['unpublished'])
+    uids = [uid for uid in journal.committed_uids() if uid in unpublished]
+    logger.info(f"{len(uids)} of {len(unpublished)} unpublished objects were loaded according to the journal")
+    METRICS.target = len(uids)
+    return find_items(filename, uids=uids)
+
+
+def exported_privates(filename, journal=None, parse_workers=1):
+    """ the unpublished items in the export, skipping any the journal has already seen deleted """
+    reader = open_export(filename, fields=DELETE_FIELDS, workers=parse_workers)
+    if reader.exact is not None:
+        logger.info(f"{reader.exact[1]} unpublished objects out of {reader.total_objects} objects")
+    skipped = 0
+    METRICS.target = lambda: (reader.exact[1] if reader.exact is not None else reader.unpublished) - skipped
+
+    for item in reader:
+        # If the item is not public...
+        if "@id" in item and item.get('review_state') != "published":
+            if journal is not None and journal.latest.get(item['UID']) == DELETED:
+                logger.debug("skipping: %s already deleted according to the journal", item['UID'])
+                skipped += 1
+                continue
+            yield item
+
+
+def remove_privates(filename, concurrency=1, journal=None, from_journal=False, cache=None, parse_workers=1):
+    if from_journal:
+        items = journaled_privates(filename, journal)
+    else:
+        items = exported_privates(filename, journal, parse_workers)
+
+    deleted = 0
+    not_found = 0
+    failed = 0
+
+    def prepare(item):
+        record = StoryRecord.for_delete(item)
+        if journal is not None:
+            record.rid = journal.rid(record.uid)
+        if cache is not None and record.rid is None:
+            record.rid = cache.rid(record.uid)
+        return record
+
+    def delete(record):
+        try:
+            delete_one(record)
+        except Exception as e:
+            return (record, e)
+        return (record, None)
+
+    def finish(result):
+        nonlocal deleted, not_found, failed
+        (record, error) = result
+        if error is not None and http_status(error) == 404:
+            logger.warning("slug %s not found.", record.uid)
+            not_found += 1
+            METRICS.complete("not found")
+        elif error is not None:
+            logger.error(f"could not delete {record.uid}: {error}", exc_info=error)
+            failed += 1
+            METRICS.complete(error.__class__.__name__)
+            return
+        else:
+            deleted += 1
+            METRICS.complete("deleted")
+        if journal is not None and not FAKE_IT:
+            journal.record(record.uid, record.url, DELETED)
+        if cache is not None and not FAKE_IT:
+            cache.remove(record.uid)
+
+    concurrency = max(concurrency, 1)
+    pipeline = Pipeline(items, depth=max(2 * concurrency, 16))
+    pipeline.add_stage("preprocess", prepare)
+    pipeline.add_stage("delete", delete, workers=concurrency, limit=lambda: THROTTLE.limit)
+    pipeline.run(finish, name="journal")
+
+    METRICS.close()
+    logger.info(f"complete.  Deleted {deleted} objects with {not_found} not found and {failed} failed")
+
+
+def delete_one(record):
+    logger.info("removing %s %s", record.url, record.uid)
+    if not FAKE_IT:
+        from nuclia import sdk  # not until the first request - a faked run never needs it
+
+        with METRICS.timer("delete"):
+            THROTTLE.call(sdk.NucliaResource().delete,
+                          ndb=client.get_client(KB, API_KEY),
+                          **record.delete_payload())
+    else:
+        logger.warning("Faked request - delete did not occur")
+
 
 if __name__ == "__main__":
     args = process_args()
@@ -98,6 +230,40 @@ if __name__ == "__main__":
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("debug on")
+    if args.log_every:
+        queued_logging.start(args.log_every, args.report_interval)
+
+    if args.fake_it:
+        FAKE_IT = True  #global
+
+    if args.from_journal and args.no_journal:
+        logger.error("--from-journal needs the journal")
+        raise ValueError
+
+    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox, need_key=not FAKE_IT)
+    tracing.enable(args.trace_out)
+    METRICS = Metrics("private item deleter",
+                      interval=args.report_interval,
+                      export=args.metrics_out,
+                      labels={'knowledgebox': args.knowledgebox})
+    client.configure(pool_size=args.concurrency)
+    THROTTLE = Throttle(max_concurrency=args.concurrency,
+                        rate=args.rate,
+                        max_attempts=args.retries)
+
+    journal = None
+    if not args.no_journal:
+        journal = Journal(args.knowledgebox)
+    cache = None
+    if args.cache:
+        cache = ResourceCache(KB)
 
-    remove_privates(args.filename)
+    remove_privates(args.filename, args.concurrency, journal, args.from_journal, cache, args.parse_workers)
 
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.close()
+    client.close()
+    tracing.close()
+    queued_logging.stop()
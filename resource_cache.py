@@ -0,0 +1,241 @@
+"""
+A local copy of what is in each knowledgebox: for every slug (the plone UID), the nuclia resource
+id, when the resource was last modified, and the content hash of what we last sent for it.
+
+The loader fills it in as it creates and updates resources (with --cache), and a sync pages through
+the knowledgebox's catalog to bootstrap it, or to catch up with changes made elsewhere:
+
+    python resource_cache.py <knowledgebox> --page-size=200
+
+With it, the tools skip items that are already loaded and unchanged without asking nuclia, address
+resources by rid rather than having nuclia look their slugs up, and can work out what differs
+between an export and the knowledgebox offline.
+
+Everything lives in one sqlite file under cache/, keyed by knowledgebox id and slug.
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import configuration
+import client
+from throttle import Throttle
+
+logger = logging.getLogger("resource cache")
+
+CACHE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "resources.sqlite")
+PAGE_SIZE = 200
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="""sync the local resource cache with a knowledgebox:
+                                                   page through its catalog, recording every resource's slug, id
+                                                   and modification time, and forget resources that are gone""",
+                                     usage="usage: resource_cache.py <knowledgebox> --page-size=N --rate=N --retries=N")
+    parser.add_argument("knowledgebox",
+                        help="language name for knowledgebox."
+                             f"supported: {configuration.kb_config.keys()}",
+                        )
+
+    parser.add_argument("--page-size",
+                        type=int,
+                        help="resources per catalog page",
+                        default=PAGE_SIZE
+                        )
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second to send to nuclia",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--cache-file",
+                        help="the sqlite file to sync.  default: cache/resources.sqlite",
+                        default=None
+                        )
+
+    parser.add_argument("-v", "--verbose",
+                        help="turn on debug",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+class ResourceCache:
+
+    def __init__(self, kb, filename=None):
+        """
+        :param kb: the knowledgebox id (not its language name) - the cache is shared by all of them
+        :param filename: the sqlite file, by default cache/resources.sqlite
+        """
+        self.kb = kb
+        self.filename = filename or CACHE_FILENAME
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS resources (
+                                kb TEXT NOT NULL,
+                                slug TEXT NOT NULL,
+                                rid TEXT NOT NULL,
+                                modified REAL,
+                                hash TEXT,
+                                PRIMARY KEY (kb, slug)
+                            )""")
+
+        # slug -> (rid, modified, hash) for this knowledgebox, so lookups don't touch the database.
+        self.entries = {slug: (rid, modified, digest)
+                        for (slug, rid, modified, digest)
+                        in self._db.execute("SELECT slug, rid, modified, hash FROM resources WHERE kb = ?", (kb,))}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def exists(self, slug):
+        """ True if the resource for this slug is known to be in the knowledgebox """
+        return slug in self.entries
+
+    def rid(self, slug):
+        """ the nuclia resource id for this slug, if we know it """
+        entry = self.entries.get(slug)
+        return entry[0] if entry is not None else None
+
+    def unchanged(self, slug, digest):
+        """ True if the resource for this slug exists and was last sent with this content hash """
+        entry = self.entries.get(slug)
+        return entry is not None and digest is not None and entry[2] == digest
+
+    def slugs(self):
+        return list(self.entries)
+
+    def _entry(self, slug, rid, modified, digest):
+        old = self.entries.get(slug)
+        if digest is None and old is not None and old[0] == rid:
+            # same resource, content we didn't send - keep the hash of what we did send.
+            digest = old[2]
+        return (rid, modified, digest)
+
+    def put(self, slug, rid, modified=None, digest=None):
+        """ record that the resource for this slug is in the knowledgebox as 'rid'.
+            modified defaults to now, and digest (the content hash sent) to the one already cached.
+        """
+        if rid is None:
+            return
+        self.put_many([(slug, rid, modified, digest)])
+
+    def put_many(self, entries):
+        """ put() a batch of (slug, rid, modified, digest) in one transaction """
+        now = time.time()
+        with self._lock:
+            rows = []
+            for (slug, rid, modified, digest) in entries:
+                entry = self._entry(slug, rid, modified if modified is not None else now, digest)
+                self.entries[slug] = entry
+                rows.append((self.kb, slug) + entry)
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO resources (kb, slug, rid, modified, hash) "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def remove(self, slug):
+        """ forget the resource for this slug - it has been deleted """
+        self.remove_many([slug])
+
+    def remove_many(self, slugs):
+        with self._lock:
+            slugs = [slug for slug in slugs if self.entries.pop(slug, None) is not None]
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("DELETE FROM resources WHERE kb = ? AND slug = ?",
+                                     [(self.kb, slug) for slug in slugs])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def catalog_pages(kb, api_key, page_size=PAGE_SIZE, throttle=None):
+    """ yield every page of the knowledgebox's catalog, from the first """
+    from nuclia import sdk
+    from nucliadb_models.search import CatalogRequest, ResourceProperties
+
+    page_number = 0
+    while True:
+        request = CatalogRequest(page_number=page_number,
+                                 page_size=page_size,
+                                 show=[ResourceProperties.BASIC])
+        search = sdk.NucliaKB().search
+        if throttle is not None:
+            results = throttle.call(search.catalog, ndb=client.get_client(kb, api_key), query=request)
+        else:
+            results = search.catalog(ndb=client.get_client(kb, api_key), query=request)
+        yield results
+        if results.fulltext is None or not results.fulltext.next_page:
+            return
+        page_number += 1
+
+
+def sync(cache, api_key, page_size=PAGE_SIZE, throttle=None):
+    """ bring the cache up to date with the knowledgebox's catalog.
+        returns (resources in the knowledgebox, cached resources that are gone and were forgotten)
+    """
+    seen = set()
+    pages = 0
+    for results in catalog_pages(cache.kb, api_key, page_size, throttle):
+        entries = []
+        for (rid, resource) in results.resources.items():
+            if not resource.slug:
+                continue
+            modified = resource.modified.timestamp() if resource.modified is not None else None
+            entries.append((resource.slug, rid, modified, None))
+            seen.add(resource.slug)
+        cache.put_many(entries)
+        pages += 1
+        if pages % 10 == 0:
+            logger.info(f"{len(seen)} resources on {pages} pages")
+
+    gone = [slug for slug in cache.slugs() if slug not in seen]
+    cache.remove_many(gone)
+    return (len(seen), len(gone))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+    args = process_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("debug on")
+
+    (KB, API_KEY) = configuration.get_kb_config(args.knowledgebox)
+    throttle = Throttle(rate=args.rate, max_attempts=args.retries)
+
+    with ResourceCache(KB, args.cache_file) as cache:
+        before = len(cache)
+        (found, gone) = sync(cache, API_KEY, args.page_size, throttle)
+        logger.info(f"{found} resources in the {args.knowledgebox} knowledgebox "
+                    f"({found - before + gone:+d} new, {gone} gone) cached in {cache.filename}")
+
+    client.close()
@@ -0,0 +1,148 @@
+"""
+Replays the failure manifest written by loader.py, re-uploading only the items that failed.
+
+The items are pulled straight out of the export through its index (see indexer.py),
+uploaded concurrently like loader.py does, and whatever still fails is written to a new manifest.
+"""
+import argparse
+import json
+import logging
+import os
+
+import configuration
+import client
+import loader
+from throttle import Throttle
+from journal import Journal
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(levelname)s:%(asctime)s:%(name)s:%(message)s',
+                    datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("nuclia retry")
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="""Retry the uploads listed in a failure manifest from loader.py.
+                                                 conflicts (items that already exist) are only retried with --upsert""",
+                                     usage="""usage: retry.py <knowledgebox> <manifest> <filename>
+                                                     --concurrency=N --upsert
+                                                     --failures=<manifest.jsonl>
+                                                     -v"""
+                                     )
+
+    parser.add_argument("knowledgebox",
+                        help="language name for knowledgebox."
+                             f"supported: {configuration.kb_config.keys()}",
+                        )
+
+    parser.add_argument("manifest",
+                        help="failure manifest written by loader.py",
+                        )
+
+    parser.add_argument("filename",
+                        help="filename of the json export the failures came from",
+                        )
+
+    parser.add_argument("--concurrency",
+                        type=int,
+                        help="number of uploads to keep in flight at once",
+                        default=1
+                        )
+
+    parser.add_argument("--upsert",
+                        help="update resources that already exist instead of skipping them",
+                        action="store_true")
+
+    parser.add_argument("--rate",
+                        type=float,
+                        help="maximum requests per second to send to nuclia",
+                        default=None
+                        )
+
+    parser.add_argument("--retries",
+                        type=int,
+                        help="attempts per request before giving up on rate limits, server errors and dropped connections",
+                        default=5
+                        )
+
+    parser.add_argument("--failures",
+                        help="where to write the manifest of items that still fail. "
+                             "default: errors/<knowledgebox>_failures.jsonl",
+                        default=None
+                        )
+
+    parser.add_argument("--no-journal",
+                        help="don't record outcomes in the journal",
+                        action="store_true")
+
+    parser.add_argument("-v", "--verbose",
+                        help="turn on debug",
+                        action="store_true")
+
+    parser.add_argument("--fake-it",
+                        help="do everything except upload something.",
+                        action="store_true")
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def read_manifest(filename, upsert=False):
+    """ the UIDs to retry from a failure manifest, and the lines of the ones left alone
+        (the conflicts, without upsert) - for the new manifest, so a later --upsert run still has them.
+    """
+    uids = []
+    kept = []
+    with open(filename, 'r') as filep:
+        for line in filep:
+            if not line.strip():
+                continue
+            failure = json.loads(line)
+            if failure['exception'] == 'ConflictError' and not upsert:
+                kept.append(line if line.endswith("\n") else line + "\n")
+                continue
+            uids.append(failure['UID'])
+
+    if kept:
+        logger.info(f"leaving {len(kept)} conflicts alone - use --upsert to update them")
+
+    return (uids, kept)
+
+
+if __name__ == "__main__":
+    args = process_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("debug on")
+
+    # read it all before the new manifest (which may be the same file) is opened.
+    (uids, kept) = read_manifest(args.manifest, args.upsert)
+    logger.info(f"retrying {len(uids)} items from {args.manifest}")
+
+    (loader.KB, loader.API_KEY) = configuration.get_kb_config(args.knowledgebox, need_key=not args.fake_it)
+    loader.FAKE_IT = args.fake_it
+    client.configure(pool_size=args.concurrency)
+    loader.THROTTLE = Throttle(max_concurrency=args.concurrency,
+                               rate=args.rate,
+                               max_attempts=args.retries)
+
+    journal = None
+    if not args.no_journal and not args.fake_it:
+        journal = Journal(args.knowledgebox)
+
+    failures_filename = args.failures or loader.failures_path(args.knowledgebox)
+    os.makedirs(os.path.dirname(os.path.abspath(failures_filename)), exist_ok=True)
+    with open(failures_filename, 'w') as failures:
+        failures.writelines(kept)
+        loader.load_ids(item_uids=uids,
+                        filename=args.filename,
+                        journal=journal,
+                        upsert=args.upsert,
+                        concurrency=args.concurrency,
+                        failures=failures)
+
+    if journal is not None:
+        journal.close()
+    client.close()
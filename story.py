@@ -0,0 +1,223 @@
+"""
+The stories we send to nuclia, as compact records instead of whole plone items.
+
+preprocess_item() turns a plone export item into a StoryRecord holding only what we upload:
+the published url (test and dev hosts rewritten), cleaned subjects, language and language service
+(inferred from the url), body text and thumbnail.  The regular expressions are compiled once and
+the language lookups are cached per host and section, since an export only has a handful of each.
+
+The record builds the payloads for every request the tools make about it - create, full update,
+the origin-only patch the editor sends and the remover's delete - so they all serialise a story the same way.
+"""
+import hashlib
+import json
+import re
+from functools import lru_cache
+
+LANGUAGES = {'english': 'en',
+             'korean': 'kr',
+             'vietnamese': 'vi',
+             'burmese': 'my',
+             'tibetan': 'bo',
+             'khmer': 'km',
+             'uyghur': 'ug',
+             'mandarin': 'zh-cn',
+             'cantonese': 'zh-yue',
+             'lao': 'lo',
+             'indonesian': 'id',
+             'bengali': 'bn',
+             'malay': 'ms-zsm',
+             'thai': 'th'
+             }
+
+LANGUAGE_LABELS = {'burmese': "Burmese",
+                   'cantonese': "Cantonese",
+                   'english': "English RFA",
+                   'khmer': "Khmer",
+                   'korean': "Korean",
+                   'lao': "Lao",
+                   'mandarin': "Mandarin",
+                   'tibetan': "Tibetan",
+                   'uyghur': "Uyghur",
+                   'vietnamese': "Vietnamese",
+                   'bengali': "Bengali",
+                   'english-benar': "English BenarNews",
+                   'indonesian': "Indonesian",
+                   'malay': "Malay",
+                   'thai': "Thai"
+                   }
+
+# the fields of a plone item that preprocess_item uses - everything else can be dropped while reading.
+PREPROCESS_FIELDS = ('@id', 'UID', 'title', 'description', 'subjects', 'text', 'effective', 'modified', 'created',
+                     'image', 'p4_image', 'review_state')
+
+# the fields StoryRecord.for_delete uses, and the review_state that picks out unpublished items - which can lack the rest.
+DELETE_FIELDS = ('@id', 'UID', 'review_state')
+
+THUMBNAIL_SUFFIX = "/@@images/image/image_thumb_tablet"
+
+# point ids at the published sites, not a test or dev uri
+rfa_pattern = re.compile(r".*\.rfaweb.org")
+benar_pattern = re.compile(r"https://.*\.benarnews.org")
+
+
+class StoryRecord:
+    """ one story, holding just the fields we send to nuclia """
+
+    __slots__ = ('uid', 'url', 'title', 'description', 'subjects', 'text', 'effective', 'modified', 'created',
+                 'thumbnail', 'language', 'language_title', 'language_service', 'content_hash', 'rid')
+
+    def __init__(self, uid, url, title, description, subjects, text, effective, modified, created,
+                 thumbnail, language, language_title, language_service):
+        self.uid = uid
+        self.url = url
+        self.title = title
+        self.description = description
+        self.subjects = subjects
+        self.text = text
+        self.effective = effective
+        self.modified = modified
+        self.created = created
+        self.thumbnail = thumbnail
+        self.language = language
+        self.language_title = language_title
+        self.language_service = language_service
+        self.content_hash = None  # set by the loader
+        self.rid = None  # the nuclia resource id, once known
+
+    @classmethod
+    def for_delete(cls, item):
+        """ the StoryRecord for deleting an export item - only its UID and @id are needed, or used """
+        return cls(uid=item['UID'], url=published_url(item['@id']), title=None, description=None, subjects=[],
+                   text="", effective=None, modified=None, created=None, thumbnail=None, language=None,
+                   language_title=None, language_service=None)
+
+    def __repr__(self):
+        return f"<StoryRecord {self.uid} {self.url}>"
+
+    def resource_fields(self):
+        """ every resource field we send to nuclia for this story """
+        return dict(
+            title=self.title,
+            metadata={
+                "language": self.language,
+            },
+            usermetadata={
+                "classifications": [
+                    {"labelset": "Language Service", "label": self.language_service},
+                ],
+            },
+            origin=self.origin(),
+            extra=self.extra(),
+            summary=self.description,
+            texts={
+                "body": {
+                    "body": self.text,
+                    "format": "HTML",
+                }
+            },
+        )
+
+    def origin(self):
+        return {
+            "url": self.url,
+            "tags": self.subjects,
+            "created": self.effective,
+            "modified": self.modified,
+            # "metadata": {"thumbnail": self.thumbnail}
+        }
+
+    def extra(self):
+        return {"metadata": {"thumbnail": self.thumbnail}}
+
+    def create_payload(self):
+        """ keyword arguments for NucliaResource.create - the slug is the plone UID """
+        return dict(slug=self.uid, **self.resource_fields())
+
+    def address(self):
+        """ which resource to update or delete - by rid if we know it, saving nuclia a slug lookup """
+        if self.rid is not None:
+            return dict(rid=self.rid)
+        return dict(slug=self.uid)
+
+    def update_payload(self):
+        """ keyword arguments for NucliaResource.update, replacing all of the resource's content """
+        return dict(**self.address(), **self.resource_fields())
+
+    def origin_payload(self):
+        """ keyword arguments for NucliaResource.update, fixing only the origin and thumbnail """
+        return dict(**self.address(), origin=self.origin(), extra=self.extra())
+
+    def delete_payload(self):
+        """ keyword arguments for NucliaResource.delete """
+        return self.address()
+
+
+def content_hash(record):
+    """ a stable hash of everything we send to nuclia for a StoryRecord,
+        so we can tell whether it changed since it was last loaded.
+    """
+    payload = json.dumps(record.resource_fields(), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def published_url(url):
+    if 'rfaweb' in url:
+        url = rfa_pattern.sub("https://www.rfa.org", url)
+    if 'benarnews' in url:
+        url = benar_pattern.sub("https://www.benarnews.org", url)
+    return url
+
+
+@lru_cache(maxsize=256)
+def language_for(netloc, section):
+    """ (language code, language title, language service label) for a site and its first path segment """
+    language_service = LANGUAGE_LABELS.get(section, 'unknown')
+    if section == 'english' and 'benar' in netloc:
+        language_service = "English BenarNews"
+    return (LANGUAGES.get(section, "en"), section.capitalize(), language_service)
+
+
+def preprocess_item(item):
+    """ the StoryRecord for a plone export item """
+    url = published_url(item['@id'])
+
+    # set description to None if it's blank:
+    description = item['description']
+    if not description or description.isspace():
+        description = None
+
+    # clean the whitespace crap out of subjects:
+    subjects = [tag for tag in item['subjects'] if (tag and not tag.isspace())]
+
+    # language must be inferred from URL: https://<netloc>/<section>/...
+    (scheme, _, netloc_and_path) = url.partition('//')
+    (netloc, _, path) = netloc_and_path.partition('/')
+    section = path.split('/', 1)[0].split('?', 1)[0].split('#', 1)[0]
+    (language, language_title, language_service) = language_for(netloc, section)
+
+    # Some stories have no text!
+    text = item['text']['data'] if item['text'] is not None else ""
+
+    # set the thumbnail URL.
+    # (a featured_image used to be picked up here too, but was always replaced by one of these.)
+    if item['image'] is not None:
+        thumbnail = url + THUMBNAIL_SUFFIX
+    elif item.get('p4_image') is not None:
+        thumbnail = published_url(item['p4_image']['@id'] + THUMBNAIL_SUFFIX)
+    else:
+        thumbnail = None
+
+    return StoryRecord(uid=item['UID'],
+                       url=url,
+                       title=item['title'],
+                       description=description,
+                       subjects=subjects,
+                       text=text,
+                       effective=item['effective'],
+                       modified=item['modified'],
+                       created=item['created'],
+                       thumbnail=thumbnail,
+                       language=language,
+                       language_title=language_title,
+                       language_service=language_service)
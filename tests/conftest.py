@@ -0,0 +1,36 @@
+import json
+import os
+import sys
+
+import pytest
+
+# the tools are top level scripts, imported by module name.
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+SAMPLE = os.path.join(os.path.dirname(HERE), "data", "sample.json")
+
+
+def story(n, review_state="published", **fields):
+    """ a plone export item, made from one of the sample stories """
+    with open(SAMPLE, 'r') as filep:
+        samples = [item for item in json.load(filep) if '@id' in item]
+    item = dict(samples[n % len(samples)])
+    item['UID'] = f"uid{n:05d}"
+    item['@id'] = f"{item['@id'].rsplit('.html', 1)[0]}-{n}.html"
+    item['review_state'] = review_state
+    item.update(fields)
+    return item
+
+
+def write_export(filename, items, indent=None):
+    """ write items as a plone export, with the error report plone puts at the end """
+    with open(filename, 'w') as filep:
+        json.dump(list(items) + [{"unexported_paths": []}], filep, indent=indent)
+    return str(filename)
+
+
+@pytest.fixture
+def export(tmp_path):
+    """ write_export into the test's temporary directory """
+    return lambda items, name="export.json", indent=None: write_export(tmp_path / name, items, indent)
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import delta
+from conftest import story
+from validator import ExportReader
+
+
+def before(item):
+    """ the baseline row for an item of the older export """
+    return (delta.published(item), *delta.fingerprint(item))
+
+
+def test_classify():
+    old = story(1)
+
+    assert delta.classify(story(1), None) == delta.ADDED
+    assert delta.classify(story(1), before(story(1, review_state="private"))) == delta.ADDED
+    assert delta.classify(story(1, review_state="private"), None) is None
+    assert delta.classify(story(1), before(old)) is None
+    assert delta.classify(story(1, modified="2030-01-01T00:00:00+00:00"), before(old)) == delta.CHANGED
+    assert delta.classify(story(1, title="a new title"), before(old)) == delta.CHANGED
+    assert delta.classify(story(1, review_state="private"), before(old)) == delta.UNPUBLISHED
+    assert delta.classify(story(1, review_state="private"), before(story(1, review_state="private"))) is None
+
+
+@pytest.mark.parametrize("name", ["delta.json", "delta.json.gz"])
+def test_make_delta(export, tmp_path, name):
+    old = [story(n, review_state="private" if n >= 16 else "published") for n in range(20)]
+    new = ([story(n) for n in range(0, 4)]  # the same
+           + [story(n, title=f"changed {n}") for n in range(4, 8)]
+           + [story(n, review_state="private") for n in range(8, 10)]
+           # 10 to 12 are gone
+           + [story(n) for n in range(12, 16)]
+           + [story(n) for n in range(16, 18)]  # published at last
+           + [story(n) for n in range(20, 23)])  # new
+
+    counts = delta.make_delta(export(old, "old.json"), export(new, "new.json"), str(tmp_path / name))
+
+    assert counts == {delta.ADDED: 5, delta.CHANGED: 4, delta.UNPUBLISHED: 2, delta.REMOVED: 2}
+    kinds = {item['UID']: (item[delta.DELTA_FIELD], item['review_state']) for item in ExportReader(str(tmp_path / name))}
+    assert kinds == {**{f"uid{n:05d}": (delta.CHANGED, "published") for n in range(4, 8)},
+                     **{f"uid{n:05d}": (delta.UNPUBLISHED, "private") for n in range(8, 10)},
+                     **{f"uid{n:05d}": (delta.REMOVED, delta.REMOVED_STATE) for n in range(10, 12)},
+                     **{f"uid{n:05d}": (delta.ADDED, "published") for n in (16, 17, 20, 21, 22)}}
+
+
+def test_no_changes(export, tmp_path):
+    items = [story(n) for n in range(5)]
+
+    counts = delta.make_delta(export(items, "old.json"), export(items, "new.json"), str(tmp_path / "delta.json"))
+
+    assert sum(counts.values()) == 0
+    with open(tmp_path / "delta.json") as filep:
+        assert json.load(filep) == []
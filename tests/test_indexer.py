@@ -0,0 +1,103 @@
+import gzip
+import io
+import json
+import shutil
+
+import pytest
+
+import indexer
+from conftest import story
+from validator import ExportReader, ShardedReader
+
+
+def audio(n, count=3):
+    """ an item's list of related objects - each with an @id and a UID, like an item's own """
+    return [{"@id": f"http://www.rfa.org/audio/{n}-{k}.mp3", "UID": f"audio{n:05d}{k}", "title": "a, {b} [c] \"d\""}
+            for k in range(count)]
+
+
+def stories(count):
+    return [story(n, p4_audio=audio(n), title=f"한 {n} \"quoted\" [{n}] {{x}}") for n in range(count)]
+
+
+@pytest.fixture
+def items_export(export):
+    return export(stories(20))
+
+
+def item_starts(buf):
+    """ where each story starts - not the error report at the end """
+    return [offset for (offset, length) in indexer.scan_items(buf)][:-1]
+
+
+@pytest.mark.parametrize("chunk_size", [61, 1000, 1024 * 1024])
+def test_scan_stream_across_chunks(items_export, chunk_size):
+    with open(items_export, 'rb') as filep:
+        buf = filep.read()
+
+    scanned = list(indexer.scan_stream(io.BytesIO(buf), chunk_size=chunk_size))
+
+    assert [(offset, len(data)) for (offset, data) in scanned] == list(indexer.scan_items(buf))
+    assert [json.loads(data)['UID'] for (offset, data) in scanned[:-1]] == [f"uid{n:05d}" for n in range(20)]
+
+
+def test_object_at_grows_the_window():
+    value = {"text": "x" * 100, "more": [1, 22, 333], "flags": [True, False, None], "escaped": "é\\\""}
+    buf = json.dumps(value).encode('utf-8')
+
+    for window in range(1, len(buf) + 1):
+        assert indexer.object_at(buf, 0, window=window) == value
+
+
+def test_object_at_inside_a_string():
+    buf = b'[{"title": "a, {b} c", "x": 1}]'
+
+    assert indexer.object_at(buf, buf.index(b'{b')) is None
+
+
+def test_next_item_skips_nested_objects(items_export):
+    with open(items_export, 'rb') as filep:
+        buf = filep.read()
+    starts = item_starts(buf)
+    assert buf.count(b'"@id"') > 3 * len(starts)  # there are nested objects that look like items
+
+    for start in range(1, len(buf), 101):
+        expected = [offset for offset in starts[1:] if buf.rindex(b',', 0, offset) >= start]
+        assert indexer.next_item(buf, start) == (expected[0] if expected else None)
+
+
+def test_plan_shards_without_an_index(items_export):
+    with open(items_export, 'rb') as filep:
+        starts = item_starts(filep.read())
+
+    shards = indexer.plan_shards(items_export, 8)
+
+    assert len(shards) == 8
+    assert shards[0][0] == 0
+    assert all(start in starts for (start, end) in shards[1:])
+    assert all(end == following for ((_, end), (following, _)) in zip(shards, shards[1:]))
+
+
+def test_sharded_reader_matches_export_reader(items_export):
+    expected = list(ExportReader(items_export, fields=('UID', 'p4_audio')))
+
+    reader = ShardedReader(items_export, fields=('UID', 'p4_audio'), workers=2, shard_size=4096)
+
+    assert len(reader.shards) > 2
+    assert list(reader) == expected
+
+
+def test_find_items_in_a_compressed_export(export, tmp_path):
+    # about 3MB, so plenty of items cross the reader's 1MB chunks.
+    items = [story(n, text={'data': f"<p>{n} " + "words " * 8000 + "</p>", 'content-type': "text/html",
+                            'encoding': "utf-8"}) for n in range(60)]
+    filename = export(items)
+    with open(filename, 'rb') as source, gzip.open(tmp_path / "export.json.gz", 'wb') as target:
+        shutil.copyfileobj(source, target)
+    compressed = str(tmp_path / "export.json.gz")
+
+    uids = [f"uid{n:05d}" for n in range(60)]
+    found = list(indexer.find_items(compressed, uids=uids))
+
+    assert [item['UID'] for item in found] == uids
+    assert found == items
@@ -0,0 +1,49 @@
+from journal import Journal, CREATED, UPDATED, CONFLICT, FAILED, DELETED
+
+
+def test_committed_outcomes(tmp_path):
+    with Journal("Korean", filename=str(tmp_path / "journal.sqlite")) as journal:
+        journal.record("a", "/a.html", CREATED, digest="1")
+        journal.record("b", "/b.html", UPDATED, digest="1")
+        journal.record("c", "/c.html", CONFLICT)
+        journal.record("d", "/d.html", FAILED, "ReadTimeout")
+        journal.record("e", "/e.html", CREATED, digest="1")
+        journal.record("e", "/e.html", DELETED)
+
+        assert [uid for uid in "abcdef" if journal.committed(uid)] == ["a", "b", "c"]
+        assert sorted(journal.committed_uids()) == ["a", "b", "c"]
+
+
+def test_unchanged(tmp_path):
+    with Journal("Korean", filename=str(tmp_path / "journal.sqlite")) as journal:
+        journal.record("a", "/a.html", CREATED, digest="1")
+        assert journal.unchanged("a", "1")
+        assert not journal.unchanged("a", "2")
+        assert not journal.unchanged("b", "1")
+
+        # a failed update leaves the resource as it was, but it is sent again next time.
+        journal.record("a", "/a.html", FAILED, "ReadTimeout")
+        assert not journal.committed("a")
+        assert not journal.unchanged("a", "1")
+        assert journal.hashes["a"] == "1"
+
+        journal.record("a", "/a.html", UPDATED, digest="2")
+        assert journal.unchanged("a", "2")
+
+
+def test_reopened(tmp_path):
+    filename = str(tmp_path / "journal.sqlite")
+    with Journal("Korean", filename=filename) as journal:
+        journal.record("a", "/a.html", CREATED, digest="1", rid="rid-a")
+        journal.record("b", "/b.html", CREATED, digest="1", rid="rid-b")
+        journal.record("b", "/b.html", FAILED, "ReadTimeout")
+        journal.record("c", "/c.html", CREATED, digest="1", rid="rid-c")
+        journal.record("c", "/c.html", DELETED)
+
+    with Journal("Korean", filename=filename) as journal:
+        assert journal.unchanged("a", "1")
+        assert journal.rid("a") == "rid-a"
+        assert not journal.committed("b")
+        assert journal.rid("b") == "rid-b"
+        assert not journal.committed("c")
+        assert journal.rid("c") is None
@@ -0,0 +1,94 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import label_editor
+
+
+class FakeCatalog:
+    """ the resources still on the old labelset, served a page at a time.  relabelling one removes it,
+        unless it is one of 'failing', which fails that many times first.
+    """
+
+    def __init__(self, count, failing=None):
+        self.resources = {f"rid{n:03d}": SimpleNamespace(id=f"rid{n:03d}") for n in range(count)}
+        self.failing = dict(failing or {})
+        self.relabels = []
+
+    def page(self, page_number, page_size):
+        rids = sorted(self.resources)[page_number * page_size:(page_number + 1) * page_size]
+        next_page = (page_number + 1) * page_size < len(self.resources)
+        return SimpleNamespace(resources={rid: self.resources[rid] for rid in rids},
+                               fulltext=SimpleNamespace(next_page=next_page))
+
+    def relabel(self, rid=None, resource=None):
+        self.relabels.append(rid)
+        if self.failing.get(rid):
+            self.failing[rid] -= 1
+            raise RuntimeError(f"could not relabel {rid}")
+        del self.resources[rid]
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    def make(count, failing=None):
+        fake = FakeCatalog(count, failing)
+        monkeypatch.setattr(label_editor, "catalog_page", fake.page)
+        monkeypatch.setattr(label_editor, "edit_label", fake.relabel)
+        return fake
+    return make
+
+
+def test_relabels_everything_once(catalog):
+    fake = catalog(25)
+
+    assert label_editor.edit_all_labels(concurrency=3, page_size=10)
+    assert sorted(fake.relabels) == [f"rid{n:03d}" for n in range(25)]
+    assert not fake.resources
+
+
+def test_retries_failed_resources(catalog):
+    fake = catalog(25, failing={"rid003": 2, "rid017": 1})
+
+    assert label_editor.edit_all_labels(concurrency=3, page_size=10)
+    assert fake.relabels.count("rid003") == 3
+    assert fake.relabels.count("rid017") == 2
+    assert not fake.resources
+
+
+def test_gives_up_after_max_passes(catalog):
+    fake = catalog(5, failing={"rid002": 100})
+
+    assert not label_editor.edit_all_labels(concurrency=2, page_size=10, max_passes=3)
+    assert fake.relabels.count("rid002") == 3
+    assert list(fake.resources) == ["rid002"]
+
+
+def test_a_failing_result_does_not_hang(catalog, monkeypatch):
+    catalog(25)
+
+    class FailingMetrics:
+        target = None
+
+        def complete(self, outcome="completed"):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(label_editor, "METRICS", FailingMetrics())
+    errors = []
+
+    def relabel_all():
+        try:
+            label_editor.edit_all_labels(concurrency=3, page_size=10)
+        except OSError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=relabel_all, daemon=True)
+    thread.start()
+    thread.join(10)
+
+    assert not thread.is_alive()
+    assert [str(e) for e in errors] == ["disk full"]
@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+import pytest
+
+import loader
+from conftest import story
+from journal import Journal, CREATED, UPDATED
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """ the (uid, exists) of every record loader sends, in place of sending it """
+    calls = []
+    lock = threading.Lock()
+
+    def send_one(record, exists=False, upsert=False):
+        time.sleep(0.001)
+        with lock:
+            calls.append((record.uid, exists))
+        return UPDATED if exists else CREATED
+
+    monkeypatch.setattr(loader, "send_one", send_one)
+    return calls
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_max_uploads(export, sent, concurrency):
+    filename = export([story(n) for n in range(30)])
+
+    loader.load_file(filename, max_uploads=7, concurrency=concurrency, preprocess_workers=3)
+
+    assert len(sent) == 7
+    assert len(set(sent)) == 7
+
+
+def test_unpublished_items_are_not_sent(export, sent):
+    filename = export([story(n, review_state="private" if n % 3 else "published") for n in range(12)])
+
+    loader.load_file(filename, concurrency=2)
+
+    assert sorted(uid for (uid, exists) in sent) == [f"uid{n:05d}" for n in range(0, 12, 3)]
+
+
+def test_rerun_skips_what_the_journal_has(export, sent, tmp_path):
+    items = [story(n) for n in range(6)]
+    with Journal("Korean", filename=str(tmp_path / "journal.sqlite")) as journal:
+        loader.load_file(export(items), concurrency=2, journal=journal)
+        assert sorted(sent) == [(f"uid{n:05d}", False) for n in range(6)]
+
+        sent.clear()
+        items[2]['text'] = {'data': "<p>changed</p>", 'content-type': "text/html", 'encoding': "utf-8"}
+        loader.load_file(export(items + [story(6)], name="export2.json"), concurrency=2, journal=journal)
+        assert sorted(sent) == [("uid00002", True), ("uid00006", False)]
+
+
+def test_failure_manifest_is_replaced_only_by_failures(export, sent, monkeypatch, tmp_path):
+    filename = export([story(n) for n in range(5)])
+    manifest = tmp_path / "errors" / "failures.jsonl"
+    manifest.parent.mkdir()
+    manifest.write_text('{"UID": "uid00099"}\n')
+
+    failures = loader.FailureManifest(str(manifest))
+    loader.load_file(filename, concurrency=2, failures=failures)
+    failures.close()
+    assert manifest.read_text() == '{"UID": "uid00099"}\n'
+
+    def send_one(record, exists=False, upsert=False):
+        if record.uid == "uid00003":
+            raise RuntimeError("no")
+        return CREATED
+
+    monkeypatch.setattr(loader, "send_one", send_one)
+    failures = loader.FailureManifest(str(manifest))
+    loader.load_file(filename, concurrency=2, failures=failures)
+    failures.close()
+    assert [json.loads(line)['UID'] for line in manifest.read_text().splitlines()] == ["uid00003"]
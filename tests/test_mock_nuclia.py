@@ -0,0 +1,38 @@
+import json
+import urllib.request
+
+import pytest
+
+import mock_nuclia
+from conftest import story
+from story import preprocess_item
+
+search = pytest.importorskip("nucliadb_models.search")
+resource_models = pytest.importorskip("nucliadb_models.resource")
+
+
+@pytest.fixture
+def base():
+    server = mock_nuclia.serve(port=0)
+    yield f"http://127.0.0.1:{server.server_port}/api/v1/kb/mock"
+    server.shutdown()
+
+
+def request(url, body=None, method=None):
+    data = None if body is None else json.dumps(body, default=str).encode('utf-8')
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, method=method,
+                                                       headers={"Content-Type": "application/json"})) as response:
+        return json.loads(response.read())
+
+
+def test_replies_match_the_sdk_models(base):
+    """ the sdk parses every reply into these models - a reply that doesn't fit fails the tool """
+    created = request(f"{base}/resources", preprocess_item(story(1)).create_payload())
+    request(f"{base}/resource/{created['uuid']}", {'title': "retitled"}, method="PATCH")
+
+    resource = resource_models.Resource.model_validate(request(f"{base}/resource/{created['uuid']}"))
+    assert resource.title == "retitled"
+    catalog = search.CatalogResponse.model_validate(request(f"{base}/catalog", {'filters': []}))
+    assert list(catalog.resources) == [created['uuid']]
+    search.KnowledgeboxSearchResults.model_validate(request(f"{base}/search", {}))
+    resource_models.ResourceList.model_validate(request(f"{base}/resources"))
@@ -0,0 +1,19 @@
+import pytest
+
+import orchestrate
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "manifest"
+    manifest.write_text("# knowledgebox  export\n\nKorean  data/korean stories.json\nThai data/thai.json  # later\n")
+
+    assert orchestrate.read_manifest(str(manifest)) == [("Korean", "data/korean stories.json"),
+                                                        ("Thai", "data/thai.json")]
+
+
+def test_read_manifest_rejects_a_knowledgebox_listed_twice(tmp_path):
+    manifest = tmp_path / "manifest"
+    manifest.write_text("Korean data/korean.json\nThai data/thai.json\nKorean data/korean_more.json\n")
+
+    with pytest.raises(ValueError, match="Korean"):
+        orchestrate.read_manifest(str(manifest))
@@ -0,0 +1,100 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline
+
+
+def test_every_item_reaches_the_sink():
+    results = []
+
+    pipeline = Pipeline(range(200), depth=4)
+    pipeline.add_stage("double", lambda n: 2 * n, workers=3)
+    pipeline.add_stage("odd tens", lambda n: n if n % 20 else None, workers=2)
+    pipeline.run(results.append)
+
+    assert sorted(results) == [2 * n for n in range(200) if (2 * n) % 20]
+    assert [stage.processed for stage in pipeline.stages] == [200, 200]
+
+
+def test_stop_finishes_what_was_read():
+    results = []
+
+    def sink(n):
+        results.append(n)
+        if len(results) == 10:
+            pipeline.stop()
+
+    pipeline = Pipeline(itertools.count(), depth=2)
+    pipeline.add_stage("slow", lambda n: time.sleep(0.001) or n, workers=4)
+    pipeline.run(sink)
+
+    assert pipeline.stopped
+    assert len(results) == pipeline.source_stage.processed  # everything read was finished
+    assert len(results) <= 10 + 2 * 2 + 4 + 1  # then only what was queued or in hand
+    assert sorted(results) == list(range(len(results)))
+
+
+def test_a_failing_stage_stops_the_pipeline():
+    def fail(n):
+        if n == 50:
+            raise ValueError("bad item")
+        return n
+
+    pipeline = Pipeline(itertools.count(), depth=2)
+    pipeline.add_stage("fail", fail, workers=3)
+
+    with pytest.raises(ValueError, match="bad item"):
+        pipeline.run(lambda n: None)
+
+
+def test_a_failing_sink_stops_the_pipeline():
+    def sink(n):
+        if n == 50:
+            raise ValueError("bad result")
+
+    pipeline = Pipeline(itertools.count(), depth=2)
+    pipeline.add_stage("pass", lambda n: n, workers=3)
+
+    with pytest.raises(ValueError, match="bad result"):
+        pipeline.run(sink)
+
+
+def test_limit_caps_busy_workers():
+    busy = 0
+    most = 0
+    lock = threading.Lock()
+
+    def work(n):
+        nonlocal busy, most
+        with lock:
+            busy += 1
+            most = max(most, busy)
+        time.sleep(0.002)
+        with lock:
+            busy -= 1
+        return n
+
+    pipeline = Pipeline(range(100), depth=8)
+    pipeline.add_stage("work", work, workers=8, limit=lambda: 3)
+    pipeline.run(lambda n: None)
+
+    assert most == 3
+
+
+def test_summary_reports_the_sink_and_its_queue():
+    def slow_sink(n):
+        time.sleep(0.002)
+
+    pipeline = Pipeline(range(50), depth=4)
+    pipeline.add_stage("double", lambda n: 2 * n, workers=2)
+    pipeline.run(slow_sink, name="journal")
+
+    rows = [line.split() for line in pipeline.summary().splitlines()[1:]]
+    assert [row[0] for row in rows] == ["parse", "double", "journal"]
+    assert rows[-1][2] == "50"
+    assert pipeline.sink_stage.processed == 50
+    assert pipeline.queues[-1].max_depth > 0  # the slow sink's queue backed up
+    assert rows[-1][4] == f"{pipeline.queues[-1].mean_depth:.1f}/{pipeline.queues[-1].max_depth}"
@@ -0,0 +1,23 @@
+import threading
+
+import remove_privates
+from conftest import story
+
+
+def test_deletes_unpublished_items_missing_their_content(export, monkeypatch):
+    bare = [{'@id': f"https://www.rfa.org/korean/bare-{n}.html", 'UID': f"bare{n:05d}", 'review_state': "private"}
+            for n in range(5)]
+    filename = export([story(n, review_state="published" if n % 2 else "private") for n in range(6)] + bare)
+    deleted = []
+    lock = threading.Lock()
+
+    def delete_one(record):
+        with lock:
+            deleted.append((record.uid, record.url, record.delete_payload()))
+
+    monkeypatch.setattr(remove_privates, "delete_one", delete_one)
+    remove_privates.remove_privates(filename, concurrency=2)
+
+    assert sorted(uid for (uid, url, payload) in deleted) == ["bare00000", "bare00001", "bare00002", "bare00003",
+                                                              "bare00004", "uid00000", "uid00002", "uid00004"]
+    assert ("bare00003", "https://www.rfa.org/korean/bare-3.html", {'slug': "bare00003"}) in deleted
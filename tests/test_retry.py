@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import story
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def failure(uid, exception):
+    return json.dumps({'UID': uid, '@id': f"/{uid}.html", 'exception': exception, 'status': None, 'attempts': 1})
+
+
+def test_conflicts_are_kept_without_upsert(export, tmp_path):
+    filename = export([story(n) for n in range(6)])
+    manifest = tmp_path / "failures.jsonl"
+    conflicts = [failure("uid00001", "ConflictError"), failure("uid00004", "ConflictError")]
+    manifest.write_text("\n".join([failure("uid00000", "ReadTimeout")] + conflicts
+                                  + [failure("uid00002", "RateLimitError")]) + "\n")
+
+    # the new manifest is the one it read, as it is by default.
+    subprocess.run([sys.executable, "retry.py", "Korean", str(manifest), filename, "--fake-it",
+                    "--failures", str(manifest)], cwd=ROOT, check=True, capture_output=True)
+
+    assert manifest.read_text().splitlines() == conflicts
@@ -0,0 +1,170 @@
+import functools
+import time
+
+import backoff
+import httpx
+import pytest
+
+import throttle as throttle_module
+from throttle import Throttle, TokenBucket, without_sdk_retries
+
+
+def http_error(status, headers=None):
+    """ what a request fails with when the server replies with 'status' - no sdk needed """
+    request = httpx.Request("POST", "http://nuclia.test/api/v1/kb/kb1/resources")
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+
+def rate_limited(try_after=None):
+    return http_error(429, headers={'Retry-After': str(try_after)} if try_after is not None else None)
+
+
+class Flaky:
+    """ fails with each of 'failures' in turn, then returns 'done' """
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return "done"
+
+
+def test_retries_rate_limits_until_success():
+    throttle = Throttle(max_attempts=3, base_delay=0)
+    flaky = Flaky(rate_limited(), rate_limited())
+
+    assert throttle.call(flaky) == "done"
+    assert flaky.calls == 3
+    assert throttle.retries == 2
+
+
+def test_gives_up_after_max_attempts():
+    throttle = Throttle(max_attempts=2, base_delay=0)
+    flaky = Flaky(rate_limited(), rate_limited(), rate_limited())
+
+    with pytest.raises(Exception) as raised:
+        throttle.call(flaky)
+    assert raised.value.attempts == 2
+    assert flaky.calls == 2
+
+
+def test_does_not_retry_client_errors():
+    throttle = Throttle(max_attempts=5, base_delay=0)
+    flaky = Flaky(http_error(409))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        throttle.call(flaky)
+    assert flaky.calls == 1
+
+
+def test_sdk_errors():
+    if not throttle_module.sdk_errors()['client']:
+        pytest.skip("nucliadb_sdk doesn't import here")
+    from nucliadb_sdk.v2 import exceptions
+
+    assert throttle_module.http_status(exceptions.RateLimitError("too many requests", try_after=2)) == 429
+    assert throttle_module.retry_after(exceptions.RateLimitError("too many requests", try_after=2)) == 2.0
+    assert throttle_module.http_status(exceptions.ConflictError("exists")) == 409
+    assert throttle_module.http_status(exceptions.UnknownError("Unknown error connecting to API: 503: busy")) == 503
+
+
+def test_rate_limit_halves_concurrency_once_per_second():
+    throttle = Throttle(max_concurrency=8, max_attempts=3, base_delay=0)
+
+    throttle.call(Flaky(rate_limited(), rate_limited()))
+    assert throttle.limit == 4
+
+
+def test_successes_raise_concurrency_one_at_a_time():
+    throttle = Throttle(max_concurrency=4)
+    throttle.limit = 2
+
+    for n in range(2):
+        throttle.call(Flaky())
+    assert throttle.limit == 3
+    for n in range(3):
+        throttle.call(Flaky())
+    assert throttle.limit == 4
+    for n in range(10):
+        throttle.call(Flaky())
+    assert throttle.limit == 4
+
+
+def test_slow_replies_count_as_overloaded():
+    throttle = Throttle(max_concurrency=4, target_latency=0.01)
+
+    throttle.call(lambda: time.sleep(0.02))
+    assert throttle.limit == 2
+
+
+def test_retry_after_pauses_every_worker():
+    throttle = Throttle(max_attempts=2, base_delay=10)
+    flaky = Flaky(rate_limited(try_after=0.2))
+
+    tstart = time.monotonic()
+    throttle.call(flaky)
+    assert 0.2 <= time.monotonic() - tstart < 5  # the server's delay, not our own 10s backoff
+    assert throttle.bucket.paused_until >= tstart + 0.2
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+
+    tstart = time.monotonic()
+    for n in range(11):
+        bucket.acquire()
+    assert time.monotonic() - tstart >= 0.19
+
+
+def sdk_checkout(func):
+    """ like the sdk's @kb decorator - passes calls made with ndb= straight through """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class FakeResource:
+    """ decorated like nuclia.sdk.NucliaResource.create: the sdk's own backoff around the @kb checkout """
+
+    calls = 0
+
+    @backoff.on_exception(backoff.expo, Exception, max_tries=5, factor=10)
+    @sdk_checkout
+    def create(self, **kwargs):
+        import nuclia.exceptions
+        FakeResource.calls += 1
+        try:
+            raise rate_limited()
+        except Exception as e:
+            raise nuclia.exceptions.RateLimitError() from e
+
+
+def test_without_sdk_retries():
+    resource = FakeResource()
+    create = without_sdk_retries(resource.create)
+
+    assert create.__self__ is resource
+    assert create.__func__ is FakeResource.create.__wrapped__
+    assert without_sdk_retries(resource.__init__) == resource.__init__
+
+
+def test_sdk_rate_limit_reaches_the_throttle(monkeypatch):
+    throttle = Throttle(max_concurrency=8, max_attempts=2, base_delay=0)
+    decreases = []
+    decrease = throttle._decrease
+    monkeypatch.setattr(throttle, '_decrease', lambda: decreases.append(1) or decrease())
+    FakeResource.calls = 0
+
+    with pytest.raises(Exception) as raised:
+        throttle.call(FakeResource().create, ndb=None, slug="x")
+
+    assert FakeResource.calls == 2  # the throttle's attempts, not 5 of the sdk's for each
+    assert raised.value.attempts == 2
+    assert decreases == [1, 1]
+    assert throttle.limit == 4
@@ -0,0 +1,30 @@
+import threading
+
+import tracing
+
+
+def test_one_profile_at_a_time(monkeypatch, tmp_path):
+    for name in ('_trace_out', '_profile_every', '_profile_out', '_profile_stats', '_profile_calls', '_profiled', '_profile_busy'):
+        monkeypatch.setattr(tracing, name, getattr(tracing, name))
+    tracing.enable(profile_every=1, profile_out=str(tmp_path / "profile.pstats"))
+    entered = threading.Event()
+    done = threading.Event()
+
+    def profiled_block():
+        with tracing.profiled():
+            entered.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=profiled_block)
+    thread.start()
+    entered.wait(5)
+    with tracing.profiled():  # would raise ValueError on python 3.12+ if it started a second profiler
+        pass
+    done.set()
+    thread.join()
+    with tracing.profiled():
+        pass
+
+    assert tracing._profile_calls == 3
+    assert tracing._profile_busy == 1
+    assert tracing._profiled == 2
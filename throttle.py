@@ -0,0 +1,287 @@
+"""
+Rate limiting, retries and adaptive concurrency for requests to nuclia.
+
+Every request goes through Throttle.call(), which:
+  - waits for a token from a token bucket, so we never send faster than --rate requests/second,
+  - retries rate limits (429), server errors (5xx) and dropped connections with exponential
+    backoff and jitter, honouring the server's Retry-After / try_after when it gives one
+    (and holding every worker back until then, not just the one that was told),
+  - adjusts the number of requests the caller should keep in flight, AIMD style:
+    one more after a full window of fast successes, half as many after a 429/503 or a slow reply.
+
+It is the only retry layer: sdk methods the sdk wraps in its own 'backoff' retries (NucliaResource.create
+retries a 429 five times, over minutes, before raising it) are called past that decorator.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger("nuclia throttle")
+
+OVERLOADED = (429, 503)
+_status_pattern = re.compile(r"\b([45]\d\d)\b")
+
+
+_sdk_errors = None
+
+
+def sdk_errors():
+    """ the sdk exception classes http_status() knows, by kind, as tuples for isinstance().
+        imported with the first failure rather than at startup, and empty where an sdk can't be
+        imported - its exceptions can't be raised then either.
+    """
+    global _sdk_errors
+    if _sdk_errors is None:
+        errors = {'rate_limit': (), 'conflict': (), 'not_found': (), 'client': ()}
+        try:
+            from nucliadb_sdk.v2 import exceptions
+        except Exception as e:  # not installed, or doesn't import on this python
+            logger.debug(f"no nucliadb_sdk exceptions: {e!r}")
+        else:
+            errors = {'rate_limit': (exceptions.RateLimitError,),
+                      'conflict': (exceptions.ConflictError,),
+                      'not_found': (exceptions.NotFoundError,),
+                      'client': (exceptions.ClientError,)}
+        try:
+            import nuclia.exceptions
+        except Exception as e:
+            logger.debug(f"no nuclia exceptions: {e!r}")
+        else:
+            errors['rate_limit'] += (nuclia.exceptions.RateLimitError,)
+        _sdk_errors = errors
+    return _sdk_errors
+
+
+def http_status(exc):
+    """ the http status code behind an sdk exception, or None if it didn't come from a response """
+    import httpx
+
+    errors = sdk_errors()
+    if isinstance(exc, errors['rate_limit']):
+        return 429
+    if isinstance(exc, errors['conflict']):
+        return 409
+    if isinstance(exc, errors['not_found']):
+        return 404
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    if isinstance(exc, errors['client']):
+        # the sdk only puts the status in the message: "Unknown error connecting to API: 503: ..."
+        match = _status_pattern.search(str(exc))
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def retry_after(exc):
+    """ how long the server asked us to wait, in seconds, if it said """
+    for e in (exc, exc.__cause__):
+        try_after = getattr(e, 'try_after', None)
+        headers = getattr(getattr(e, 'response', None), 'headers', None)
+        if try_after is None and headers is not None:
+            try_after = headers.get('retry-after')
+        if try_after is not None:
+            try:
+                return max(float(try_after), 0.0)
+            except (TypeError, ValueError):
+                pass  # an http date rather than seconds - fall back to our own backoff.
+    return None
+
+
+def retryable(exc):
+    import httpx
+
+    if isinstance(exc, httpx.TransportError):
+        return True  # connection dropped, timed out, etc.
+    status = http_status(exc)
+    return status == 429 or (status is not None and status >= 500)
+
+
+def _is_backoff(func):
+    code = getattr(func, '__code__', None)
+    return code is not None and os.path.basename(os.path.dirname(code.co_filename)) == 'backoff'
+
+
+def without_sdk_retries(func):
+    """ func - or the method it is bound to - past any 'backoff' retry decorators around it """
+    instance = getattr(func, '__self__', None)
+    inner = getattr(func, '__func__', func)
+    unwrapped = inner
+    while _is_backoff(unwrapped) and getattr(unwrapped, '__wrapped__', None) is not None:
+        unwrapped = unwrapped.__wrapped__
+    if unwrapped is inner:
+        return func
+    return unwrapped.__get__(instance) if instance is not None else unwrapped
+
+
+class TokenBucket:
+    """ allow 'rate' requests per second on average, with bursts of up to 'burst' """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate or 1, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """ hand out no tokens for 'seconds' - the server told us to back off """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    if self.rate:
+                        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if not self.rate:
+                        return
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """ a token bucket shared by every process it is handed to, for a rate limit across processes """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate or 1, 1)
+        # tokens, updated, paused_until - time.monotonic() is the same clock in every process.
+        self._state = multiprocessing.Array('d', [self.capacity, time.monotonic(), 0.0])
+        self._lock = self._state.get_lock()
+
+    @property
+    def tokens(self):
+        return self._state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self._state[0] = value
+
+    @property
+    def updated(self):
+        return self._state[1]
+
+    @updated.setter
+    def updated(self, value):
+        self._state[1] = value
+
+    @property
+    def paused_until(self):
+        return self._state[2]
+
+    @paused_until.setter
+    def paused_until(self, value):
+        self._state[2] = value
+
+
+class Throttle:
+
+    def __init__(self, max_concurrency=1, rate=None, max_attempts=5, base_delay=1.0, max_delay=60.0,
+                 target_latency=None, bucket=None, gate=None):
+        """
+        :param max_concurrency: the most requests the caller may keep in flight
+        :param rate: maximum requests per second, or None for no limit
+        :param max_attempts: tries per request, including the first
+        :param base_delay: backoff before the first retry, in seconds; doubled for each retry after that
+        :param max_delay: longest backoff between tries, in seconds
+        :param target_latency: replies slower than this many seconds count as the server being overloaded
+        :param bucket: a token bucket to use instead of one of our own at 'rate', e.g. a SharedTokenBucket
+        :param gate: a semaphore held for the duration of each request, to cap requests in flight
+                     across several throttles (and processes)
+        """
+        self.max_concurrency = max(max_concurrency, 1)
+        self.limit = self.max_concurrency
+        self.bucket = bucket if bucket is not None else TokenBucket(rate)
+        self.gate = gate
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+
+        self.retries = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """ call func(*args, **kwargs), retrying transient failures.
+            the exception that finally escapes has an 'attempts' attribute.
+        """
+        func = without_sdk_retries(func)
+        attempt = 0
+        while True:
+            attempt += 1
+            waited = time.perf_counter()
+            self.bucket.acquire()
+            if time.perf_counter() - waited > 0.001:
+                tracing.add_span("rate limit", waited, time.perf_counter() - waited, "throttle")
+            tstart = time.monotonic()
+            try:
+                with tracing.span(getattr(func, '__name__', 'request'), "request", attempt=attempt):
+                    if self.gate is not None:
+                        with self.gate:
+                            result = func(*args, **kwargs)
+                    else:
+                        result = func(*args, **kwargs)
+            except Exception as e:
+                e.attempts = attempt
+                if http_status(e) in OVERLOADED:
+                    self._decrease()
+                if attempt >= self.max_attempts or not retryable(e):
+                    raise
+
+                delay = retry_after(e)
+                if delay is not None:
+                    self.bucket.pause(delay)
+                else:
+                    # exponential backoff with full jitter
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                logger.warning(f"{e.__class__.__name__} on attempt {attempt} - retrying in {delay:.1f}s")
+                with self._lock:
+                    self.retries += 1
+                with tracing.span("backoff", "throttle", attempt=attempt):
+                    time.sleep(delay)
+            else:
+                latency = time.monotonic() - tstart
+                if self.target_latency is not None and latency > self.target_latency:
+                    self._decrease()
+                else:
+                    self._increase()
+                return result
+
+    def _increase(self):
+        """ additive increase: one more request in flight per window of successes """
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                logger.debug(f"concurrency raised to {self.limit}")
+
+    def _decrease(self):
+        """ multiplicative decrease - at most once a second, so a burst of 429s only halves us once """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < 1.0:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                logger.info(f"server overloaded - concurrency lowered to {self.limit}")
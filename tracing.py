@@ -0,0 +1,157 @@
+"""
+Where each item's time goes: spans around the pipeline stages and the requests to nuclia,
+written out in Chrome trace format, and cProfile captures of a sample of them.
+
+    tracing.enable(trace_out="trace.json", profile_every=100, profile_out="load.pstats")
+    with tracing.span("serialise", slug=record.uid):
+        ...
+    with tracing.profiled():
+        ...
+    tracing.close()
+
+Open the trace in chrome://tracing or https://ui.perfetto.dev - every thread gets its own row.
+The http spans (added by client.py) run from sending a request to receiving the response headers,
+so the gap between one and the request span around it is the sdk's own work and reading the body.
+Read the profile with "python -m pstats load.pstats".
+
+Until enable() is called, span() and profiled() do nothing, cheaply.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger("tracing")
+
+MAX_EVENTS = 1000000  # stop recording spans after this many, rather than run out of memory
+
+_trace_out = None
+_events = []
+_threads = {}  # thread id -> name, for labelling the rows of the trace
+_dropped = 0
+_profile_every = None
+_profile_out = None
+_profile_stats = None
+_profile_calls = 0
+_profiled = 0
+_profile_busy = 0
+_lock = threading.Lock()
+_profiling = threading.Lock()  # held while a block is profiled - python 3.12 allows one profiler per process
+_pid = os.getpid()
+_tstart = time.perf_counter()
+_nothing = nullcontext()
+
+
+def enable(trace_out=None, profile_every=None, profile_out=None):
+    """ start recording spans (if trace_out is given), and profiling every profile_every'th call of profiled() """
+    global _trace_out, _profile_every, _profile_out
+    _trace_out = trace_out
+    if profile_every:
+        _profile_every = max(int(profile_every), 1)
+        _profile_out = profile_out or "profile.pstats"
+
+
+def enabled():
+    return _trace_out is not None
+
+
+def add_span(name, start, duration, category="nuclia", **args):
+    """ record a span that has already happened - start and duration from time.perf_counter() """
+    global _dropped
+    if _trace_out is None:
+        return
+    event = {'name': name,
+             'cat': category,
+             'ph': 'X',
+             'ts': (start - _tstart) * 1e6,
+             'dur': duration * 1e6,
+             'pid': _pid,
+             'tid': threading.get_ident(),
+             }
+    if event['tid'] not in _threads:
+        _threads[event['tid']] = threading.current_thread().name
+    if args:
+        event['args'] = args
+    with _lock:
+        if len(_events) < MAX_EVENTS:
+            _events.append(event)
+        else:
+            _dropped += 1
+
+
+@contextmanager
+def _span(name, category, args):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.perf_counter() - start, category, **args)
+
+
+def span(name, category="nuclia", **args):
+    """ a context manager recording how long its block took """
+    if _trace_out is None:
+        return _nothing
+    return _span(name, category, args)
+
+
+@contextmanager
+def _profile():
+    global _profile_stats, _profiled
+    try:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with _lock:
+                if _profile_stats is None:
+                    _profile_stats = pstats.Stats(profile)
+                else:
+                    _profile_stats.add(profile)
+                _profiled += 1
+    finally:
+        _profiling.release()
+
+
+def profiled():
+    """ a context manager that profiles one in every profile_every of the blocks it wraps.
+        a sample that comes up while another thread's block is being profiled is skipped.
+    """
+    global _profile_calls, _profile_busy
+    if _profile_every is None:
+        return _nothing
+    with _lock:
+        _profile_calls += 1
+        sample = _profile_calls % _profile_every == 0
+    if not sample:
+        return _nothing
+    if not _profiling.acquire(blocking=False):
+        with _lock:
+            _profile_busy += 1
+        return _nothing
+    return _profile()
+
+
+def close():
+    """ write out the trace and the profile """
+    if _trace_out is not None:
+        with _lock:
+            thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': _pid, 'tid': tid, 'args': {'name': name}}
+                            for (tid, name) in _threads.items()]
+            trace = {'traceEvents': thread_names + _events,
+                     'displayTimeUnit': 'ms'}
+            with open(_trace_out, 'w') as filep:
+                json.dump(trace, filep)
+        logger.info(f"{len(_events)} spans written to {_trace_out}"
+                    + (f" ({_dropped} more were dropped)" if _dropped else ""))
+
+    if _profile_stats is not None:
+        _profile_stats.dump_stats(_profile_out)
+        logger.info(f"{_profiled} of {_profile_calls} calls profiled into {_profile_out}"
+                    + (f" ({_profile_busy} samples skipped, another was being profiled)" if _profile_busy else ""))
@@ -1,10 +1,44 @@
 """
 This loads a json data file exported from plone and:
 counts the number of json items  - to manually validate a good export.
+
+The counts are remembered in a sidecar file next to the export (<filename>.counts.json)
+so the next tool to read the same export knows its size without parsing it first.
+
+Big exports can be parsed on several cores: ShardedReader hands shards of the file to a pool of
+processes and yields their items in file order, just as ExportReader would.
+
+Exports may be gzip or zstd compressed (see compressed.py): they are decompressed by a thread as
+they are parsed.  Compressed exports can't be cut into shards, so they are always read by ExportReader.
 """
 import argparse
+import json
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import ijson
 
+from indexer import plan_shards
+from compressed import compression, open_export_file
+
+logger = logging.getLogger("export reader")
+
+BUFFER_SIZE = 1024 * 1024  # bytes handed to the parser per read
+
+# the fastest ijson backend available, preferring the C one.
+try:
+    ijson_backend = ijson.get_backend('yajl2_c')
+except ImportError:
+    ijson_backend = ijson
+    logger.warning(f"ijson's C backend (yajl2_c) is not available - parsing with the slower '{ijson.backend}' backend")
+
+# fields the reader itself needs to count and skip items.
+COUNTED_FIELDS = ('@id', 'review_state', 'unexported_paths')
+
+SHARD_SIZE = 16 * 1024 * 1024  # bytes of the export per shard, when parsing in parallel
+
 
 def process_args():
     parser = argparse.ArgumentParser(description="Validate a plone export."
@@ -13,6 +47,11 @@ def process_args():
     parser.add_argument("filename",
                         help="filename of json export")
 
+    parser.add_argument("--workers",
+                        type=int,
+                        help="processes to parse the export with",
+                        default=1)
+
     parser.add_argument("-v", "--verbose",
                         help="turn on debug")
 
@@ -21,29 +60,232 @@ def process_args():
     return parsed_args
 
 
-def validate(filename):
-    with open(filename, 'r') as filep:
+def counts_filename(filename):
+    return f"{filename}.counts.json"
+
+
+def read_counts(filename):
+    """ return the (objects, unpublished, errors) remembered for this export,
+        or None if there is no sidecar or the export has changed since it was written.
+    """
+    try:
+        with open(counts_filename(filename), 'r') as filep:
+            counts = json.load(filep)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(filename)
+    if counts.get('size') != stat.st_size or counts.get('mtime') != stat.st_mtime_ns:
+        return None
+
+    return (counts['objects'], counts['unpublished'], counts['errors'])
+
+
+def write_counts(filename, objects, unpublished, errors):
+    stat = os.stat(filename)
+    counts = {'size': stat.st_size,
+              'mtime': stat.st_mtime_ns,
+              'objects': objects,
+              'unpublished': unpublished,
+              'errors': errors,
+              }
+    try:
+        with open(counts_filename(filename), 'w') as filep:
+            json.dump(counts, filep)
+    except OSError:
+        pass  # nowhere to put it - we'll just count again next time.
+
+
+class ExportReader:
+    """ stream the items of a plone export, counting them as they go by.
+
+        the totals come from the sidecar left by an earlier full pass if there is one.
+        otherwise they are estimated from how far through the file the parser is,
+        and become exact (and are saved to the sidecar) once the whole file has been read.
+
+        if 'fields' is given, each item is cut down to just those top level fields (plus the ones
+        needed for counting), so items waiting to be uploaded don't hold on to everything else in the export.
+    """
+
+    def __init__(self, filename, fields=None):
+        self.filename = filename
+        self.fields = None if fields is None else frozenset(fields).union(COUNTED_FIELDS)
+        self.size = os.path.getsize(filename)  # on disk - compressed, if it is
+        self.objects = 0
+        self.unpublished = 0
+        self.errors = 0
+        self.exact = read_counts(filename)
+        self._filep = None
+
+    def __iter__(self):
+        fields = self.fields
+        with open_export_file(self.filename, buffering=BUFFER_SIZE) as filep:
+            self._filep = filep
+
+            # stream it from json into objects one item at a time
+            for item in ijson_backend.items(filep, 'item', buf_size=BUFFER_SIZE):
+                if fields is not None:
+                    item = {key: value for (key, value) in item.items() if key in fields}
+                self._count(item)
+                yield item
+
+            self._filep = None
+
+        self._finished()
+
+    def _count(self, item):
+        if '@id' in item:
+            self.objects += 1
+            if item.get('review_state') != "published":
+                self.unpublished += 1
+        else:
+            self.errors = len(item['unexported_paths'])
+
+    def _finished(self):
+        # we read it all - remember the counts for next time.
+        self.exact = (self.objects, self.unpublished, self.errors)
+        write_counts(self.filename, *self.exact)
+
+    def _position(self):
+        """ how far through the file the parser is, or None if it isn't reading """
+        if self._filep is None:
+            return None
+        if hasattr(self._filep, 'compressed_position'):
+            return self._filep.compressed_position
+        return self._filep.tell()
+
+    def _estimate(self, seen):
+        """ scale a running count up to the whole file by the fraction of bytes read so far. """
+        position = self._position()
+        if not position:
+            return seen
+        return max(seen, round(seen * self.size / position))
+
+    @property
+    def total_objects(self):
+        if self.exact is not None:
+            return self.exact[0]
+        return self._estimate(self.objects)
+
+    @property
+    def total_published(self):
+        if self.exact is not None:
+            return self.exact[0] - self.exact[1]
+        return self._estimate(self.objects - self.unpublished)
+
+
+def parse_shard(filename, start, end, fields=None):
+    """ the items in bytes start to end of the export, or None if they aren't whole items.
+        runs in the ShardedReader's worker processes.
+    """
+    with open(filename, 'rb') as filep:
+        filep.seek(start)
+        data = filep.read(end - start)
+
+    # make the shard a json array of its own: "[" item, item, ... "]"
+    if start == 0:
+        data = data[data.find(b'[') + 1:]
+    data = data.rstrip()
+    if end >= os.path.getsize(filename):
+        if not data.endswith(b']'):
+            return None
+        data = data[:-1].rstrip()
+    elif data.endswith(b','):
+        data = data[:-1]
+
+    items = []
+    try:
+        for item in ijson_backend.items(b'[' + data + b']', 'item'):
+            if fields is not None:
+                item = {key: value for (key, value) in item.items() if key in fields}
+            items.append(item)
+    except ijson.JSONError:
+        return None
+    return items
+
+
+class ShardedReader(ExportReader):
+    """ the items of a plone export, in the same order as ExportReader, parsed by 'workers' processes.
+
+        the export is split into shards of about SHARD_SIZE bytes (see indexer.plan_shards), and up to
+        two shards per worker are parsed ahead of the one being read.  a shard that doesn't parse on its
+        own was cut inside an item, so it is parsed again here together with the next one.
+    """
+
+    def __init__(self, filename, fields=None, workers=2, shard_size=SHARD_SIZE):
+        super().__init__(filename, fields)
+        self.workers = max(workers, 1)
+        self.shards = plan_shards(filename, max(self.workers, self.size // shard_size + 1))
+        self._read = None  # bytes of the shards already yielded
+
+    def __iter__(self):
+        fields = self.fields
+        shards = iter(self.shards)
+        pending = deque()  # (start, end, future), in file order
+        self._read = 0
+
+        # the pipeline's threads are running by now, so start the workers afresh rather than fork.
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        def submit():
+            while len(pending) < 2 * self.workers:
+                shard = next(shards, None)
+                if shard is None:
+                    return
+                pending.append((*shard, pool.submit(parse_shard, self.filename, *shard, fields)))
+
+        try:
+            submit()
+            while pending:
+                (start, end, future) = pending.popleft()
+                items = future.result()
+                while items is None:
+                    # cut inside an item - try again with the next shard too.
+                    submit()
+                    if not pending:
+                        raise ValueError(f"{self.filename} is not a json array of items (from byte {start})")
+                    (_, end, following) = pending.popleft()
+                    following.cancel()
+                    logger.debug(f"shard at {start} didn't end between items - reading on to {end}")
+                    items = parse_shard(self.filename, start, end, fields)
+
+                submit()
+                for item in items:
+                    self._count(item)
+                    yield item
+                self._read = end
+        finally:
+            # if we stopped early, don't parse the rest.
+            pool.shutdown(cancel_futures=True)
+
+        self._read = None
+        self._finished()
+
+    def _position(self):
+        return self._read
+
+
+def open_export(filename, fields=None, workers=1):
+    """ an ExportReader, or a ShardedReader if there's more than one worker (and the export isn't compressed) """
+    if workers > 1 and compression(filename) is not None:
+        logger.info(f"{filename} is compressed - parsing it in one process, decompressing in another thread")
+    elif workers > 1:
+        return ShardedReader(filename, fields=fields, workers=workers)
+    return ExportReader(filename, fields=fields)
 
-        # stream it from json into objects one item at a time
-        items = ijson.items(filep, 'item')
-        objects = 0
-        errors = 0
-        unpublished = 0
 
-        for item in items:
-            if '@id' in item:
-                objects += 1
-                if item.get('review_state') != "published":
-                    unpublished += 1
-            else:
-                errors = len(item['unexported_paths'])
+def validate(filename, workers=1):
+    reader = open_export(filename, fields=(), workers=workers)
+    if reader.exact is None:
+        for item in reader:
+            pass
 
-    return (objects, unpublished, errors)
+    return reader.exact
 
 
 if __name__ == "__main__":
     args = process_args()
 
-    (objects, unpublished, errors) = validate(args.filename)
+    (objects, unpublished, errors) = validate(args.filename, args.workers)
 
     print(f"{args.filename}:  {objects} objects | {objects - unpublished} published | {errors} errors")
\ No newline at end of file